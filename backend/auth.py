@@ -1,32 +1,138 @@
+import hashlib
+import hmac
 import os
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from fastapi import Depends, Header, HTTPException
 from jose import jwt, JWTError
 from passlib.context import CryptContext
+from sqlalchemy import event
 from sqlalchemy.orm import Session
 
 from .database import SessionLocal
+from .metrics import metrics
 from .models import User
 
 # ------------------------------------------------------
 # PASSWORD HASH
 # ------------------------------------------------------
+# Custo do argon2 (padrões = os do passlib). Ao mudar, os hashes antigos
+# são refeitos no próximo login (verify_and_update).
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "3"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "65536"))  # KiB
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", "4"))
+
+# Pool dedicado ao argon2: no máximo HASH_WORKERS hashes em paralelo e
+# HASH_QUEUE_LIMIT esperando; acima disso a requisição recebe 503.
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 2)))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", str(HASH_WORKERS * 4)))
+
 pwd_context = CryptContext(
     schemes=["argon2"],
-    deprecated="auto"
+    deprecated="auto",
+    argon2__rounds=ARGON2_TIME_COST,
+    argon2__memory_cost=ARGON2_MEMORY_COST,
+    argon2__parallelism=ARGON2_PARALLELISM
 )
 
+
+class HashPoolBusy(Exception):
+    """Fila do pool de hash cheia (a API responde 503)."""
+
+
+class HashExecutor:
+    """
+    Executa o argon2 em threads próprias (o argon2-cffi libera o GIL),
+    fora do threadpool que atende as rotas, com limite de fila.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, queue_limit=HASH_QUEUE_LIMIT):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="argon2")
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+    def pending(self):
+        """Hashes rodando ou na fila."""
+        return self._pending
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashPoolBusy()
+        with self._pending_lock:
+            self._pending += 1
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+            self._slots.release()
+
+
+hasher = HashExecutor()
+
+metrics.gauge("argon2_pending", "Hashes argon2 rodando ou aguardando no pool", hasher.pending)
+
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return hasher.run(pwd_context.hash, password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return hasher.run(pwd_context.verify, plain_password, hashed_password)
+
+def verify_and_update_password(plain_password: str, hashed_password: str):
+    """
+    Retorna (ok, novo_hash). novo_hash vem preenchido quando o hash
+    foi gerado com parâmetros antigos e deve ser regravado.
+    """
+    return hasher.run(pwd_context.verify_and_update, plain_password, hashed_password)
 
 # ------------------------------------------------------
 # JWT CONFIG
 # ------------------------------------------------------
 SECRET_KEY = os.getenv("JWT_SECRET", "MUDE-ISSO-PARA-UM-SEGREDO-GIGANTE")
 ALGORITHM = "HS256"
+TOKEN_EXPIRE_HOURS = 24
+
+def create_token(user_id: int):
+    payload = {
+        "sub": str(user_id),
+        "exp": datetime.utcnow() + timedelta(hours=TOKEN_EXPIRE_HOURS)
+    }
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+
+# ------------------------------------------------------
+# LINKS DE DOWNLOAD ASSINADOS
+# ------------------------------------------------------
+# Link com validade para o download do EHI: o navegador abre direto
+# (sem header Authorization) e a assinatura HMAC amarra plano, dono e
+# expiração. Nenhuma consulta ao banco para validar.
+DOWNLOAD_LINK_TTL = int(os.getenv("DOWNLOAD_LINK_TTL", "900"))  # segundos
+
+def _download_signature(plan_id: int, user_id: int, expires: int) -> str:
+    message = f"{plan_id}:{user_id}:{expires}".encode()
+    return hmac.new(SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+def download_link_expiry(ttl: int = DOWNLOAD_LINK_TTL) -> int:
+    """
+    Expiração arredondada em janelas de `ttl` (o link vale entre ttl e
+    2*ttl). Na mesma janela o link é idêntico, então respostas que o
+    contêm (get-plans) podem ficar em cache até a janela virar.
+    """
+    return (int(time.time()) // ttl + 2) * ttl
+
+def create_download_link(plan_id: int, user_id: int, expires: int = None) -> str:
+    if expires is None:
+        expires = download_link_expiry()
+    sig = _download_signature(plan_id, user_id, expires)
+    return f"/api/download-ehi/{plan_id}?uid={user_id}&expires={expires}&sig={sig}"
+
+def verify_download_link(plan_id: int, user_id: int, expires: int, sig: str) -> bool:
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(_download_signature(plan_id, user_id, expires), sig)
 
 # ------------------------------------------------------
 # DB DEPENDENCY
@@ -38,13 +144,74 @@ def get_db():
     finally:
         db.close()
 
+# ------------------------------------------------------
+# CACHE DE USUÁRIOS (TTL + LRU)
+# ------------------------------------------------------
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))      # segundos
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
+# O que as rotas precisam do usuário logado (sem sessão do SQLAlchemy)
+CurrentUser = namedtuple("CurrentUser", ["id", "name", "email", "trial_used"])
+
+
+class UserCache:
+    def __init__(self, ttl=USER_CACHE_TTL, max_size=USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()  # user_id -> (expira_em, CurrentUser)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None:
+                return None
+
+            expires, principal = entry
+            if expires < time.monotonic():
+                del self._data[user_id]
+                return None
+
+            self._data.move_to_end(user_id)
+            return principal
+
+    def set(self, principal):
+        with self._lock:
+            self._data[principal.id] = (time.monotonic() + self.ttl, principal)
+            self._data.move_to_end(principal.id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+user_cache = UserCache()
+
+
+# Qualquer alteração/remoção de User pelo ORM tira o usuário do cache.
+# (UPDATE em massa via query.update() precisa chamar invalidate na mão.)
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
+
 # ------------------------------------------------------
 # CURRENT USER (JWT)
 # ------------------------------------------------------
 def get_current_user(
     authorization: str = Header(...),
     db: Session = Depends(get_db)
-):
+) -> CurrentUser:
+    """
+    Dependência única das rotas autenticadas.
+    Com o usuário em cache, a requisição não toca no banco.
+    """
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Token inválido")
 
@@ -53,11 +220,18 @@ def get_current_user(
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = int(payload.get("sub"))
-    except JWTError:
+    except (JWTError, TypeError, ValueError):
         raise HTTPException(status_code=401, detail="Token inválido ou expirado")
 
+    principal = user_cache.get(user_id)
+    if principal:
+        return principal
+
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=401, detail="Usuário não encontrado")
 
-    return user
+    principal = CurrentUser(user.id, user.name, user.email, bool(user.trial_used))
+    user_cache.set(principal)
+
+    return principal
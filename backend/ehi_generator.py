@@ -1,23 +1,35 @@
 import base64
+import os
 
-def generate_ehi(username: str, password: str, plan: str) -> str:
+# Servidor padrão (quando a conta não tem VPNServer atribuído)
+EHI_HOST = os.getenv("EHI_HOST", "maritimavpn.shop")
+EHI_PROXY_IP = os.getenv("EHI_PROXY_IP", "104.17.71.206")
+EHI_PROXY_PORT = os.getenv("EHI_PROXY_PORT", "80")
+
+def generate_ehi(username: str, password: str, plan: str, server=None) -> str:
     """
     Gera um arquivo EHI compatível com HTTP Injector.
     O retorno é uma string Base64 para ser salva no banco ou enviada por email.
+    `server` (VPNServer) define o host e o proxy para onde o EHI aponta.
     """
 
+    host = (server and server.public_host) or EHI_HOST
+
     payload = (
         "GET / HTTP/1.1[crlf]"
-        "Host: maritimavpn.shop[crlf]"
+        f"Host: {host}[crlf]"
         "Connection: Upgrade[crlf]"
         "Upgrade: websocket[crlf][crlf]"
     )
 
-    proxy_ip = "104.17.71.206"
-    proxy_port = "80"
+    proxy_ip = (server and server.proxy_ip) or EHI_PROXY_IP
+    proxy_port = (server and server.proxy_port) or EHI_PROXY_PORT
 
     # Preparar a string do nome do plano
-    plan_name = f"MaritimaVPN – Plano {plan} dias"
+    if plan == "trial":
+        plan_name = "MaritimaVPN – Teste grátis"
+    else:
+        plan_name = f"MaritimaVPN – Plano {plan} dias"
 
     # Template REAL de um .ehi simplificado (funcional para import no HTTP Injector)
     # Este formato segue a estrutura interna da versão 5.x
@@ -32,7 +44,7 @@ def generate_ehi(username: str, password: str, plan: str) -> str:
         "proxy_mode": "custom_payload",
         "use_payload": true,
         "ssh": {{
-            "host": "maritimavpn.shop",
+            "host": "{host}",
             "port": 22,
             "username": "{username}",
             "password": "{password}"
@@ -53,4 +65,3 @@ def generate_ehi(username: str, password: str, plan: str) -> str:
     encoded = base64.b64encode(ehi_content.encode()).decode()
 
     return encoded
-
@@ -0,0 +1,103 @@
+import hashlib
+import os
+from functools import lru_cache
+
+from .ehi_generator import EHI_HOST, EHI_PROXY_IP, EHI_PROXY_PORT, generate_ehi
+from .tracing import span
+
+# ------------------------------------------------------
+# CONFIG
+# ------------------------------------------------------
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+EHI_DIR = os.getenv("EHI_DIR", os.path.join(BASE_DIR, "ehis"))
+EHI_CACHE_SIZE = int(os.getenv("EHI_CACHE_SIZE", "2048"))  # stats de arquivos em memória
+
+# Mudou o template em ehi_generator? Incremente para regenerar todos os EHIs.
+EHI_TEMPLATE_VERSION = "1"
+
+os.makedirs(EHI_DIR, exist_ok=True)
+
+
+# ------------------------------------------------------
+# ARMAZENAMENTO ENDEREÇADO POR CONTEÚDO
+# ------------------------------------------------------
+# Cada EHI é gravado uma única vez em EHI_DIR/<ab>/<sha256>.ehi.
+# Como o nome depende do conteúdo, o arquivo nunca muda depois de
+# gravado: o stat em cache e o ETag (o próprio sha256) não precisam de
+# invalidação.
+def ehi_path(ehi_file):
+    return os.path.join(EHI_DIR, ehi_file)
+
+
+def store_ehi(encoded: str) -> str:
+    """Grava o EHI (gravação atômica) e retorna o nome relativo a EHI_DIR."""
+    data = encoded.encode()
+    digest = hashlib.sha256(data).hexdigest()
+    ehi_file = os.path.join(digest[:2], f"{digest}.ehi")
+    path = ehi_path(ehi_file)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    return ehi_file
+
+
+@lru_cache(maxsize=EHI_CACHE_SIZE)
+def stat_ehi(ehi_file: str) -> os.stat_result:
+    """os.stat do arquivo, guardado em memória (erros não entram no cache)."""
+    return os.stat(ehi_path(ehi_file))
+
+
+def ehi_etag(ehi_file: str) -> str:
+    """ETag forte: o sha256 do conteúdo, que já é o nome do arquivo."""
+    digest = os.path.splitext(os.path.basename(ehi_file))[0]
+    return f'"{digest}"'
+
+
+# ------------------------------------------------------
+# EHI POR CONTA
+# ------------------------------------------------------
+def ehi_fingerprint(username, password, plan, server=None):
+    """Resumo de tudo que entra no EHI; mudou, o arquivo precisa ser refeito."""
+    host = (server and server.public_host) or EHI_HOST
+    proxy_ip = (server and server.proxy_ip) or EHI_PROXY_IP
+    proxy_port = (server and server.proxy_port) or EHI_PROXY_PORT
+
+    parts = [EHI_TEMPLATE_VERSION, username, password, str(plan), host, proxy_ip, str(proxy_port)]
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def build_ehi(username, password, plan, server=None):
+    """Renderiza e grava o EHI. Retorna (ehi_file, fingerprint)."""
+    with span("generate_ehi", plan=str(plan)):
+        encoded = generate_ehi(username, password, str(plan), server)
+    with span("store_ehi"):
+        ehi_file = store_ehi(encoded)
+    return ehi_file, ehi_fingerprint(username, password, plan, server)
+
+
+def ensure_ehi(db, account):
+    """
+    Garante que o EHI da conta está atualizado e gravado; retorna o ehi_file.
+    Só renderiza de novo se credenciais, servidor ou plano mudaram
+    (ou se o arquivo sumiu do disco).
+    """
+    fingerprint = ehi_fingerprint(account.username, account.password, account.plan, account.server)
+
+    if account.ehi_fingerprint == fingerprint:
+        try:
+            stat_ehi(account.ehi_file)
+            return account.ehi_file
+        except OSError:
+            pass
+
+    account.ehi_file, account.ehi_fingerprint = build_ehi(
+        account.username, account.password, account.plan, account.server
+    )
+    db.commit()
+
+    return account.ehi_file
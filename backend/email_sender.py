@@ -1,54 +1,389 @@
+import heapq
+import os
+import queue
+import random
 import smtplib
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
 from email.message import EmailMessage
-import os
 
-def send_ehi_email(to_email, username):
+from .database import SessionLocal
+from .metrics import email_deliveries, metrics, smtp_connect_seconds, smtp_send_seconds
+from .models import EmailDelivery
+from .tracing import KIND_CLIENT, current_traceparent, resume_trace, span
+
+# ------------------------------------------------------
+# CONFIG SMTP
+# ------------------------------------------------------
+# Padrão: Gmail com senha de aplicativo. Para testar sem rede, aponte para
+# um SMTP local, ex.: `python -m aiosmtpd -n -l 127.0.0.1:8025` com
+# SMTP_HOST=127.0.0.1 SMTP_PORT=8025 SMTP_SSL=0 (sem EMAIL_APP_PASSWORD).
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_SSL = os.getenv("SMTP_SSL", "1") == "1"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "20"))
+
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", "20"))
+MAIL_BATCH_WAIT = float(os.getenv("MAIL_BATCH_WAIT", "0.5"))            # segundos
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "5"))
+MAIL_BACKOFF_BASE = float(os.getenv("MAIL_BACKOFF_BASE", "30"))         # segundos
+MAIL_BACKOFF_MAX = float(os.getenv("MAIL_BACKOFF_MAX", "1800"))
+MAIL_MAX_PER_CONNECTION = int(os.getenv("MAIL_MAX_PER_CONNECTION", "90"))
+MAIL_IDLE_CLOSE = float(os.getenv("MAIL_IDLE_CLOSE", "60"))             # fecha conexão ociosa
+MAIL_NOOP_AFTER = float(os.getenv("MAIL_NOOP_AFTER", "15"))             # testa conexão parada
+
+# Falhas de conexão: vale reconectar e reenviar
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, socket.timeout, ConnectionError)
+
+
+def _is_reconnect_error(e):
+    if isinstance(e, RECONNECT_ERRORS):
+        return True
+    # 421 = serviço indisponível / conexão sendo encerrada pelo servidor
+    return isinstance(e, smtplib.SMTPResponseException) and e.smtp_code == 421
+
+
+# ------------------------------------------------------
+# CONEXÃO SMTP REUTILIZÁVEL
+# ------------------------------------------------------
+class SMTPConnection:
     """
-    Envia um e-mail com o arquivo .ehi gerado como anexo.
+    Conexão SMTP autenticada que é reaproveitada entre vários envios.
+    Reconecta sozinha em 421/timeout/desconexão e depois de
+    `max_messages` mensagens (limite por sessão do Gmail).
     """
-    filepath = f"generated/ehi/{username}.ehi"
 
-    # Verifica se o arquivo existe antes de tentar enviá-lo
-    if not os.path.exists(filepath):
-        print(f"Erro: O arquivo {filepath} não foi encontrado.")
-        return
+    def __init__(
+        self,
+        host=SMTP_HOST,
+        port=SMTP_PORT,
+        use_ssl=SMTP_SSL,
+        username=None,
+        password=None,
+        timeout=SMTP_TIMEOUT,
+        max_messages=MAIL_MAX_PER_CONNECTION,
+    ):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.username = username if username is not None else os.getenv("EMAIL_SENDER")
+        self.password = password if password is not None else os.getenv("EMAIL_APP_PASSWORD")
+        self.timeout = timeout
+        self.max_messages = max_messages
 
-    msg = EmailMessage()
-    msg["Subject"] = "Seu arquivo EHI - Maritima VPN"
-    msg["From"] = os.getenv("EMAIL_SENDER")  # Melhor usar variáveis de ambiente para não deixar expostas as credenciais
-    msg["To"] = to_email
+        self._smtp = None
+        self._sent = 0
+        self._last_used = 0.0
+
+    @property
+    def is_open(self):
+        return self._smtp is not None
+
+    @property
+    def idle_for(self):
+        return time.monotonic() - self._last_used
+
+    def open(self):
+        started = time.perf_counter()
+        if self.use_ssl:
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+        if self.password:
+            smtp.login(self.username, self.password)
+        smtp_connect_seconds.observe(time.perf_counter() - started)
+
+        self._smtp = smtp
+        self._sent = 0
+        self._last_used = time.monotonic()
+
+    def close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except Exception:
+            try:
+                self._smtp.close()
+            except Exception:
+                pass
+        self._smtp = None
 
-    msg.set_content(f"""
-Olá!
+    def ensure_open(self):
+        if self._smtp is not None and self._sent >= self.max_messages:
+            self.close()
 
-Seu arquivo EHI já está pronto.
+        if self._smtp is not None and self.idle_for > MAIL_NOOP_AFTER:
+            try:
+                code, _ = self._smtp.noop()
+                if code != 250:
+                    self.close()
+            except Exception:
+                self.close()
 
-Faça download e importe no HTTP Injector.
+        if self._smtp is None:
+            self.open()
 
-Obrigado por usar a Maritima VPN!
-""")
+    def send(self, msg):
+        for attempt in range(2):
+            self.ensure_open()
+            try:
+                with smtp_send_seconds.time():
+                    self._smtp.send_message(msg)
+                self._sent += 1
+                self._last_used = time.monotonic()
+                return
+            except Exception as e:
+                if not _is_reconnect_error(e) or attempt == 1:
+                    raise
+                self.close()
 
-    try:
-        with open(filepath, "rb") as f:
+
+# ------------------------------------------------------
+# MENSAGENS
+# ------------------------------------------------------
+def build_message(delivery):
+    msg = EmailMessage()
+    msg["Subject"] = delivery.subject
+    msg["From"] = os.getenv("EMAIL_SENDER")
+    msg["To"] = delivery.to_email
+    msg.set_content(delivery.body or "")
+
+    if delivery.attachment_path:
+        with open(delivery.attachment_path, "rb") as f:
             msg.add_attachment(
                 f.read(),
                 maintype="application",
                 subtype="octet-stream",
-                filename=f"{username}.ehi"
+                filename=delivery.attachment_name or os.path.basename(delivery.attachment_path)
             )
 
-        # Configurações de SMTP usando Gmail (método de login com senha de aplicativo)
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-            email_sender = os.getenv("EMAIL_SENDER")  # E-mail de envio, que deve estar configurado como variável de ambiente
-            app_password = os.getenv("EMAIL_APP_PASSWORD")  # Senha do aplicativo, que deve estar configurada como variável de ambiente
-            smtp.login(email_sender, app_password)
-            smtp.send_message(msg)
-        
-        print(f"E-mail enviado com sucesso para {to_email}.")
-
-    except Exception as e:
-        print(f"Erro ao enviar o e-mail: {e}")
-        
-def send_email(to_email, username):
-        return send_ehi_email(to_email, username)    
+    return msg
+
+
+# ------------------------------------------------------
+# FILA DE ENVIO
+# ------------------------------------------------------
+def _backoff(attempts):
+    """Espera antes da próxima tentativa: exponencial com jitter (como os jobs de provisionamento)."""
+    delay = min(MAIL_BACKOFF_MAX, MAIL_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class MailQueue:
+    """
+    Fila em memória com uma thread de envio.
+    Cada item é o id de um EmailDelivery; a thread junta lotes de até
+    `batch_size` e envia todos pela mesma conexão SMTP. Retentativas
+    esperam em `_delayed` (heap por horário) até o backoff vencer.
+    """
+
+    def __init__(self, connection_factory=SMTPConnection, batch_size=MAIL_BATCH_SIZE, batch_wait=MAIL_BATCH_WAIT):
+        self.connection_factory = connection_factory
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+        self._queue = queue.Queue()
+        self._delayed = []          # heap [(time.monotonic() de envio, id)]
+        self._delayed_lock = threading.Lock()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._conn = None
+
+    def submit(self, delivery_id):
+        self._queue.put(delivery_id)
+
+    def submit_later(self, delivery_id, delay):
+        with self._delayed_lock:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, delivery_id))
+
+    def qsize(self):
+        return self._queue.qsize() + len(self._delayed)
+
+    def _release_due(self):
+        """Passa para a fila as retentativas vencidas; retorna segundos até a próxima."""
+        now = time.monotonic()
+        with self._delayed_lock:
+            while self._delayed and self._delayed[0][0] <= now:
+                self._queue.put(heapq.heappop(self._delayed)[1])
+            return self._delayed[0][0] - now if self._delayed else None
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+
+            self._stop.clear()
+            self._requeue_pending()
+
+            self._thread = threading.Thread(target=self._loop, name="mail-sender", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=30):
+        """Para a thread depois de esvaziar a fila."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _requeue_pending(self):
+        # Mensagens que ficaram na fila quando o processo parou
+        db = SessionLocal()
+        try:
+            rows = db.query(EmailDelivery.id, EmailDelivery.next_attempt_at).filter(
+                EmailDelivery.status == "queued"
+            ).all()
+        finally:
+            db.close()
+
+        now = datetime.utcnow()
+        for delivery_id, next_attempt_at in rows:
+            if next_attempt_at and next_attempt_at > now:
+                self.submit_later(delivery_id, (next_attempt_at - now).total_seconds())
+            else:
+                self._queue.put(delivery_id)
+
+    def _next_batch(self):
+        wait = self._release_due()
+        try:
+            first = self._queue.get(timeout=min(1, wait) if wait is not None else 1)
+        except queue.Empty:
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + self.batch_wait
+
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _loop(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+
+            if batch:
+                try:
+                    self._send_batch(batch)
+                except Exception as e:
+                    # Falha fora do envio (banco, por exemplo): os ids já saíram
+                    # da fila e as linhas continuam "queued", então voltam para ela
+                    print(f"Erro no envio de e-mails: {e}")
+                    for delivery_id in batch:
+                        self.submit_later(delivery_id, _backoff(1))
+            elif self._conn and self._conn.idle_for > MAIL_IDLE_CLOSE:
+                self._conn.close()
+
+        if self._conn:
+            self._conn.close()
+
+    @staticmethod
+    def _attempt_failed(delivery, error, retry):
+        delivery.attempts = (delivery.attempts or 0) + 1
+        delivery.last_error = str(error)
+
+        if delivery.attempts >= MAIL_MAX_ATTEMPTS:
+            delivery.status = "failed"
+            email_deliveries.inc("failed")
+            print(f"Erro ao enviar o e-mail para {delivery.to_email}: {error}")
+        else:
+            delay = _backoff(delivery.attempts)
+            delivery.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+            email_deliveries.inc("retry")
+            retry.append((delivery.id, delay))
+
+    def _send_batch(self, ids):
+        db = SessionLocal()
+        retry = []
+        try:
+            deliveries = db.query(EmailDelivery).filter(
+                EmailDelivery.id.in_(ids),
+                EmailDelivery.status == "queued"
+            ).all()
+
+            if not deliveries:
+                return
+
+            # Conecta antes do lote: com o SMTP fora do ar, cada mensagem
+            # conta uma tentativa e volta para a fila (sem um connect por mensagem)
+            try:
+                if self._conn is None:
+                    self._conn = self.connection_factory()
+                self._conn.ensure_open()
+            except Exception as e:
+                print(f"Erro ao conectar no SMTP: {e}")
+                if self._conn:
+                    self._conn.close()
+                for delivery in deliveries:
+                    self._attempt_failed(delivery, e, retry)
+                deliveries = []
+
+            for delivery in deliveries:
+                try:
+                    with resume_trace(delivery.trace_parent, "email.send", KIND_CLIENT, attempt=(delivery.attempts or 0) + 1):
+                        self._conn.send(build_message(delivery))
+                    delivery.status = "sent"
+                    delivery.sent_at = datetime.utcnow()
+                    delivery.last_error = None
+                    email_deliveries.inc("sent")
+                except Exception as e:
+                    self._attempt_failed(delivery, e, retry)
+
+                    if _is_reconnect_error(e):
+                        self._conn.close()
+
+            db.commit()
+        finally:
+            db.close()
+
+        for delivery_id, delay in retry:
+            self.submit_later(delivery_id, delay)
+
+
+mailer = MailQueue()
+
+metrics.gauge("mail_queue_depth", "E-mails na fila de envio em memória (inclui retentativas aguardando)", mailer.qsize)
+
+
+# ------------------------------------------------------
+# API
+# ------------------------------------------------------
+def send_email(to, subject, body, attachment_path=None, attachment_name=None):
+    """
+    Registra o e-mail na tabela de entregas e coloca na fila de envio.
+    Retorna o id do EmailDelivery; o envio acontece em background.
+    """
+    with span("send_email", subject=subject):
+        db = SessionLocal()
+        try:
+            delivery = EmailDelivery(
+                to_email=to,
+                subject=subject,
+                body=body,
+                attachment_path=attachment_path,
+                attachment_name=attachment_name,
+                status="queued",
+                attempts=0,
+                trace_parent=current_traceparent()  # o envio (outra thread) continua este trace
+            )
+            db.add(delivery)
+            db.commit()
+            delivery_id = delivery.id
+        finally:
+            db.close()
+
+    mailer.start()
+    mailer.submit(delivery_id)
+
+    return delivery_id
 
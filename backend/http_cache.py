@@ -0,0 +1,25 @@
+from email.utils import parsedate_to_datetime
+
+# ------------------------------------------------------
+# REQUISIÇÕES CONDICIONAIS
+# ------------------------------------------------------
+# Respostas do usuário logado: o navegador guarda, mas sempre revalida
+# (If-None-Match / If-Modified-Since) e recebe 304 se nada mudou.
+PRIVATE_REVALIDATE = "private, no-cache"
+
+
+def not_modified(request, etag, mtime=None):
+    """True quando o cliente já tem esta versão (responder 304)."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and mtime is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    return False
@@ -0,0 +1,161 @@
+import os
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert
+
+from .database import SessionLocal
+from .metrics import metrics
+from .models import LoginLog, LoginLogDaily
+
+# ------------------------------------------------------
+# CONFIG
+# ------------------------------------------------------
+LOGIN_LOG_BUFFER_SIZE = int(os.getenv("LOGIN_LOG_BUFFER_SIZE", "10000"))  # cheio: descarta os mais antigos
+LOGIN_LOG_BATCH_SIZE = int(os.getenv("LOGIN_LOG_BATCH_SIZE", "200"))
+LOGIN_LOG_FLUSH_MS = int(os.getenv("LOGIN_LOG_FLUSH_MS", "1000"))
+LOGIN_LOG_RETENTION_DAYS = int(os.getenv("LOGIN_LOG_RETENTION_DAYS", "30"))
+
+
+# ------------------------------------------------------
+# BUFFER DE LOGINS
+# ------------------------------------------------------
+class LoginLogBuffer:
+    """
+    Buffer circular em memória para os registros de login.
+    Uma thread grava em lote (um INSERT com executemany) a cada
+    LOGIN_LOG_BATCH_SIZE registros ou LOGIN_LOG_FLUSH_MS, o que vier
+    primeiro. No shutdown, stop() grava o que sobrou.
+    """
+
+    def __init__(self, max_size=LOGIN_LOG_BUFFER_SIZE, batch_size=LOGIN_LOG_BATCH_SIZE, flush_ms=LOGIN_LOG_FLUSH_MS):
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+
+        self._rows = deque(maxlen=max_size)
+        self._lock = threading.Lock()
+        self._full = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.dropped = 0
+
+    def add(self, email, ip_address, user_agent):
+        row = {
+            "email": email,
+            "ip_address": ip_address,
+            "user_agent": user_agent,
+            "created_at": datetime.utcnow(),
+        }
+
+        with self._lock:
+            if len(self._rows) == self._rows.maxlen:
+                self.dropped += 1
+            self._rows.append(row)
+            pending = len(self._rows)
+
+        if pending >= self.batch_size:
+            self._full.set()
+
+        self.start()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="login-log", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._full.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows = list(self._rows)
+            self._rows.clear()
+
+        if not rows:
+            return 0
+
+        db = SessionLocal()
+        try:
+            db.execute(insert(LoginLog), rows)
+            db.commit()
+        except Exception as e:
+            print(f"Erro ao gravar logs de login: {e}")
+            db.rollback()
+            # Devolve ao buffer para a próxima tentativa
+            with self._lock:
+                self._rows.extendleft(reversed(rows))
+            return 0
+        finally:
+            db.close()
+
+        return len(rows)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._full.wait(self.flush_interval)
+            self._full.clear()
+            self.flush()
+
+
+login_logs = LoginLogBuffer()
+
+metrics.gauge("login_log_buffer_depth", "Registros de login aguardando gravação", lambda: len(login_logs))
+metrics.gauge("login_log_dropped", "Registros de login descartados com o buffer cheio", lambda: login_logs.dropped)
+
+
+# ------------------------------------------------------
+# RETENÇÃO / AGREGADOS DIÁRIOS
+# ------------------------------------------------------
+def rollup_login_logs(retention_days=LOGIN_LOG_RETENTION_DAYS):
+    """
+    Resume os logs mais antigos que `retention_days` em LoginLogDaily
+    (logins por dia e IP) e apaga os registros individuais.
+    Processa um dia por transação.
+    """
+    cutoff = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=retention_days)
+    total = 0
+
+    db = SessionLocal()
+    try:
+        while True:
+            oldest = db.query(func.min(LoginLog.created_at)).filter(LoginLog.created_at < cutoff).scalar()
+            if oldest is None:
+                break
+
+            day_start = oldest.replace(hour=0, minute=0, second=0, microsecond=0)
+            day_end = min(day_start + timedelta(days=1), cutoff)
+            in_day = (LoginLog.created_at >= day_start, LoginLog.created_at < day_end)
+
+            counts = db.query(LoginLog.ip_address, func.count(LoginLog.id)).filter(*in_day).group_by(LoginLog.ip_address).all()
+
+            existing = {
+                row.ip_address: row
+                for row in db.query(LoginLogDaily).filter(LoginLogDaily.day == day_start.date()).all()
+            }
+
+            for ip_address, count in counts:
+                row = existing.get(ip_address)
+                if row:
+                    row.logins += count
+                else:
+                    db.add(LoginLogDaily(day=day_start.date(), ip_address=ip_address, logins=count))
+
+            total += db.query(LoginLog).filter(*in_day).delete(synchronize_session=False)
+            db.commit()
+    finally:
+        db.close()
+
+    return total
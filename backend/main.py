@@ -1,29 +1,39 @@
+import hmac
 import os
-from datetime import datetime, timedelta
+from email.utils import formatdate
+from typing import Optional
 
-from fastapi import FastAPI, Depends, HTTPException, Header, Request
+from fastapi import FastAPI, Depends, Header, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
-from jose import jwt, JWTError
+from fastapi.responses import FileResponse, JSONResponse, Response
+from sqlalchemy.orm import Session, joinedload
 
 from .database import Base, engine, SessionLocal
-from .models import User, VPNAccount, LoginLog
+from .models import User, VPNAccount
 from .schemas import UserCreate, UserLogin
-from .auth import hash_password, verify_password
+from .auth import (
+    HashPoolBusy,
+    create_token,
+    get_current_user,
+    get_db,
+    hash_password,
+    verify_and_update_password,
+    verify_download_link,
+)
 from .payment_routes import router as payment_router
-
-# ------------------------------------------------------
-# CONFIG JWT
-# ------------------------------------------------------
-SECRET_KEY = os.getenv("JWT_SECRET", "MUDE-ISSO-PARA-UM-SEGREDO-GIGANTE")
-ALGORITHM = "HS256"
-TOKEN_EXPIRE_HOURS = 24
-
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-EHI_DIR = os.path.join(BASE_DIR, "ehis")
-
-os.makedirs(EHI_DIR, exist_ok=True)
+from .provisioning import workers as provisioning_workers
+from .email_sender import mailer
+from .login_log import login_logs
+from .warm_pool import pool as warm_pool
+from .mercadopago_client import mp
+from .rate_limit import RateLimitMiddleware
+from .metrics import CONTENT_TYPE, METRICS_TOKEN, MetricsMiddleware, metrics
+from .tracing import exporter as trace_exporter
+from .migrations import run_migrations
+from .scheduler import start_scheduler, stop_scheduler
+from .servers import ensure_default_server
+from .http_cache import PRIVATE_REVALIDATE, not_modified
+from .ehi_store import ehi_etag, ehi_path, ensure_ehi, stat_ehi
 
 # ------------------------------------------------------
 # APP
@@ -35,48 +45,62 @@ app.mount("/imagens", StaticFiles(directory="imagens"), name="imagens")
 
 app.include_router(payment_router)
 
+# Antes das rotas: barra abuso em login/cadastro/teste/PIX
+app.add_middleware(RateLimitMiddleware)
+# Por fora de todos: mede também as respostas do limitador
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(HashPoolBusy)
+def hash_pool_busy(request: Request, exc: HashPoolBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Servidor ocupado, tente novamente em instantes"},
+        headers={"Retry-After": "1"}
+    )
+
 # ------------------------------------------------------
 # DB
 # ------------------------------------------------------
 Base.metadata.create_all(bind=engine)
+run_migrations(engine)
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+with SessionLocal() as _db:
+    ensure_default_server(_db)
 
 # ------------------------------------------------------
-# JWT
+# WORKERS (PROVISIONAMENTO, E-MAIL, RESERVA SSH E AGENDADOR)
 # ------------------------------------------------------
-def create_token(user_id: int):
-    payload = {
-        "sub": str(user_id),
-        "exp": datetime.utcnow() + timedelta(hours=TOKEN_EXPIRE_HOURS)
-    }
-    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+@app.on_event("startup")
+def start_workers():
+    provisioning_workers.start()
+    mailer.start()
+    login_logs.start()
+    warm_pool.start()
+    start_scheduler()
 
-def get_current_user(
-    authorization: str = Header(...),
-    db: Session = Depends(get_db)
-):
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Token inválido")
+@app.on_event("shutdown")
+def stop_workers():
+    stop_scheduler()
+    provisioning_workers.stop()
+    mailer.stop()
+    login_logs.stop()
+    warm_pool.stop()
+    mp.close()
+    trace_exporter.stop()
 
-    token = authorization.replace("Bearer ", "")
-
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = int(payload["sub"])
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Token inválido ou expirado")
+@app.on_event("shutdown")
+async def close_http_clients():
+    await mp.aclose()
 
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise HTTPException(status_code=401, detail="Usuário não encontrado")
+# ------------------------------------------------------
+# MÉTRICAS (PROMETHEUS)
+# ------------------------------------------------------
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and not hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Token inválido")
 
-    return user
+    return Response(content=metrics.render(), media_type=CONTENT_TYPE)
 
 # ------------------------------------------------------
 # REGISTER
@@ -105,74 +129,97 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
 def login(data: UserLogin, request: Request, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.email == data.email).first()
 
-    if not user or not verify_password(data.password, user.password):
+    if not user:
+        raise HTTPException(status_code=401, detail="Credenciais inválidas")
+
+    valid, new_hash = verify_and_update_password(data.password, user.password)
+    if not valid:
         raise HTTPException(status_code=401, detail="Credenciais inválidas")
 
-    log = LoginLog(
+    # Hash com parâmetros antigos do argon2: regrava com os atuais
+    if new_hash:
+        user.password = new_hash
+        db.commit()
+
+    # Gravado em lote pela thread do buffer, fora do caminho da resposta
+    login_logs.add(
         email=user.email,
         ip_address=request.client.host,
-        user_agent=request.headers.get("user-agent", "unknown"),
-        created_at=datetime.utcnow()
+        user_agent=request.headers.get("user-agent", "unknown")
     )
 
-    db.add(log)
-    db.commit()
-
     token = create_token(user.id)
     return {"token": token}
 
 # ------------------------------------------------------
-# MEUS PLANOS
+# DOWNLOAD EHI
 # ------------------------------------------------------
-@app.get("/api/get-plans")
-def get_plans(
-    user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
-    plans = db.query(VPNAccount).filter(
-        VPNAccount.owner_id == user.id
-    ).all()
-
-    return [
-        {
-            "id": p.id,
-            "plan": p.plan,
-            "username": p.username,
-            "expires": p.expires_at
-        }
-        for p in plans
-    ]
+# Com EHI_ACCEL_REDIRECT (ex.: "/_ehis/") quem envia o arquivo é o nginx:
+#
+#   location /_ehis/ {
+#       internal;
+#       alias /caminho/para/backend/ehis/;
+#   }
+EHI_ACCEL_REDIRECT = os.getenv("EHI_ACCEL_REDIRECT", "")
+
 
-# ------------------------------------------------------
-# DOWNLOAD EHI (CORRETO)
-# ------------------------------------------------------
 @app.get("/api/download-ehi/{plan_id}")
 def download_ehi(
     plan_id: int,
-    user: User = Depends(get_current_user),
+    request: Request,
+    uid: Optional[int] = None,
+    expires: Optional[int] = None,
+    sig: Optional[str] = None,
+    authorization: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
-    plan = db.query(VPNAccount).filter(
+    # Link assinado (aberto direto pelo navegador) ou token Bearer
+    if sig is not None:
+        if uid is None or expires is None or not verify_download_link(plan_id, uid, expires, sig):
+            raise HTTPException(status_code=403, detail="Link de download inválido ou expirado")
+        owner_id = uid
+    else:
+        if authorization is None:
+            raise HTTPException(status_code=401, detail="Token inválido")
+        owner_id = get_current_user(authorization, db).id
+
+    plan = db.query(VPNAccount).options(joinedload(VPNAccount.server)).filter(
         VPNAccount.id == plan_id,
-        VPNAccount.owner_id == user.id
+        VPNAccount.owner_id == owner_id
     ).first()
 
     if not plan:
         raise HTTPException(status_code=404, detail="Plano não encontrado")
 
-    if not plan.ehi_file:
-        raise HTTPException(
-            status_code=400,
-            detail="EHI ainda não gerado. Aguarde a confirmação do pagamento."
-        )
+    # Renderiza só se credenciais/servidor/plano mudaram
+    try:
+        ehi_file = ensure_ehi(db, plan)
+        stat = stat_ehi(ehi_file)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Arquivo EHI não encontrado")
+
+    etag = ehi_etag(ehi_file)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": PRIVATE_REVALIDATE,  # muda na renovação
+    }
+
+    if not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
 
-    file_path = os.path.join(EHI_DIR, plan.ehi_file)
+    filename = f"{plan.username}.ehi"
 
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Arquivo EHI não encontrado")
+    if EHI_ACCEL_REDIRECT:
+        headers["X-Accel-Redirect"] = EHI_ACCEL_REDIRECT + ehi_file.replace(os.sep, "/")
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return Response(media_type="application/octet-stream", headers=headers)
 
+    # FileResponse cuida de Range/If-Range e usa sendfile quando o servidor suporta
     return FileResponse(
-        path=file_path,
-        filename=plan.ehi_file,
-        media_type="application/octet-stream"
+        ehi_path(ehi_file),
+        media_type="application/octet-stream",
+        filename=filename,
+        headers=headers,
+        stat_result=stat
     )
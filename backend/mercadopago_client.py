@@ -0,0 +1,215 @@
+import asyncio
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+import httpx
+
+from .metrics import mercadopago_request_seconds
+from .tracing import KIND_CLIENT, record_span
+
+# ------------------------------------------------------
+# CONFIG MERCADO PAGO
+# ------------------------------------------------------
+# MP_API_URL pode apontar para um servidor falso local nos testes,
+# ex.: MP_API_URL=http://127.0.0.1:8099
+MP_API_URL = os.getenv("MP_API_URL", "https://api.mercadopago.com")
+MP_ACCESS_TOKEN = os.getenv("MP_ACCESS_TOKEN")
+
+MP_CONNECT_TIMEOUT = float(os.getenv("MP_CONNECT_TIMEOUT", "3"))
+MP_TIMEOUT = float(os.getenv("MP_TIMEOUT", "10"))                # leitura/escrita por chamada
+MP_MAX_RETRIES = int(os.getenv("MP_MAX_RETRIES", "3"))
+MP_RETRY_BASE = float(os.getenv("MP_RETRY_BASE", "0.2"))         # segundos
+MP_RETRY_MAX = float(os.getenv("MP_RETRY_MAX", "2"))
+MP_RETRY_AFTER_MAX = float(os.getenv("MP_RETRY_AFTER_MAX", "30"))  # teto para o Retry-After
+MP_POOL_SIZE = int(os.getenv("MP_POOL_SIZE", "20"))
+MP_KEEPALIVE = int(os.getenv("MP_KEEPALIVE", "10"))               # conexões ociosas mantidas
+MP_KEEPALIVE_EXPIRY = float(os.getenv("MP_KEEPALIVE_EXPIRY", "60"))
+
+# 429 e 5xx: o MP pede para tentar de novo
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class MercadoPagoError(Exception):
+    """Resposta de erro do Mercado Pago (ou falha de rede após as retentativas)."""
+
+    def __init__(self, message, status_code=None, response=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = response
+
+
+def _backoff(attempt, response=None):
+    # 429 com Retry-After: respeita o que o MP pediu (com teto)
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return min(MP_RETRY_AFTER_MAX, float(response.headers["Retry-After"]))
+
+    # Exponencial com "full jitter": espalha as retentativas de vários
+    # pedidos que falharam juntos
+    return random.uniform(0, min(MP_RETRY_MAX, MP_RETRY_BASE * 2 ** attempt))
+
+
+def _endpoint(path):
+    # /v1/payments/123 -> /v1/payments/{id}: o id não vira rótulo
+    return re.sub(r"/\d+", "/{id}", path)
+
+
+def _observe(method, path, started, status):
+    # Uma tentativa: histograma em /metrics e span no trace atual (se houver)
+    elapsed = time.perf_counter() - started
+    endpoint = _endpoint(path)
+    mercadopago_request_seconds.observe(elapsed, method, endpoint, status)
+    record_span(f"mercadopago {method} {endpoint}", elapsed, KIND_CLIENT, status=status)
+
+
+def _result(response):
+    if response.status_code >= 400:
+        raise MercadoPagoError(
+            f"Mercado Pago respondeu {response.status_code}: {response.text[:300]}",
+            status_code=response.status_code,
+            response=response
+        )
+    return response.json()
+
+
+# ------------------------------------------------------
+# CLIENTE
+# ------------------------------------------------------
+class MercadoPagoClient:
+    """
+    Cliente da API de pagamentos com conexões keep-alive reaproveitadas.
+
+    As rotas usam os métodos async (um httpx.AsyncClient por event loop);
+    os workers de provisionamento, que são threads, usam os *_sync
+    (um httpx.Client compartilhado). Os dois seguem a mesma política de
+    timeout e retentativa.
+
+    POST só é repetido com X-Idempotency-Key: o MP devolve o mesmo
+    pagamento em vez de criar outro.
+    """
+
+    def __init__(self, base_url=MP_API_URL, access_token=MP_ACCESS_TOKEN, max_retries=MP_MAX_RETRIES):
+        self.base_url = base_url
+        self.access_token = access_token
+        self.max_retries = max_retries
+
+        self._async_client = None
+        self._async_loop = None
+        self._sync_client = None
+        self._lock = threading.Lock()
+
+    def _client_options(self):
+        return {
+            "base_url": self.base_url,
+            "headers": {"Authorization": f"Bearer {self.access_token}"},
+            "timeout": httpx.Timeout(MP_TIMEOUT, connect=MP_CONNECT_TIMEOUT),
+            "limits": httpx.Limits(
+                max_connections=MP_POOL_SIZE,
+                max_keepalive_connections=MP_KEEPALIVE,
+                keepalive_expiry=MP_KEEPALIVE_EXPIRY
+            ),
+        }
+
+    def _get_async_client(self):
+        # Conexões ficam presas ao event loop em que foram abertas
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            self._async_client = httpx.AsyncClient(**self._client_options())
+            self._async_loop = loop
+        return self._async_client
+
+    def _get_sync_client(self):
+        with self._lock:
+            if self._sync_client is None:
+                self._sync_client = httpx.Client(**self._client_options())
+            return self._sync_client
+
+    @staticmethod
+    def _retryable(method, headers, attempt, max_retries):
+        if attempt >= max_retries:
+            return False
+        return method == "GET" or "X-Idempotency-Key" in headers
+
+    async def _request(self, method, path, json=None, params=None, headers=None, timeout=None):
+        headers = headers or {}
+        client = self._get_async_client()
+        attempt = 0
+
+        while True:
+            response = None
+            started = time.perf_counter()
+            try:
+                response = await client.request(
+                    method, path, json=json, params=params, headers=headers,
+                    timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+                )
+                _observe(method, path, started, str(response.status_code))
+                if response.status_code not in RETRY_STATUS or not self._retryable(method, headers, attempt, self.max_retries):
+                    return _result(response)
+            except httpx.TransportError as e:
+                _observe(method, path, started, "error")
+                if not self._retryable(method, headers, attempt, self.max_retries):
+                    raise MercadoPagoError(f"Falha ao conectar no Mercado Pago: {e}") from e
+
+            await asyncio.sleep(_backoff(attempt, response))
+            attempt += 1
+
+    def _request_sync(self, method, path, json=None, params=None, headers=None, timeout=None):
+        headers = headers or {}
+        client = self._get_sync_client()
+        attempt = 0
+
+        while True:
+            response = None
+            started = time.perf_counter()
+            try:
+                response = client.request(
+                    method, path, json=json, params=params, headers=headers,
+                    timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+                )
+                _observe(method, path, started, str(response.status_code))
+                if response.status_code not in RETRY_STATUS or not self._retryable(method, headers, attempt, self.max_retries):
+                    return _result(response)
+            except httpx.TransportError as e:
+                _observe(method, path, started, "error")
+                if not self._retryable(method, headers, attempt, self.max_retries):
+                    raise MercadoPagoError(f"Falha ao conectar no Mercado Pago: {e}") from e
+
+            time.sleep(_backoff(attempt, response))
+            attempt += 1
+
+    # --------------------------------------------------
+    # PAGAMENTOS
+    # --------------------------------------------------
+    async def create_pix(self, payment_data, idempotency_key=None, timeout=None):
+        """Cria o pagamento PIX. A mesma chave de idempotência vale para todas as tentativas."""
+        headers = {"X-Idempotency-Key": idempotency_key or str(uuid.uuid4())}
+        return await self._request("POST", "/v1/payments", json=payment_data, headers=headers, timeout=timeout)
+
+    async def get_payment(self, mp_payment_id, timeout=None):
+        return await self._request("GET", f"/v1/payments/{mp_payment_id}", timeout=timeout)
+
+    def get_payment_sync(self, mp_payment_id, timeout=None):
+        return self._request_sync("GET", f"/v1/payments/{mp_payment_id}", timeout=timeout)
+
+    def search_payments_sync(self, params, timeout=None):
+        """GET /v1/payments/search; retorna {"results": [...], "paging": {...}}."""
+        return self._request_sync("GET", "/v1/payments/search", params=params, timeout=timeout)
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+            self._async_loop = None
+
+    def close(self):
+        with self._lock:
+            if self._sync_client is not None:
+                self._sync_client.close()
+                self._sync_client = None
+
+
+mp = MercadoPagoClient()
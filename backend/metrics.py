@@ -0,0 +1,351 @@
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+# ------------------------------------------------------
+# CONFIG
+# ------------------------------------------------------
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# Com METRICS_TOKEN definido, /metrics exige "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Segundos. Chamadas externas (SSH, SMTP, MP) e requisições
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Consultas ao banco e trechos curtos
+FAST_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+
+# ------------------------------------------------------
+# REGISTRO (ACUMULADORES POR THREAD)
+# ------------------------------------------------------
+class MetricsRegistry:
+    """
+    Cada thread soma nos próprios acumuladores (um dict só dela), então
+    observe()/inc() não tomam trava nem disputam memória com outras
+    threads. A coleta (render) soma os dicts de todas as threads; o dict
+    de uma thread que terminou é incorporado ao acumulado e descartado.
+
+    Gauges são funções chamadas na coleta (tamanho de fila etc.).
+    """
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self._metrics = {}          # nome -> Counter/Histogram/Gauge
+        self._local = threading.local()
+        self._shards = []           # [(weakref da thread, dict)]
+        self._retired = {}          # soma das threads que já terminaram
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+            return shard
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Métrica duplicada: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(self, name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self, name, help, labels, buckets))
+
+    def gauge(self, name, help, fn, labels=()):
+        """`fn()` devolve um número ou, com `labels`, {(valores...): número}."""
+        return self._register(Gauge(self, name, help, labels, fn))
+
+    # --------------------------------------------------
+    # Coleta
+    # --------------------------------------------------
+    @staticmethod
+    def _merge(into, shard):
+        # list(): a thread dona pode estar criando séries agora
+        for key, cell in list(shard.items()):
+            total = into.get(key)
+            if total is None:
+                into[key] = list(cell)
+            else:
+                for i, value in enumerate(cell):
+                    total[i] += value
+
+    def snapshot(self):
+        """{(métrica, labels): [valores]} somado de todas as threads."""
+        with self._lock:
+            alive = []
+            for ref, shard in self._shards:
+                thread = ref()
+                if thread is None or not thread.is_alive():
+                    self._merge(self._retired, shard)
+                else:
+                    alive.append((ref, shard))
+            self._shards = alive
+
+            merged = {key: list(cell) for key, cell in self._retired.items()}
+
+        for _, shard in alive:
+            self._merge(merged, shard)
+
+        return merged
+
+    def render(self):
+        """Texto no formato de exposição do Prometheus."""
+        values = self.snapshot()
+        lines = []
+
+        for name, metric in sorted(self._metrics.items()):
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.render(values))
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# ------------------------------------------------------
+# TIPOS
+# ------------------------------------------------------
+class Counter:
+    kind = "counter"
+
+    def __init__(self, registry, name, help, labels):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def inc(self, *labels, amount=1):
+        if not self.registry.enabled:
+            return
+        shard = self.registry._shard()
+        key = (self.name, labels)
+        cell = shard.get(key)
+        if cell is None:
+            shard[key] = [amount]
+        else:
+            cell[0] += amount
+
+    def render(self, values):
+        for (name, labels), cell in sorted(values.items(), key=lambda item: item[0]):
+            if name == self.name:
+                yield f"{name}{_label_text(self.labels, labels)} {_number(cell[0])}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labels, buckets):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, seconds, *labels):
+        if not self.registry.enabled:
+            return
+        shard = self.registry._shard()
+        key = (self.name, labels)
+        cell = shard.get(key)
+        if cell is None:
+            # [count, sum, bucket_0 ... bucket_n, +Inf] (não cumulativo)
+            cell = shard[key] = [0, 0.0] + [0] * (len(self.buckets) + 1)
+        cell[0] += 1
+        cell[1] += seconds
+        cell[2 + bisect_left(self.buckets, seconds)] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self, values):
+        for (name, labels), cell in sorted(values.items(), key=lambda item: item[0]):
+            if name != self.name:
+                continue
+
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), cell[2:]):
+                cumulative += count
+                yield f"{name}_bucket{_label_text(self.labels, labels, [('le', _number(bound))])} {cumulative}"
+            yield f"{name}_sum{_label_text(self.labels, labels)} {_number(cell[1])}"
+            yield f"{name}_count{_label_text(self.labels, labels)} {cell[0]}"
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, registry, name, help, labels, fn):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+
+    def render(self, values):
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"Erro ao coletar a métrica {self.name}: {e}")
+            return
+
+        if self.labels:
+            for labels, number in sorted(value.items()):
+                yield f"{self.name}{_label_text(self.labels, labels)} {_number(number)}"
+        else:
+            yield f"{self.name} {_number(value)}"
+
+
+metrics = MetricsRegistry()
+
+
+# ------------------------------------------------------
+# MÉTRICAS DO BACKEND
+# ------------------------------------------------------
+http_request_seconds = metrics.histogram(
+    "http_request_duration_seconds", "Duração das requisições HTTP por rota",
+    ("method", "route", "status")
+)
+db_query_seconds = metrics.histogram(
+    "db_query_duration_seconds", "Tempo de execução das consultas SQL",
+    ("statement",), buckets=FAST_BUCKETS
+)
+ssh_connect_seconds = metrics.histogram(
+    "ssh_connect_duration_seconds", "Tempo para abrir e autenticar uma conexão SSH",
+    ("host",)
+)
+ssh_command_seconds = metrics.histogram(
+    "ssh_command_duration_seconds", "Duração dos comandos SSH (envio do script até o exit status)",
+    ("command",)
+)
+ssh_errors = metrics.counter(
+    "ssh_errors_total", "Falhas de conexão/comando SSH", ("stage",)
+)
+smtp_connect_seconds = metrics.histogram(
+    "smtp_connect_duration_seconds", "Tempo para abrir (e autenticar) a conexão SMTP"
+)
+smtp_send_seconds = metrics.histogram(
+    "smtp_send_duration_seconds", "Tempo de envio de uma mensagem pela conexão SMTP"
+)
+email_deliveries = metrics.counter(
+    "email_deliveries_total", "Resultado das tentativas de envio de e-mail (sent, retry, failed)",
+    ("result",)
+)
+mercadopago_request_seconds = metrics.histogram(
+    "mercadopago_request_duration_seconds", "Latência das chamadas à API do Mercado Pago (por tentativa)",
+    ("method", "endpoint", "status")
+)
+provisioning_step_seconds = metrics.histogram(
+    "provisioning_step_duration_seconds", "Duração das etapas do job de provisionamento",
+    ("step", "result")
+)
+scheduler_job_seconds = metrics.histogram(
+    "scheduler_job_duration_seconds", "Duração das execuções das tarefas agendadas",
+    ("job", "result")
+)
+
+
+def timed_job(fn):
+    """Envolve uma tarefa do agendador registrando duração e resultado."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        result = "error"
+        try:
+            value = fn(*args, **kwargs)
+            result = "ok"
+            return value
+        finally:
+            scheduler_job_seconds.observe(time.perf_counter() - started, fn.__name__, result)
+    return wrapper
+
+
+# ------------------------------------------------------
+# SQLALCHEMY
+# ------------------------------------------------------
+def instrument_engine(engine):
+    """Mede cada execução no cursor (before/after_cursor_execute)."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        db_query_seconds.observe(time.perf_counter() - started, verb)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        # Consulta que falhou não passa pelo after: descarta o início
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_started"):
+            conn.info["query_started"].pop()
+
+
+# ------------------------------------------------------
+# MIDDLEWARE HTTP
+# ------------------------------------------------------
+class MetricsMiddleware:
+    """
+    Middleware ASGI: tempo de cada requisição até o fim da resposta,
+    rotulado pelo caminho da rota (/api/download-ehi/{plan_id}, não o id).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not metrics.enabled:
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # O roteador do FastAPI grava a rota encontrada no scope
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            http_request_seconds.observe(time.perf_counter() - started, scope["method"], path, str(status))
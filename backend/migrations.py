@@ -0,0 +1,93 @@
+from sqlalchemy import inspect, text
+
+from .database import Base
+from . import models  # noqa: F401  (registra as tabelas no Base.metadata)
+
+# ------------------------------------------------------
+# MIGRAÇÕES
+# ------------------------------------------------------
+# create_all só cria tabelas novas. Alterações em tabelas que já existem
+# (índices, conversão de dados) ficam aqui, como passos idempotentes que
+# rodam a cada inicialização.
+
+
+def _create_missing_indexes(conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=conn, checkfirst=True)
+
+
+def _add_column(conn, table, column, ddl):
+    columns = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column not in columns:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _isoformat_to_datetime(conn, table, column):
+    # Datas eram gravadas com isoformat() ("2025-01-31T12:00:00"); o tipo
+    # DateTime do SQLite usa espaço como separador ("2025-01-31 12:00:00")
+    if conn.dialect.name != "sqlite":
+        return
+
+    conn.execute(text(
+        f"UPDATE {table} SET {column} = replace({column}, 'T', ' ') "
+        f"WHERE {column} LIKE '%T%'"
+    ))
+
+
+def _vpn_accounts_expires_at_datetime(conn):
+    _isoformat_to_datetime(conn, "vpn_accounts", "expires_at")
+
+
+def _vpn_accounts_active(conn):
+    _add_column(conn, "vpn_accounts", "active", "BOOLEAN NOT NULL DEFAULT 1")
+
+
+def _trials_expires_at_datetime(conn):
+    _isoformat_to_datetime(conn, "trials", "expires_at")
+
+
+def _server_id_columns(conn):
+    _add_column(conn, "vpn_accounts", "server_id", "INTEGER REFERENCES vpn_servers(id)")
+    _add_column(conn, "trials", "server_id", "INTEGER REFERENCES vpn_servers(id)")
+    _add_column(conn, "provisioning_jobs", "server_id", "INTEGER")
+
+
+def _vpn_accounts_ehi_fingerprint(conn):
+    # Contas antigas ficam sem fingerprint: o EHI é refeito no próximo download
+    _add_column(conn, "vpn_accounts", "ehi_fingerprint", "VARCHAR")
+
+
+def _vpn_accounts_updated_at(conn):
+    # Versão da lista de planos (get-plans); contas antigas partem de agora
+    _add_column(conn, "vpn_accounts", "updated_at", "DATETIME")
+    conn.execute(text("UPDATE vpn_accounts SET updated_at = CURRENT_TIMESTAMP WHERE updated_at IS NULL"))
+
+
+def _trace_parent_columns(conn):
+    _add_column(conn, "provisioning_jobs", "trace_parent", "VARCHAR")
+    _add_column(conn, "email_deliveries", "trace_parent", "VARCHAR")
+
+
+def _email_deliveries_next_attempt_at(conn):
+    _add_column(conn, "email_deliveries", "next_attempt_at", "DATETIME")
+
+
+MIGRATIONS = [
+    _vpn_accounts_expires_at_datetime,
+    _vpn_accounts_active,
+    _trials_expires_at_datetime,
+    _server_id_columns,
+    _vpn_accounts_ehi_fingerprint,
+    _vpn_accounts_updated_at,
+    _trace_parent_columns,
+    _email_deliveries_next_attempt_at,
+    _create_missing_indexes,  # sempre por último
+]
+
+
+def run_migrations(engine):
+    """Roda depois de Base.metadata.create_all (as tabelas já existem)."""
+    with engine.begin() as conn:
+        for migration in MIGRATIONS:
+            migration(conn)
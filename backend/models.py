@@ -3,10 +3,15 @@ from datetime import datetime
 from sqlalchemy import (
     Boolean,
     Column,
+    Date,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
+    JSON,
     String,
+    Text,
+    UniqueConstraint,
 )
 from sqlalchemy.orm import relationship
 from .database import Base
@@ -25,21 +30,58 @@ class User(Base):
     trials = relationship("Trial", back_populates="user")
 
 
+class VPNServer(Base):
+    __tablename__ = "vpn_servers"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+    region = Column(String, default="br")
+
+    # Acesso SSH para provisionar (vazio = credenciais padrão SSH_USER/SSH_PASS)
+    host = Column(String, nullable=False)
+    port = Column(Integer, default=22)
+    ssh_user = Column(String)
+    ssh_password = Column(String)
+
+    # Para onde o EHI do cliente aponta
+    public_host = Column(String)
+    proxy_ip = Column(String)
+    proxy_port = Column(String)
+
+    capacity = Column(Integer, default=500, nullable=False)
+    user_count = Column(Integer, default=0, nullable=False)  # contas ativas alocadas
+    healthy = Column(Boolean, default=True, nullable=False)
+    enabled = Column(Boolean, default=True, nullable=False)
+    last_check_at = Column(DateTime)
+
+    accounts = relationship("VPNAccount", back_populates="server")
+
+
 class VPNAccount(Base):
     __tablename__ = "vpn_accounts"
 
     id = Column(Integer, primary_key=True, index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
+    server_id = Column(Integer, ForeignKey("vpn_servers.id"), index=True)
     username = Column(String, nullable=False)
     password = Column(String, nullable=False)
-    expires_at = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
     plan = Column(String, nullable=False)
-    ehi_file = Column(String, nullable=False)
-    notified_expire = Column(Integer, default=0)  # 0 = não notificado, 1 = notificado
-
+    ehi_file = Column(String, nullable=False)         # caminho relativo a ehi_store.EHI_DIR
+    ehi_fingerprint = Column(String)                  # entradas do EHI gravado (ehi_store.ehi_fingerprint)
+    # Último aviso de expiração enviado: 0 = nenhum, 1 = 3 dias, 2 = 1 dia, 3 = expirado
+    notified_expire = Column(Integer, default=0)
+    active = Column(Boolean, default=True, nullable=False)  # False = revogada no servidor SSH
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     owner = relationship("User", back_populates="accounts")
-    
+    server = relationship("VPNServer", back_populates="accounts")
+
+    __table_args__ = (
+        Index("ix_vpn_accounts_expiry_scan", "notified_expire", "expires_at"),
+        Index("ix_vpn_accounts_active_expires", "active", "expires_at"),
+        Index("ix_vpn_accounts_owner_updated", "owner_id", "updated_at"),
+    )
 
 
 class Trial(Base):
@@ -47,13 +89,19 @@ class Trial(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
+    server_id = Column(Integer, ForeignKey("vpn_servers.id"))
     ssh_user = Column(String, nullable=False)
     ssh_pass = Column(String, nullable=False)
     created_at = Column(String, nullable=False)
-    expires_at = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
     active = Column(Boolean, default=True)
 
     user = relationship("User", back_populates="trials")
+    server = relationship("VPNServer")
+
+    __table_args__ = (
+        Index("ix_trials_active_expires", "active", "expires_at"),
+    )
     
 class Payment(Base):
     __tablename__ = "payments"
@@ -61,12 +109,33 @@ class Payment(Base):
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer)
     plan_days = Column(Integer)
-    mp_payment_id = Column(String)
+    mp_payment_id = Column(String, index=True)
+    # pending -> provisioning (job dono) -> approved; ou status do MP
     status = Column(String)
-    created_at = Column(String)
-    
-    
-    
+    created_at = Column(String)  # isoformat(): a ordem do texto é a da data
+
+    __table_args__ = (
+        Index("ix_payments_status_created", "status", "created_at"),
+    )
+
+
+class WebhookEvent(Base):
+    """Notificações recebidas, uma linha por (provedor, evento, ação)."""
+    __tablename__ = "webhook_events"
+
+    id = Column(Integer, primary_key=True)
+    provider = Column(String, nullable=False)
+    event_id = Column(String, nullable=False)
+    action = Column(String, nullable=False, default="")
+    mp_payment_id = Column(String, index=True)
+    job_id = Column(Integer)
+    received_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("provider", "event_id", "action", name="uq_webhook_events_event"),
+    )
+
+
 class LoginLog(Base):
     __tablename__ = "login_logs"
 
@@ -74,5 +143,81 @@ class LoginLog(Base):
     email = Column(String)
     ip_address = Column(String)
     user_agent = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class LoginLogDaily(Base):
+    """Logins antigos resumidos por dia e IP (ver login_log.rollup_login_logs)."""
+    __tablename__ = "login_logs_daily"
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    ip_address = Column(String)
+    logins = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("day", "ip_address", name="uq_login_logs_daily_day_ip"),
+    )
+
+
+class ProvisioningJob(Base):
+    __tablename__ = "provisioning_jobs"
+
+    id = Column(Integer, primary_key=True)
+    mp_payment_id = Column(String, nullable=False, index=True)
+    payment_id = Column(Integer)
+    vpn_account_id = Column(Integer)
+    server_id = Column(Integer)
+
+    # Credenciais geradas na criação do job: retentativas reaproveitam as mesmas
+    username = Column(String)
+    password = Column(String)
+
+    status = Column(String, default="pending", index=True)  # pending, running, done, skipped, failed
+    steps = Column(JSON, default=dict)                       # {"verify": "done", "ssh": "error: ..."}
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text)
+    trace_parent = Column(String)                            # traceparent W3C de quem enfileirou (tracing.py)
+
+    next_run_at = Column(DateTime, default=datetime.utcnow, index=True)
+    locked_at = Column(DateTime)
     created_at = Column(DateTime, default=datetime.utcnow)
-   
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class EmailDelivery(Base):
+    __tablename__ = "email_deliveries"
+
+    id = Column(Integer, primary_key=True)
+    to_email = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    body = Column(Text)
+    attachment_path = Column(String)
+    attachment_name = Column(String)
+
+    status = Column(String, default="queued", index=True)  # queued, sent, failed
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text)
+    trace_parent = Column(String)                          # traceparent W3C de quem enfileirou (tracing.py)
+    next_attempt_at = Column(DateTime)                     # retentativa com backoff (vazio = já)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+
+
+class WarmAccount(Base):
+    """Usuário SSH já criado e travado no servidor, esperando um cliente (warm_pool.py)."""
+    __tablename__ = "warm_accounts"
+
+    id = Column(Integer, primary_key=True)
+    server_id = Column(Integer, ForeignKey("vpn_servers.id"), nullable=False)
+    username = Column(String, nullable=False, unique=True)
+    password = Column(String, nullable=False)
+
+    status = Column(String, default="ready", nullable=False)  # reserving, ready, claimed
+    created_at = Column(DateTime, default=datetime.utcnow)
+    claimed_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_warm_accounts_server_status", "server_id", "status"),
+    )
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from .metrics import metrics
+
+# ------------------------------------------------------
+# CONFIG
+# ------------------------------------------------------
+PAYMENT_EVENTS_HISTORY = int(os.getenv("PAYMENT_EVENTS_HISTORY", "5000"))      # últimos status guardados
+PAYMENT_EVENTS_HEARTBEAT = float(os.getenv("PAYMENT_EVENTS_HEARTBEAT", "15"))  # segundos
+PAYMENT_EVENTS_MAX_SECONDS = float(os.getenv("PAYMENT_EVENTS_MAX_SECONDS", "900"))
+
+# Depois destes status o pagamento não muda mais: o stream é encerrado
+FINAL_STATUSES = {"approved", "rejected", "cancelled", "refunded", "charged_back", "failed", "expired"}
+
+
+# ------------------------------------------------------
+# PUB/SUB EM PROCESSO
+# ------------------------------------------------------
+class PaymentEvents:
+    """
+    Pub/sub de mudanças de status por pagamento (id do Mercado Pago).
+
+    publish() pode ser chamado de qualquer thread (workers de
+    provisionamento, agendador); o evento é entregue na fila asyncio de
+    cada assinante pelo event loop dela. O último evento de cada
+    pagamento fica guardado para quem assinar depois.
+    """
+
+    def __init__(self, history_size=PAYMENT_EVENTS_HISTORY):
+        self.history_size = history_size
+        self._subscribers = {}       # mp_payment_id -> {(loop, asyncio.Queue)}
+        self._last = OrderedDict()   # mp_payment_id -> último evento
+        self._lock = threading.Lock()
+
+    def publish(self, mp_payment_id, status, **data):
+        key = str(mp_payment_id)
+        event = {"status": status, **data}
+
+        with self._lock:
+            self._last[key] = event
+            self._last.move_to_end(key)
+            while len(self._last) > self.history_size:
+                self._last.popitem(last=False)
+
+            subscribers = list(self._subscribers.get(key, ()))
+
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:
+                # Loop já encerrado; o assinante sai no unsubscribe
+                pass
+
+    def last(self, mp_payment_id):
+        with self._lock:
+            return self._last.get(str(mp_payment_id))
+
+    def subscribe(self, mp_payment_id):
+        """Chamar de dentro do event loop. Retorna a fila de eventos."""
+        key = str(mp_payment_id)
+        entry = (asyncio.get_running_loop(), asyncio.Queue())
+
+        with self._lock:
+            self._subscribers.setdefault(key, set()).add(entry)
+
+        return entry
+
+    def unsubscribe(self, mp_payment_id, entry):
+        key = str(mp_payment_id)
+
+        with self._lock:
+            subscribers = self._subscribers.get(key)
+            if subscribers:
+                subscribers.discard(entry)
+                if not subscribers:
+                    del self._subscribers[key]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
+
+
+payment_events = PaymentEvents()
+
+metrics.gauge("payment_event_subscribers", "Conexões SSE acompanhando pagamentos", payment_events.subscriber_count)
+
+
+def sse_message(event, name="status"):
+    return f"event: {name}\ndata: {json.dumps(event)}\n\n"
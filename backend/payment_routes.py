@@ -1,48 +1,58 @@
+import asyncio
 import os
-import mercadopago
+from typing import Optional
 from datetime import datetime, timedelta
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.orm import Session
 
-from .auth import get_current_user
+from .auth import CurrentUser, download_link_expiry, get_current_user, get_db, user_cache
 from .database import SessionLocal
 from .models import Payment, User, VPNAccount
 from .schemas import CreatePlan
 from .ssh_connector import create_ssh_user
-from .ehi_generator import generate_ehi
+from .ehi_store import build_ehi, ehi_path
 from .email_sender import send_email
+from .webhooks import ingest_payment_event, is_duplicate, mercadopago_event_key
+from .mercadopago_client import MercadoPagoError, mp
+from .payment_events import (
+    FINAL_STATUSES,
+    PAYMENT_EVENTS_HEARTBEAT,
+    PAYMENT_EVENTS_MAX_SECONDS,
+    payment_events,
+    sse_message,
+)
+from .servers import NoServerAvailable, pick_server, release_server
+from .http_cache import PRIVATE_REVALIDATE, not_modified
+from .tracing import start_trace
+from .warm_pool import finish_claim, take_account
+from .scheduler import NOTICE_3_DAYS
+from .plans_cache import load_plans_page, plans_cache, plans_etag, plans_version, render_plans
 
 # ------------------------------------------------------
 # CONFIG
 # ------------------------------------------------------
 router = APIRouter(prefix="/api")
 
-sdk = mercadopago.SDK(os.getenv("MP_ACCESS_TOKEN"))
-
 PLAN_PRICES = {
     7: 5.00,
     15: 7.00,
     30: 12.00
 }
 
-# ------------------------------------------------------
-# DB
-# ------------------------------------------------------
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+PLANS_PAGE_SIZE = int(os.getenv("PLANS_PAGE_SIZE", "50"))
+PLANS_MAX_PAGE_SIZE = 200
 
 # ------------------------------------------------------
 # CRIAR PIX (NÃO CRIA PLANO AQUI)
 # ------------------------------------------------------
 @router.post("/create-pix")
-def create_pix(
+async def create_pix(
     data: CreatePlan,
-    user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    user: CurrentUser = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias="X-Idempotency-Key")
 ):
     plan_days = int(data.plan_days)
     price = PLAN_PRICES.get(plan_days)
@@ -60,22 +70,37 @@ def create_pix(
         "notification_url": "https://maritimavpn.shop/api/webhook/mercadopago"
     }
 
-    mp_payment = sdk.payment().create(payment_data)
-    response = mp_payment.get("response")
+    # Chave do cliente (clique duplo / reenvio) ou uma nova por pedido;
+    # o cliente MP repete a mesma chave nas retentativas
+    if idempotency_key:
+        idempotency_key = f"{user.id}-{idempotency_key}"
+
+    try:
+        response = await mp.create_pix(payment_data, idempotency_key=idempotency_key)
+    except MercadoPagoError as e:
+        print(f"Erro ao criar pagamento PIX: {e}")
+        raise HTTPException(status_code=502, detail="Erro ao criar pagamento PIX")
 
-    if not response or "id" not in response:
+    if "id" not in response:
         raise HTTPException(status_code=500, detail="Erro ao criar pagamento PIX")
 
-    payment = Payment(
-        user_id=user.id,
-        plan_days=plan_days,
-        mp_payment_id=str(response["id"]),
-        status=response["status"],
-        created_at=datetime.utcnow().isoformat()
-    )
+    # Sessão síncrona: grava fora do event loop. Com a mesma chave de
+    # idempotência o MP devolve o pagamento já criado: não duplica
+    def save_payment():
+        mp_payment_id = str(response["id"])
+        if db.query(Payment.id).filter(Payment.mp_payment_id == mp_payment_id).first():
+            return
 
-    db.add(payment)
-    db.commit()
+        db.add(Payment(
+            user_id=user.id,
+            plan_days=plan_days,
+            mp_payment_id=mp_payment_id,
+            status=response["status"],
+            created_at=datetime.utcnow().isoformat()
+        ))
+        db.commit()
+
+    await run_in_threadpool(save_payment)
 
     tx = response["point_of_interaction"]["transaction_data"]
 
@@ -101,101 +126,168 @@ async def mercadopago_webhook(request: Request, db: Session = Depends(get_db)):
     if not payment_id:
         return {"status": "invalid"}
 
-    mp_payment = sdk.payment().get(payment_id)
-    response = mp_payment.get("response")
-
-    if not response or response["status"] != "approved":
-        return {"status": "not_approved"}
+    # Retentativa já vista neste processo: nem chega no banco
+    key = mercadopago_event_key(body)
+    if is_duplicate(key):
+        return {"status": "duplicate"}
 
-    payment_db = db.query(Payment).filter(
-        Payment.mp_payment_id == str(payment_id)
-    ).first()
-
-    if not payment_db or payment_db.status == "approved":
-        return {"status": "already_processed"}
-
-    # Atualiza pagamento
-    payment_db.status = "approved"
-    db.commit()
-
-    user = db.query(User).filter(User.id == payment_db.user_id).first()
-    if not user:
-        return {"status": "user_not_found"}
-
-    # CRIA PLANO
-    plan_days = payment_db.plan_days
-    expires = datetime.utcnow() + timedelta(days=plan_days)
-
-    username = f"user{user.id}{payment_id[-4:]}"
-    password = os.urandom(4).hex()
-
-    create_ssh_user(username, password, plan_days)
-    ehi_path = generate_ehi(username, password, str(plan_days))
-
-    vpn = VPNAccount(
-        owner_id=user.id,
-        username=username,
-        password=password,
-        plan=str(plan_days),
-        expires_at=expires.isoformat(),
-        ehi_file=ehi_path,
-        notified_expire=0
-    )
-
-    db.add(vpn)
-    db.commit()
+    # Consulta ao MP, SSH, EHI e e-mail rodam nos workers de provisionamento.
+    # Aqui só registramos o evento/job e respondemos 200 na hora; o job
+    # guarda o trace e os workers continuam nele.
+    with start_trace("mercadopago_webhook", mp_payment_id=str(payment_id), action=key[2]) as trace:
+        status, job_id = await run_in_threadpool(ingest_payment_event, db, key, str(payment_id))
+        trace.set(result=status, job_id=job_id)
 
-    # ENVIA EMAIL
-    send_email(
-        to=user.email,
-        subject="Seu acesso Marítima VPN",
-        body=f"""
-Seu pagamento foi aprovado!
+    if job_id is None:
+        return {"status": status}
+    return {"status": status, "job_id": job_id}
 
-Usuário: {username}
-Senha: {password}
-Validade: {expires.strftime('%d/%m/%Y')}
+# ------------------------------------------------------
+# STATUS DO PAGAMENTO EM TEMPO REAL (SSE)
+# ------------------------------------------------------
+@router.get("/payments/{payment_id}/events")
+async def payment_status_events(
+    payment_id: str,
+    request: Request,
+    token: Optional[str] = None,
+    authorization: Optional[str] = Header(None)
+):
+    # EventSource não manda headers: o token pode vir na query string
+    if token:
+        authorization = f"Bearer {token}"
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Token inválido")
+
+    # Sessão própria e curta (sem Depends(get_db)): a dependência só seria
+    # fechada no fim do stream, segurando uma conexão do pool por até
+    # PAYMENT_EVENTS_MAX_SECONDS
+    def current_status():
+        db = SessionLocal()
+        try:
+            user = get_current_user(authorization, db)
+            return db.query(Payment.status).filter(
+                Payment.mp_payment_id == payment_id,
+                Payment.user_id == user.id
+            ).scalar()
+        finally:
+            db.close()
+
+    # Assina antes de ler o status: nenhuma transição fica no meio
+    subscription = payment_events.subscribe(payment_id)
 
-O arquivo EHI está anexado.
-""",
-        attachment_path=ehi_path
+    try:
+        status = await run_in_threadpool(current_status)
+    except Exception:
+        payment_events.unsubscribe(payment_id, subscription)
+        raise
+
+    if status is None:
+        payment_events.unsubscribe(payment_id, subscription)
+        raise HTTPException(status_code=404, detail="Pagamento não encontrado")
+
+    async def stream():
+        loop, queue = subscription
+        deadline = loop.time() + PAYMENT_EVENTS_MAX_SECONDS
+
+        try:
+            yield "retry: 3000\n\n"
+            yield sse_message({"status": status})
+            if status in FINAL_STATUSES:
+                return
+
+            while loop.time() < deadline:
+                try:
+                    event = await asyncio.wait_for(queue.get(), PAYMENT_EVENTS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": ping\n\n"
+                    continue
+
+                yield sse_message(event)
+                if event["status"] in FINAL_STATUSES:
+                    return
+        finally:
+            payment_events.unsubscribe(payment_id, subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
-    return {"status": "plan_created"}
-
 # ------------------------------------------------------
 # TESTE GRÁTIS (SOMENTE LOGADO)
 # ------------------------------------------------------
+def _release_trial(db, user_id):
+    """Devolve o teste grátis quando a criação falhou."""
+    db.query(User).filter(User.id == user_id).update({"trial_used": False}, synchronize_session=False)
+    db.commit()
+    user_cache.invalidate(user_id)
+
 @router.post("/trial")
 def create_trial(
-    user: User = Depends(get_current_user),
+    user: CurrentUser = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    if user.trial_used:
+    with start_trace("trial", user_id=user.id):
+        return _create_trial(user, db)
+
+def _create_trial(user, db):
+    # Marca o teste como usado antes de provisionar; o UPDATE condicional
+    # impede dois testes simultâneos para o mesmo usuário
+    claimed = db.query(User).filter(
+        User.id == user.id,
+        User.trial_used.isnot(True)
+    ).update({"trial_used": True}, synchronize_session=False)
+    db.commit()
+    user_cache.invalidate(user.id)
+
+    if not claimed:
         raise HTTPException(status_code=400, detail="Teste grátis já utilizado")
 
     plan_days = 3
     expires = datetime.utcnow() + timedelta(days=plan_days)
 
-    username = f"trial{user.id}{int(datetime.utcnow().timestamp()) % 1000}"
-    password = os.urandom(4).hex()
+    try:
+        server = pick_server(db)
+    except NoServerAvailable as e:
+        _release_trial(db, user.id)
+        raise HTTPException(status_code=503, detail=str(e))
+
+    # Conta pré-criada do servidor (um comando); reserva vazia: cria na hora
+    credentials = take_account(db, server, plan_days)
+
+    if credentials:
+        username, password = credentials
+    else:
+        username = f"trial{user.id}{int(datetime.utcnow().timestamp()) % 1000}"
+        password = os.urandom(4).hex()
+
+        ssh_result = create_ssh_user(username, password, plan_days, server)
+        if not ssh_result["success"]:
+            release_server(db, server.id)
+            _release_trial(db, user.id)
+            raise HTTPException(status_code=502, detail="Erro ao criar usuário VPN, tente novamente")
 
-    create_ssh_user(username, password, plan_days)
-    ehi_path = generate_ehi(username, password, str(plan_days))
+    ehi_file, fingerprint = build_ehi(username, password, "trial", server)
 
     vpn = VPNAccount(
         owner_id=user.id,
+        server_id=server.id,
         username=username,
         password=password,
         plan="trial",
-        expires_at=expires.isoformat(),
-        ehi_file=ehi_path,
-        notified_expire=0
+        expires_at=expires,
+        ehi_file=ehi_file,
+        ehi_fingerprint=fingerprint,
+        # O teste já nasce dentro da janela de 3 dias: só recebe os avisos seguintes
+        notified_expire=NOTICE_3_DAYS
     )
 
-    user.trial_used = True
-
     db.add(vpn)
+    if credentials:
+        finish_claim(db, username)
     db.commit()
 
     send_email(
@@ -208,7 +300,8 @@ Usuário: {username}
 Senha: {password}
 Validade: {expires.strftime('%d/%m/%Y')}
 """,
-        attachment_path=ehi_path
+        attachment_path=ehi_path(ehi_file),
+        attachment_name=f"{username}.ehi"
     )
 
     return {"message": "Teste grátis ativado com sucesso"}
@@ -218,19 +311,30 @@ Validade: {expires.strftime('%d/%m/%Y')}
 # ------------------------------------------------------
 @router.get("/get-plans")
 def get_plans(
-    user: User = Depends(get_current_user),
+    request: Request,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(PLANS_PAGE_SIZE, ge=1, le=PLANS_MAX_PAGE_SIZE),
+    user: CurrentUser = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    plans = db.query(VPNAccount).filter(
-        VPNAccount.owner_id == user.id
-    ).all()
-
-    return [
-        {
-            "id": p.id,
-            "plan": p.plan,
-            "username": p.username,
-            "expires": p.expires_at
-        }
-        for p in plans
-    ]
+    link_expires = download_link_expiry()
+    total, version = plans_version(db, user.id, link_expires)
+    etag = plans_etag(user.id, page, page_size, version)
+
+    headers = {
+        "ETag": etag,
+        "Cache-Control": PRIVATE_REVALIDATE,
+        "X-Total-Count": str(total),
+    }
+
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    body = plans_cache.get(user.id, (page, page_size), etag)
+
+    if body is None:
+        plans = load_plans_page(db, user.id, page, page_size)
+        body = render_plans(plans, user.id, link_expires)
+        plans_cache.set(user.id, (page, page_size), etag, body)
+
+    return Response(content=body, media_type="application/json", headers=headers)
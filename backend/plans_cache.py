@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import event, func
+
+from .auth import create_download_link
+from .models import VPNAccount
+
+# ------------------------------------------------------
+# CONFIG
+# ------------------------------------------------------
+PLANS_CACHE_SIZE = int(os.getenv("PLANS_CACHE_SIZE", "10000"))  # usuários
+
+
+# ------------------------------------------------------
+# VERSÃO DA LISTA DE PLANOS
+# ------------------------------------------------------
+def plans_version(db, user_id, link_expires):
+    """
+    Retorna (total, versão) da lista de planos do usuário.
+    A versão junta quantidade e max(updated_at) das contas (uma consulta
+    coberta pelo índice owner_id/updated_at) e a expiração dos links de
+    download, que também entram na resposta.
+    """
+    total, last_update = db.query(
+        func.count(VPNAccount.id),
+        func.max(VPNAccount.updated_at)
+    ).filter(VPNAccount.owner_id == user_id).one()
+
+    stamp = last_update.isoformat() if last_update else "-"
+    return total, f"{total}:{stamp}:{link_expires}"
+
+
+def plans_etag(user_id, page, page_size, version):
+    digest = hashlib.sha1(f"{user_id}:{page}:{page_size}:{version}".encode()).hexdigest()
+    return f'"{digest}"'
+
+
+# ------------------------------------------------------
+# PÁGINA DE PLANOS
+# ------------------------------------------------------
+def load_plans_page(db, user_id, page, page_size):
+    # Só as colunas da resposta (nada de senha/ehi_file)
+    return db.query(
+        VPNAccount.id,
+        VPNAccount.plan,
+        VPNAccount.username,
+        VPNAccount.expires_at
+    ).filter(
+        VPNAccount.owner_id == user_id
+    ).order_by(VPNAccount.id).offset((page - 1) * page_size).limit(page_size).all()
+
+
+def render_plans(plans, user_id, link_expires):
+    """Corpo JSON do get-plans, com o link de download assinado de cada conta."""
+    return json.dumps(jsonable_encoder([
+        {
+            "id": p.id,
+            "plan": p.plan,
+            "username": p.username,
+            "expires": p.expires_at,
+            "download_url": create_download_link(p.id, user_id, link_expires)
+        }
+        for p in plans
+    ]))
+
+
+# ------------------------------------------------------
+# CACHE DAS RESPOSTAS (LRU POR USUÁRIO)
+# ------------------------------------------------------
+class PlansCache:
+    """
+    Resposta já serializada do get-plans, por usuário e página.
+    Cada entrada guarda o ETag com que foi montada: se a versão mudou,
+    a entrada não serve mais e é refeita.
+    """
+
+    def __init__(self, max_size=PLANS_CACHE_SIZE):
+        self.max_size = max_size
+        self._data = OrderedDict()  # user_id -> {(page, page_size): (etag, body)}
+        self._lock = threading.Lock()
+
+    def get(self, user_id, page_key, etag):
+        with self._lock:
+            pages = self._data.get(user_id)
+            if not pages:
+                return None
+
+            entry = pages.get(page_key)
+            if entry is None or entry[0] != etag:
+                return None
+
+            self._data.move_to_end(user_id)
+            return entry[1]
+
+    def set(self, user_id, page_key, etag, body):
+        with self._lock:
+            pages = self._data.setdefault(user_id, {})
+            pages[page_key] = (etag, body)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+plans_cache = PlansCache()
+
+
+# Conta criada (provisionamento/teste), renovada ou removida pelo ORM:
+# descarta as páginas do dono. UPDATE em massa não passa por aqui, mas
+# atualiza updated_at, então a versão muda do mesmo jeito.
+@event.listens_for(VPNAccount, "after_insert")
+@event.listens_for(VPNAccount, "after_update")
+@event.listens_for(VPNAccount, "after_delete")
+def _invalidate_plans(mapper, connection, target):
+    plans_cache.invalidate(target.owner_id)
@@ -0,0 +1,473 @@
+import os
+import random
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from .database import SessionLocal
+from .models import Payment, ProvisioningJob, User, VPNAccount
+from .ssh_connector import provision_users
+from .ehi_store import build_ehi, ehi_path
+from .email_sender import send_email
+from .servers import get_server, pick_server
+from .mercadopago_client import MercadoPagoError, mp
+from .payment_events import payment_events
+from .metrics import metrics, provisioning_step_seconds
+from .tracing import current_traceparent, resume_trace, span
+from .warm_pool import finish_claim, take_account
+
+# ------------------------------------------------------
+# CONFIG
+# ------------------------------------------------------
+PROVISIONING_WORKERS = int(os.getenv("PROVISIONING_WORKERS", "4"))
+MAX_ATTEMPTS = int(os.getenv("PROVISIONING_MAX_ATTEMPTS", "6"))
+BACKOFF_BASE = float(os.getenv("PROVISIONING_BACKOFF_BASE", "5"))    # segundos
+BACKOFF_MAX = float(os.getenv("PROVISIONING_BACKOFF_MAX", "600"))
+POLL_INTERVAL = float(os.getenv("PROVISIONING_POLL_INTERVAL", "2"))
+LEASE_TIMEOUT = int(os.getenv("PROVISIONING_LEASE_TIMEOUT", "300"))  # job "running" sem commit de etapa
+
+OPEN_STATUSES = ("pending", "running")
+
+# Payment.status de quem já tem (ou teve) um job provisionando
+CLAIMED_STATUSES = ("provisioning", "approved")
+
+
+class JobSkipped(Exception):
+    """O job não deve continuar (pagamento não aprovado, já processado...)."""
+
+
+class LeaseLost(Exception):
+    """O lease do job venceu e outro worker assumiu: este para sem gravar nada."""
+
+
+# ------------------------------------------------------
+# ENFILEIRAR
+# ------------------------------------------------------
+def enqueue_payment(db, mp_payment_id):
+    """
+    Registra um job de provisionamento para o pagamento do Mercado Pago.
+    Se já houver um job aberto para o mesmo pagamento, reaproveita.
+    """
+    mp_payment_id = str(mp_payment_id)
+
+    job = db.query(ProvisioningJob).filter(
+        ProvisioningJob.mp_payment_id == mp_payment_id,
+        ProvisioningJob.status.in_(OPEN_STATUSES)
+    ).first()
+
+    if job:
+        return job
+
+    job = ProvisioningJob(
+        mp_payment_id=mp_payment_id,
+        status="pending",
+        steps={},
+        next_run_at=datetime.utcnow(),
+        trace_parent=current_traceparent()
+    )
+
+    db.add(job)
+    db.commit()
+
+    workers.wake()
+    return job
+
+
+# ------------------------------------------------------
+# ETAPAS
+# ------------------------------------------------------
+def _mark(job, step, status):
+    steps = dict(job.steps or {})
+    steps[step] = status
+    job.steps = steps
+
+
+def _commit(db, job):
+    """
+    Commit do job só se ele ainda for deste worker ("running" com o
+    locked_at que este worker gravou), renovando o lease. Senão desfaz a
+    transação e levanta LeaseLost.
+    """
+    lease = db.info["job_lease"]
+    now = datetime.utcnow()
+
+    owned = db.query(ProvisioningJob).filter(
+        ProvisioningJob.id == job.id,
+        ProvisioningJob.status == "running",
+        ProvisioningJob.locked_at == lease
+    ).update({"locked_at": now}, synchronize_session=False)
+
+    if not owned:
+        db.rollback()
+        raise LeaseLost(f"job {job.id} assumido por outro worker")
+
+    db.commit()
+    db.info["job_lease"] = now
+
+
+def _done(job, step):
+    return (job.steps or {}).get(step) == "done"
+
+
+def _step_verify(db, job):
+    # Antes de chamar o MP: pagamento desconhecido ou já tratado
+    payment_db = db.query(Payment).filter(
+        Payment.mp_payment_id == job.mp_payment_id
+    ).first()
+
+    if not payment_db:
+        raise JobSkipped("payment_not_found")
+
+    if payment_db.status in CLAIMED_STATUSES:
+        raise JobSkipped("already_processed")
+
+    try:
+        response = mp.get_payment_sync(job.mp_payment_id)
+    except MercadoPagoError as e:
+        if e.status_code == 404:
+            raise JobSkipped("not_approved")
+        raise
+
+    if not response or response.get("status") != "approved":
+        if response and response.get("status"):
+            payment_events.publish(job.mp_payment_id, response["status"])
+        raise JobSkipped("not_approved")
+
+    # Compare-and-set: só um job passa daqui por pagamento. O UPDATE fica
+    # na mesma transação que marca a etapa "verify" do job (commit em run_job)
+    claimed = db.query(Payment).filter(
+        Payment.id == payment_db.id,
+        Payment.status.notin_(CLAIMED_STATUSES)
+    ).update({"status": "provisioning"}, synchronize_session=False)
+
+    if not claimed:
+        raise JobSkipped("already_processed")
+
+    job.payment_id = payment_db.id
+    job.username = f"user{payment_db.user_id}{job.mp_payment_id[-4:]}"
+    job.password = os.urandom(4).hex()
+
+
+def _step_ssh(db, job, payment_db):
+    # A vaga no servidor é reservada uma vez e reaproveitada nas retentativas
+    if job.server_id is None:
+        job.server_id = pick_server(db).id
+        _commit(db, job)
+
+    server = get_server(db, job.server_id)
+
+    # Conta pré-criada: as credenciais do job passam a ser as dela
+    credentials = take_account(db, server, payment_db.plan_days)
+    if credentials:
+        job.username, job.password = credentials
+        return
+
+    result = provision_users([(job.username, job.password, payment_db.plan_days)], server)[0]
+
+    if not result["success"]:
+        raise RuntimeError(result["error"])
+
+
+def _step_account(db, job, payment_db, user):
+    plan_days = payment_db.plan_days
+    expires = datetime.utcnow() + timedelta(days=plan_days)
+
+    server = get_server(db, job.server_id)
+    ehi_file, fingerprint = build_ehi(job.username, job.password, plan_days, server)
+
+    vpn = VPNAccount(
+        owner_id=user.id,
+        server_id=job.server_id,
+        username=job.username,
+        password=job.password,
+        plan=str(plan_days),
+        expires_at=expires,
+        ehi_file=ehi_file,
+        ehi_fingerprint=fingerprint,
+        notified_expire=0
+    )
+
+    payment_db.status = "approved"
+
+    db.add(vpn)
+    # Conta veio da reserva: sai dela no mesmo commit que cria a VPNAccount
+    finish_claim(db, job.username)
+    db.flush()
+
+    job.vpn_account_id = vpn.id
+
+
+def _step_email(db, job, user):
+    vpn = db.query(VPNAccount).filter(VPNAccount.id == job.vpn_account_id).first()
+    expires = vpn.expires_at
+
+    send_email(
+        to=user.email,
+        subject="Seu acesso Marítima VPN",
+        body=f"""
+Seu pagamento foi aprovado!
+
+Usuário: {vpn.username}
+Senha: {vpn.password}
+Validade: {expires.strftime('%d/%m/%Y')}
+
+O arquivo EHI está anexado.
+""",
+        attachment_path=ehi_path(vpn.ehi_file),
+        attachment_name=f"{vpn.username}.ehi"
+    )
+
+
+def _release_payment(db, job):
+    """Solta o pagamento (provisioning -> pending): webhook ou conferência podem tentar de novo."""
+    if job.payment_id:
+        db.query(Payment).filter(
+            Payment.id == job.payment_id,
+            Payment.status == "provisioning"
+        ).update({"status": "pending"}, synchronize_session=False)
+
+
+@contextmanager
+def _timed_step(step):
+    started = time.perf_counter()
+    result = "error"
+    try:
+        with span(f"provisioning.{step}"):
+            yield
+        result = "done"
+    except JobSkipped:
+        result = "skipped"
+        raise
+    finally:
+        provisioning_step_seconds.observe(time.perf_counter() - started, step, result)
+
+
+def run_job(db, job):
+    """
+    Executa as etapas pendentes do job: verify -> ssh -> account -> email.
+    Etapas já concluídas (em tentativas anteriores) são puladas.
+    """
+    # Continua o trace do webhook que enfileirou o job
+    with resume_trace(
+        job.trace_parent, "provisioning.job",
+        job_id=job.id, mp_payment_id=job.mp_payment_id, attempt=(job.attempts or 0) + 1
+    ) as job_span:
+        db.info["job_lease"] = job.locked_at
+        try:
+            _run_job(db, job)
+        except LeaseLost as e:
+            print(f"Provisionamento interrompido: {e}")
+            job_span.set(status="lease_lost")
+            return
+        job_span.set(status=job.status)
+
+
+def _run_job(db, job):
+    step = "verify"
+    try:
+        if not _done(job, "verify"):
+            with _timed_step("verify"):
+                _step_verify(db, job)
+            _mark(job, "verify", "done")
+            _commit(db, job)
+
+        payment_db = db.query(Payment).filter(Payment.id == job.payment_id).first()
+        user = db.query(User).filter(User.id == payment_db.user_id).first()
+        if not user:
+            raise JobSkipped("user_not_found")
+
+        step = "ssh"
+        if not _done(job, "ssh"):
+            with _timed_step("ssh"):
+                _step_ssh(db, job, payment_db)
+            _mark(job, "ssh", "done")
+            _commit(db, job)
+
+        # EHI + conta + pagamento aprovado no mesmo commit
+        step = "account"
+        if not _done(job, "account"):
+            with _timed_step("account"):
+                _step_account(db, job, payment_db, user)
+            _mark(job, "account", "done")
+            _commit(db, job)
+
+            # Plano já existe: quem acompanha o pagamento (SSE) fica sabendo
+            payment_events.publish(job.mp_payment_id, "approved", plan_id=job.vpn_account_id)
+
+        step = "email"
+        if not _done(job, "email"):
+            with _timed_step("email"):
+                _step_email(db, job, user)
+            _mark(job, "email", "done")
+
+        job.status = "done"
+        job.last_error = None
+        _commit(db, job)
+
+    except LeaseLost:
+        raise
+
+    except JobSkipped as e:
+        db.rollback()
+        _mark(job, step, "skipped")
+        job.status = "skipped"
+        job.last_error = str(e)
+
+        # Pulado depois do compare-and-set da verificação (usuário sumiu):
+        # o pagamento não pode ficar preso em "provisioning"
+        _release_payment(db, job)
+        _commit(db, job)
+
+    except Exception as e:
+        db.rollback()
+        job.attempts = (job.attempts or 0) + 1
+        job.last_error = f"{step}: {e}"
+        _mark(job, step, f"error: {e}")
+
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = "failed"
+            _release_payment(db, job)
+        else:
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (job.attempts - 1))
+            job.status = "pending"
+            job.next_run_at = datetime.utcnow() + timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+        job.locked_at = None
+        _commit(db, job)
+
+        if job.status == "failed":
+            print(f"Job de provisionamento {job.id} falhou de vez: {job.last_error}")
+            payment_events.publish(job.mp_payment_id, "failed")
+
+
+# ------------------------------------------------------
+# WORKERS
+# ------------------------------------------------------
+def claim_next_job(db):
+    """
+    Pega o próximo job vencido e marca como "running".
+    O UPDATE condicional garante que dois workers não pegam o mesmo job.
+    """
+    now = datetime.utcnow()
+
+    candidates = db.query(ProvisioningJob.id).filter(
+        ProvisioningJob.status == "pending",
+        ProvisioningJob.next_run_at <= now
+    ).order_by(ProvisioningJob.next_run_at).limit(5).all()
+
+    for (job_id,) in candidates:
+        claimed = db.query(ProvisioningJob).filter(
+            ProvisioningJob.id == job_id,
+            ProvisioningJob.status == "pending"
+        ).update({"status": "running", "locked_at": now}, synchronize_session=False)
+        db.commit()
+
+        if claimed:
+            return db.query(ProvisioningJob).filter(ProvisioningJob.id == job_id).first()
+
+    return None
+
+
+def recover_stale_jobs(db):
+    """
+    Jobs "running" além do LEASE_TIMEOUT voltam para a fila: processo que
+    morreu no meio do job ou commit final que falhou (banco travado).
+    """
+    limit = datetime.utcnow() - timedelta(seconds=LEASE_TIMEOUT)
+
+    recovered = db.query(ProvisioningJob).filter(
+        ProvisioningJob.status == "running",
+        ProvisioningJob.locked_at < limit
+    ).update({"status": "pending", "locked_at": None}, synchronize_session=False)
+    db.commit()
+
+    return recovered
+
+
+def recover_provisioning_jobs():
+    """Tarefa do agendador: devolve jobs travados à fila e acorda os workers."""
+    db = SessionLocal()
+    try:
+        recovered = recover_stale_jobs(db)
+    finally:
+        db.close()
+
+    if recovered:
+        print(f"{recovered} job(s) de provisionamento travado(s) voltaram para a fila")
+        workers.wake()
+
+    return recovered
+
+
+class ProvisioningWorkerPool:
+    def __init__(self, size=PROVISIONING_WORKERS):
+        self.size = size
+        self._threads = []
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def start(self):
+        if self._threads:
+            return
+
+        db = SessionLocal()
+        try:
+            recover_stale_jobs(db)
+        finally:
+            db.close()
+
+        self._stop.clear()
+        for i in range(self.size):
+            t = threading.Thread(target=self._loop, name=f"provisioning-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _loop(self):
+        while not self._stop.is_set():
+            db = SessionLocal()
+            try:
+                job = claim_next_job(db)
+                if job:
+                    run_job(db, job)
+                    continue
+            except Exception:
+                traceback.print_exc()
+            finally:
+                db.close()
+
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+
+
+workers = ProvisioningWorkerPool()
+
+
+def _open_jobs():
+    db = SessionLocal()
+    try:
+        rows = db.query(ProvisioningJob.status, func.count(ProvisioningJob.id)).filter(
+            ProvisioningJob.status.in_(OPEN_STATUSES)
+        ).group_by(ProvisioningJob.status).all()
+    finally:
+        db.close()
+
+    counts = {(status,): 0 for status in OPEN_STATUSES}
+    counts.update({(status,): count for status, count in rows})
+    return counts
+
+
+metrics.gauge("provisioning_jobs", "Jobs de provisionamento na fila (pending) e em execução (running)", _open_jobs, ("status",))
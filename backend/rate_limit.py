@@ -0,0 +1,269 @@
+import json
+import math
+import os
+import threading
+import time
+import zlib
+
+from jose import JWTError, jwt
+
+from .auth import ALGORITHM, SECRET_KEY
+from .metrics import metrics
+
+# ------------------------------------------------------
+# CONFIG
+# ------------------------------------------------------
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "16"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))  # por shard
+# Atrás de nginx/proxy: usa o primeiro IP do X-Forwarded-For
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "0") == "1"
+
+
+def _per_minute(name, default):
+    return float(os.getenv(name, default)) / 60
+
+
+# Orçamento por rota: (escopo, taxa em fichas/segundo, rajada).
+# "ip" vale para todos; "user" só quando há token válido.
+# `concurrency` limita quantas requisições da rota rodam ao mesmo tempo:
+# testes grátis usam SSH na hora e não podem tomar as conexões dos
+# workers que provisionam pagamentos.
+ROUTE_LIMITS = {
+    ("POST", "/api/login"): {
+        "limits": [("ip", _per_minute("RATE_LOGIN_PER_MIN", "10"), 10)],
+    },
+    ("POST", "/api/register"): {
+        "limits": [("ip", _per_minute("RATE_REGISTER_PER_MIN", "5"), 5)],
+    },
+    ("POST", "/api/trial"): {
+        "limits": [
+            ("user", _per_minute("RATE_TRIAL_USER_PER_MIN", "0.1"), 2),
+            ("ip", _per_minute("RATE_TRIAL_IP_PER_MIN", "0.5"), 5),
+        ],
+        "concurrency": int(os.getenv("TRIAL_MAX_CONCURRENT", "4")),
+    },
+    ("POST", "/api/create-pix"): {
+        "limits": [
+            ("user", _per_minute("RATE_PIX_USER_PER_MIN", "10"), 5),
+            ("ip", _per_minute("RATE_PIX_IP_PER_MIN", "30"), 15),
+        ],
+        "concurrency": int(os.getenv("PIX_MAX_CONCURRENT", "32")),
+    },
+}
+
+
+# ------------------------------------------------------
+# BALDES DE FICHAS (MEMÓRIA, LOCK POR SHARD)
+# ------------------------------------------------------
+class TokenBucketStore:
+    """
+    Baldes de fichas em memória, divididos em shards (um lock cada) para
+    que chaves diferentes não disputem a mesma trava.
+
+    Com vários processos (uvicorn --workers N) cada um tem o seu; para um
+    limite global troque `limiter.store` por um objeto com os mesmos
+    take(key, rate, burst) e refund(key, rate, burst) apoiado num
+    backend compartilhado.
+    """
+
+    def __init__(self, shards=RATE_LIMIT_SHARDS, max_keys=RATE_LIMIT_MAX_KEYS):
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        self.max_keys = max_keys
+
+    def _shard(self, key):
+        return self._shards[zlib.crc32(key.encode()) % len(self._shards)]
+
+    def take(self, key, rate, burst, cost=1.0):
+        """
+        Tira `cost` fichas do balde. Retorna (permitido, retry_after):
+        retry_after é quanto falta, em segundos, para haver fichas.
+        """
+        buckets, lock = self._shard(key)
+        now = time.monotonic()
+
+        with lock:
+            tokens, updated, _ = buckets.get(key, (burst, now, 0))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            # Depois de full_at o balde está cheio de novo (igual a um novo)
+            full_at = now + (burst - tokens) / rate
+
+            if tokens >= cost:
+                buckets[key] = (tokens - cost, now, full_at + cost / rate)
+                allowed, retry_after = True, 0.0
+            else:
+                buckets[key] = (tokens, now, full_at)
+                allowed, retry_after = False, (cost - tokens) / rate
+
+            if len(buckets) > self.max_keys:
+                for stale in [k for k, (_, _, full) in buckets.items() if full <= now]:
+                    del buckets[stale]
+
+        return allowed, retry_after
+
+    def refund(self, key, rate, burst, cost=1.0):
+        """Devolve fichas tiradas por take() (requisição recusada por outro balde)."""
+        buckets, lock = self._shard(key)
+        now = time.monotonic()
+
+        with lock:
+            entry = buckets.get(key)
+            if entry is None:
+                return  # já descartado: o balde conta como cheio
+
+            tokens, updated, _ = entry
+            tokens = min(burst, tokens + (now - updated) * rate + cost)
+            buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+
+    def clear(self):
+        for buckets, lock in self._shards:
+            with lock:
+                buckets.clear()
+
+
+class RateLimiter:
+    def __init__(self, store=None, routes=ROUTE_LIMITS):
+        self.store = store or TokenBucketStore()
+        self.routes = routes
+        self._running = {route: 0 for route in routes}
+        self._running_lock = threading.Lock()
+
+    def check(self, route, ip, user_id):
+        """Retorna None (pode seguir) ou o Retry-After em segundos."""
+        waits = []
+        taken = []
+
+        for scope, rate, burst in self.routes[route]["limits"]:
+            if scope == "user":
+                if user_id is None:
+                    continue
+                key = f"{route[1]}:user:{user_id}"
+            else:
+                key = f"{route[1]}:ip:{ip}"
+
+            allowed, retry_after = self.store.take(key, rate, burst)
+            if allowed:
+                taken.append((key, rate, burst))
+            else:
+                waits.append(retry_after)
+
+        if not waits:
+            return None
+
+        # Recusada: não gasta o orçamento dos baldes que tinham deixado passar
+        for key, rate, burst in taken:
+            self.store.refund(key, rate, burst)
+
+        return max(waits)
+
+    def enter(self, route):
+        """Reserva uma vaga de execução da rota; False se estiver lotada."""
+        limit = self.routes[route].get("concurrency")
+        if not limit:
+            return True
+
+        with self._running_lock:
+            if self._running[route] >= limit:
+                return False
+            self._running[route] += 1
+            return True
+
+    def running(self):
+        with self._running_lock:
+            return dict(self._running)
+
+    def leave(self, route):
+        if not self.routes[route].get("concurrency"):
+            return
+
+        with self._running_lock:
+            self._running[route] -= 1
+
+
+limiter = RateLimiter()
+
+metrics.gauge("rate_limit_in_flight", "Requisições em execução nas rotas com limite", limiter.running, ("method", "route"))
+rate_limit_rejections = metrics.counter(
+    "rate_limit_rejections_total", "Requisições barradas pelo limitador (429 taxa, 503 lotada)", ("route", "status")
+)
+
+
+# ------------------------------------------------------
+# MIDDLEWARE
+# ------------------------------------------------------
+def _header(scope, name):
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _client_ip(scope):
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = _header(scope, b"x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def _user_id(scope):
+    # Só a assinatura do JWT (HMAC); o usuário em si a rota confere depois
+    authorization = _header(scope, b"authorization")
+    if not authorization or not authorization.startswith("Bearer "):
+        return None
+
+    try:
+        payload = jwt.decode(authorization[7:], SECRET_KEY, algorithms=[ALGORITHM])
+        return int(payload.get("sub"))
+    except (JWTError, TypeError, ValueError):
+        return None
+
+
+async def _reject(send, status, detail, retry_after):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    """
+    Middleware ASGI: aplica ROUTE_LIMITS antes de a rota rodar, então
+    requisições barradas não chegam a gastar argon2, SSH ou Mercado Pago.
+    Estouro de taxa = 429; rota lotada = 503. Ambos com Retry-After.
+    """
+
+    def __init__(self, app, limiter=limiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not RATE_LIMIT_ENABLED:
+            return await self.app(scope, receive, send)
+
+        route = (scope["method"], scope["path"].rstrip("/") or "/")
+        if route not in self.limiter.routes:
+            return await self.app(scope, receive, send)
+
+        retry_after = self.limiter.check(route, _client_ip(scope), _user_id(scope))
+        if retry_after is not None:
+            rate_limit_rejections.inc(route[1], "429")
+            return await _reject(send, 429, "Muitas requisições, tente novamente em instantes", retry_after)
+
+        if not self.limiter.enter(route):
+            rate_limit_rejections.inc(route[1], "503")
+            return await _reject(send, 503, "Servidor ocupado, tente novamente em instantes", 1)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.leave(route)
@@ -0,0 +1,233 @@
+import argparse
+import os
+from datetime import date, datetime, timedelta
+
+from .database import SessionLocal
+from .models import ProvisioningJob, Trial, VPNAccount, VPNServer
+from .ssh_connector import provision_users, revoke_users, server_target, ssh
+from .servers import ensure_default_server
+from .warm_pool import reserved_usernames
+
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "1000"))
+# Trava de segurança: não remove mais que esta fração dos usuários do servidor
+# numa só rodada (protege contra banco vazio/apontando para o lugar errado)
+RECONCILE_MAX_DELETE_RATIO = float(os.getenv("RECONCILE_MAX_DELETE_RATIO", "0.5"))
+# Usuário com senha definida há menos que isso (dias) não é removido: pode ser
+# um teste/conta cujo registro no banco ainda não foi gravado
+RECONCILE_NEW_USER_GRACE_DAYS = int(os.getenv("RECONCILE_NEW_USER_GRACE_DAYS", "1"))
+
+EPOCH = date(1970, 1, 1)
+
+# ------------------------------------------------------
+# RECONCILIAÇÃO SERVIDOR SSH <-> BANCO
+# ------------------------------------------------------
+# Puxa a lista de usuários (e expiração) do servidor em um único comando,
+# compara com as contas/testes ativos do banco usando conjuntos e aplica
+# o lote mínimo de criações, renovações e remoções.
+#
+# Uso manual:  python -m backend.reconcile [--dry-run]
+
+# Usuários gerenciados pelo sistema: criados com shell /bin/false e uid >= 1000.
+# Saída: "usuário<tab>expiração<tab>última troca de senha", em dias desde
+# 1970 (expiração vazia = sem expiração)
+HOST_USERS_SCRIPT = """\
+awk -F: 'NR==FNR { if ($7 == "/bin/false" && $3 >= 1000) managed[$1] = 1; next }
+         ($1 in managed) { print $1 "\\t" $8 "\\t" $3 }' <(getent passwd) <(getent shadow)
+"""
+
+
+# ------------------------------------------------------
+# ESTADO DO SERVIDOR E DO BANCO
+# ------------------------------------------------------
+def _days(value):
+    return EPOCH + timedelta(days=int(value)) if value.strip() else None
+
+
+def fetch_host_users(server=None):
+    """
+    ({username: date de expiração ou None}, {username: date da última troca
+    de senha ou None}) dos usuários gerenciados no servidor.
+    """
+    result = ssh.execute("bash -s", stdin_data=HOST_USERS_SCRIPT, **server_target(server))
+
+    if result.exit_status != 0:
+        raise RuntimeError(f"Falha ao listar usuários do servidor: {result.stderr.strip()}")
+
+    users = {}
+    changed = {}
+    for line in result.stdout.splitlines():
+        username, _, rest = line.partition("\t")
+        if not username:
+            continue
+        expire_days, _, changed_days = rest.partition("\t")
+        users[username] = _days(expire_days)
+        changed[username] = _days(changed_days)
+
+    return users, changed
+
+
+def in_flight_usernames(db):
+    """
+    Usuários de jobs de provisionamento abertos: já podem existir no
+    servidor (etapa ssh) sem a VPNAccount, que só vem na etapa account.
+    """
+    return {
+        username for (username,) in db.query(ProvisioningJob.username).filter(
+            ProvisioningJob.status.in_(("pending", "running")),
+            ProvisioningJob.username.isnot(None)
+        )
+    }
+
+
+def fetch_db_users(db, now, server_id):
+    """{username: (password, expires_at)} das contas e testes que devem existir no servidor."""
+    accounts = db.query(VPNAccount.username, VPNAccount.password, VPNAccount.expires_at).filter(
+        VPNAccount.server_id == server_id,
+        VPNAccount.active.is_(True),
+        VPNAccount.expires_at > now
+    ).all()
+
+    trials = db.query(Trial.ssh_user, Trial.ssh_pass, Trial.expires_at).filter(
+        Trial.server_id == server_id,
+        Trial.active.is_(True),
+        Trial.expires_at > now
+    ).all()
+
+    desired = {}
+    for username, password, expires_at in list(accounts) + list(trials):
+        desired[username] = (password, expires_at)
+
+    return desired
+
+
+# ------------------------------------------------------
+# DIFF
+# ------------------------------------------------------
+def plan_changes(host, desired):
+    """
+    Retorna (create, renew, delete) como conjuntos de usernames.
+    Expiração é comparada por data, com 1 dia de tolerância (fuso do servidor).
+    """
+    host_names = set(host)
+    desired_names = set(desired)
+
+    create = desired_names - host_names
+    delete = host_names - desired_names
+
+    renew = set()
+    for username in desired_names & host_names:
+        host_expire = host[username]
+        wanted = desired[username][1].date()
+        if host_expire is None or abs((host_expire - wanted).days) > 1:
+            renew.add(username)
+
+    return create, renew, delete
+
+
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def reconcile_server(server, desired, now, dry_run=False, protected=frozenset()):
+    """
+    `protected`: usuários sem registro no banco que não podem ser tocados
+    (reserva do warm_pool e jobs de provisionamento em andamento).
+    """
+    host, changed = fetch_host_users(server)
+    host = {u: e for u, e in host.items() if u not in protected}
+    create, renew, delete = plan_changes(host, desired)
+
+    # Recém-criados ficam para a próxima rodada: o commit do teste/conta
+    # pode ter chegado depois da leitura do banco
+    grace_limit = now.date() - timedelta(days=RECONCILE_NEW_USER_GRACE_DAYS)
+    recent = {u for u in delete if changed.get(u) and changed[u] >= grace_limit}
+    delete -= recent
+
+    summary = {
+        "server": server.name,
+        "host_users": len(host),
+        "protected": len(protected),
+        "db_users": len(desired),
+        "create": len(create),
+        "renew": len(renew),
+        "delete": len(delete),
+        "recent": len(recent),
+        "failed": [],
+        "dry_run": dry_run,
+    }
+
+    if host and len(delete) > len(host) * RECONCILE_MAX_DELETE_RATIO:
+        summary["failed"].append(
+            f"remoção abortada: {len(delete)} de {len(host)} usuários (limite {RECONCILE_MAX_DELETE_RATIO:.0%})"
+        )
+        delete = set()
+        summary["delete"] = 0
+
+    if dry_run:
+        return summary
+
+    # Criação e renovação usam o mesmo script idempotente
+    to_provision = []
+    for username in sorted(create | renew):
+        password, expires_at = desired[username]
+        days = (expires_at - now).total_seconds() / 86400
+        to_provision.append((username, password, days))
+
+    for batch in _chunks(to_provision, RECONCILE_BATCH_SIZE):
+        for result in provision_users(batch, server):
+            if not result["success"]:
+                summary["failed"].append(f"{result['username']}: {result['error']}")
+
+    for batch in _chunks(sorted(delete), RECONCILE_BATCH_SIZE):
+        for username, ok in revoke_users(batch, server).items():
+            if not ok:
+                summary["failed"].append(f"{username}: falha ao remover")
+
+    return summary
+
+
+def reconcile(dry_run=False):
+    """Reconcilia cada servidor ativo; retorna um resumo por servidor."""
+    db = SessionLocal()
+    now = datetime.utcnow()
+
+    try:
+        ensure_default_server(db)
+        servers = db.query(VPNServer).filter(VPNServer.enabled.is_(True)).all()
+        in_flight = in_flight_usernames(db)
+        plan = [
+            (server, fetch_db_users(db, now, server.id), reserved_usernames(db, server.id) | in_flight)
+            for server in servers
+        ]
+        db.expunge_all()
+    finally:
+        db.close()
+
+    summaries = []
+    for server, desired, protected in plan:
+        try:
+            summaries.append(reconcile_server(server, desired, now, dry_run, protected))
+        except Exception as e:
+            summaries.append({"server": server.name, "failed": [str(e)]})
+
+    return summaries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcilia usuários do servidor SSH com o banco.")
+    parser.add_argument("--dry-run", action="store_true", help="só mostra o que seria feito")
+    args = parser.parse_args()
+
+    for summary in reconcile(dry_run=args.dry_run):
+        for key, value in summary.items():
+            if key != "failed":
+                print(f"{key}: {value}")
+        for error in summary["failed"]:
+            print(f"ERRO {error}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,333 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
 from apscheduler.schedulers.background import BackgroundScheduler
-from sqlalchemy.orm import Session
-from database import SessionLocal
-from models import VPNAccount, User
-from email_sender import send_email
-from datetime import datetime
-from scheduler import start_scheduler
+from sqlalchemy.orm import Session, joinedload
+
+from .database import SessionLocal
+from .models import Payment, Trial, VPNAccount
+from .email_sender import send_email
+from .ssh_connector import revoke_users
+from .reconcile import reconcile
+from .servers import get_server, refresh_servers
+from .login_log import rollup_login_logs
+from .mercadopago_client import MercadoPagoError, mp
+from .payment_events import FINAL_STATUSES, payment_events
+from .provisioning import enqueue_payment, recover_provisioning_jobs
+from .metrics import timed_job
+from .tracing import start_trace
+
+SCAN_CHUNK_SIZE = int(os.getenv("SCAN_CHUNK_SIZE", "500"))
+SWEEP_INTERVAL_MINUTES = int(os.getenv("SWEEP_INTERVAL_MINUTES", "60"))
+SWEEP_GRACE_HOURS = float(os.getenv("SWEEP_GRACE_HOURS", "0"))  # tolerância após expirar
+RECONCILE_INTERVAL_MINUTES = int(os.getenv("RECONCILE_INTERVAL_MINUTES", "360"))
+SERVER_CHECK_INTERVAL_MINUTES = int(os.getenv("SERVER_CHECK_INTERVAL_MINUTES", "5"))
+STALE_JOB_CHECK_INTERVAL_MINUTES = int(os.getenv("STALE_JOB_CHECK_INTERVAL_MINUTES", "1"))
+PENDING_CHECK_INTERVAL_MINUTES = int(os.getenv("PENDING_CHECK_INTERVAL_MINUTES", "10"))
+PENDING_MIN_AGE_MINUTES = int(os.getenv("PENDING_MIN_AGE_MINUTES", "5"))
+PENDING_EXPIRE_HOURS = float(os.getenv("PENDING_EXPIRE_HOURS", "24"))  # validade do PIX
+MP_SEARCH_PAGE_SIZE = int(os.getenv("MP_SEARCH_PAGE_SIZE", "100"))
+MP_SEARCH_CONCURRENCY = int(os.getenv("MP_SEARCH_CONCURRENCY", "4"))
+
+# ------------------------------------------------------
+# AVISOS DE EXPIRAÇÃO
+# ------------------------------------------------------
+# Cada aviso tem um nível (gravado em VPNAccount.notified_expire) e uma
+# janela de expires_at. A conta só entra na busca se ainda não recebeu
+# aquele aviso, então cada execução custa O(contas vencendo).
+NOTICE_3_DAYS = 1
+NOTICE_1_DAY = 2
+NOTICE_EXPIRED = 3
+
+
+def _notice_3_days(user, acc):
+    send_email(
+        user.email,
+        "Sua VPN expira em 3 dias",
+        f"Olá {user.name}, sua VPN ({acc.username}) expira no dia {acc.expires_at:%d/%m/%Y}. Renove para evitar interrupções."
+    )
+
+
+def _notice_1_day(user, acc):
+    send_email(
+        user.email,
+        "Sua VPN expira amanhã",
+        f"Olá {user.name}, sua VPN ({acc.username}) expira amanhã ({acc.expires_at:%d/%m/%Y}). Recomendamos renovar hoje."
+    )
+
+
+def _notice_expired(user, acc):
+    send_email(
+        user.email,
+        "Sua VPN expirou",
+        f"Olá {user.name}, sua VPN ({acc.username}) expirou. Faça a renovação para continuar utilizando."
+    )
+
+
+def _notice_windows(now):
+    """(nível, início, fim, envio) — janelas de expires_at por aviso."""
+    return [
+        (NOTICE_EXPIRED, None, now, _notice_expired),
+        (NOTICE_1_DAY, now, now + timedelta(days=1), _notice_1_day),
+        (NOTICE_3_DAYS, now + timedelta(days=1), now + timedelta(days=3), _notice_3_days),
+    ]
+
+
+def _due_accounts(db, level, start, end, after_id):
+    query = db.query(VPNAccount).options(joinedload(VPNAccount.owner)).filter(
+        VPNAccount.notified_expire.in_(range(level)),
+        VPNAccount.expires_at <= end,
+        VPNAccount.id > after_id
+    )
+
+    if start is not None:
+        query = query.filter(VPNAccount.expires_at > start)
+
+    return query.order_by(VPNAccount.id).limit(SCAN_CHUNK_SIZE).all()
+
 
 def check_expirations():
     db: Session = SessionLocal()
-    now = datetime.now()
+    now = datetime.utcnow()
+    sent = 0
+
+    try:
+        for level, start, end, notify in _notice_windows(now):
+            last_id = 0
+
+            # Paginação por chave (id > último id) em lotes de SCAN_CHUNK_SIZE
+            while True:
+                accounts = _due_accounts(db, level, start, end, last_id)
+                if not accounts:
+                    break
+
+                for acc in accounts:
+                    if acc.owner:
+                        notify(acc.owner, acc)
+                        sent += 1
+
+                    # Marca mesmo sem dono para não voltar na próxima busca
+                    acc.notified_expire = level
+
+                db.commit()
+                last_id = accounts[-1].id
+    finally:
+        db.close()
+
+    return sent
+
+
+# ------------------------------------------------------
+# REVOGAÇÃO DE CONTAS EXPIRADAS
+# ------------------------------------------------------
+def sweep_expired():
+    """
+    Remove dos servidores SSH as contas e testes expirados (um comando em
+    lote por servidor) e marca como inativos no banco os que foram removidos.
+    """
+    db: Session = SessionLocal()
+    limit = datetime.utcnow() - timedelta(hours=SWEEP_GRACE_HOURS)
+
+    try:
+        accounts = db.query(VPNAccount).filter(
+            VPNAccount.active.is_(True),
+            VPNAccount.expires_at <= limit
+        ).all()
+
+        trials = db.query(Trial).filter(
+            Trial.active.is_(True),
+            Trial.expires_at <= limit
+        ).all()
+
+        # Um comando de revogação por servidor
+        by_server = {}
+        for acc in accounts:
+            by_server.setdefault(acc.server_id, set()).add(acc.username)
+        for trial in trials:
+            by_server.setdefault(trial.server_id, set()).add(trial.ssh_user)
+
+        if not by_server:
+            return 0
+
+        revoked = {}
+        for server_id, usernames in by_server.items():
+            try:
+                result = revoke_users(sorted(usernames), get_server(db, server_id))
+            except Exception as e:
+                print(f"Falha ao revogar usuários no servidor {server_id}: {e}")
+                continue
+
+            for username, ok in result.items():
+                revoked[(server_id, username)] = ok
+
+        for acc in accounts:
+            if revoked.get((acc.server_id, acc.username)):
+                acc.active = False
+
+        for trial in trials:
+            if revoked.get((trial.server_id, trial.ssh_user)):
+                trial.active = False
+
+        db.commit()
+
+        failed = [u for (_, u), ok in revoked.items() if not ok]
+        if failed:
+            print(f"Falha ao revogar usuários SSH: {', '.join(failed)}")
+
+        return len(revoked) - len(failed)
+    finally:
+        db.close()
+
+
+# ------------------------------------------------------
+# PAGAMENTOS PENDENTES (WEBHOOK PERDIDO)
+# ------------------------------------------------------
+# Em vez de um GET por pagamento, uma busca paginada no MP por data de
+# criação cobre todos os pendentes de uma vez; as páginas seguintes são
+# pedidas em paralelo (no máximo MP_SEARCH_CONCURRENCY) e 429/Retry-After
+# ficam com o cliente do MP.
+PENDING_STATUSES = ("pending", "in_process")
+
+
+def _search_payment_statuses(begin, end):
+    """{mp_payment_id: status} dos pagamentos criados entre begin e end (UTC)."""
+    params = {
+        "range": "date_created",
+        "begin_date": f"{begin:%Y-%m-%dT%H:%M:%S}.000Z",
+        "end_date": f"{end:%Y-%m-%dT%H:%M:%S}.000Z",
+        "sort": "date_created",
+        "criteria": "asc",
+        "limit": MP_SEARCH_PAGE_SIZE,
+        "offset": 0,
+    }
+
+    first = mp.search_payments_sync(params)
+    pages = [first]
+
+    total = (first.get("paging") or {}).get("total", 0)
+    offsets = range(MP_SEARCH_PAGE_SIZE, total, MP_SEARCH_PAGE_SIZE)
+
+    if offsets:
+        with ThreadPoolExecutor(max_workers=MP_SEARCH_CONCURRENCY) as pool:
+            pages.extend(pool.map(lambda offset: mp.search_payments_sync({**params, "offset": offset}), offsets))
+
+    return {
+        str(payment["id"]): payment.get("status")
+        for page in pages
+        for payment in page.get("results", [])
+    }
+
+
+def reconcile_pending_payments():
+    """
+    Confere no MP os pagamentos parados em "pending" (pelo índice
+    status/created_at). Aprovados vão para a fila de provisionamento,
+    recusados/cancelados ficam com o status do MP e os mais velhos que
+    a validade do PIX viram "expired".
+    """
+    db: Session = SessionLocal()
+    now = datetime.utcnow()
+    summary = {"checked": 0, "approved": 0, "closed": 0, "expired": 0}
+
+    try:
+        # Recentes ficam de fora: o webhook ainda deve chegar
+        pending = db.query(Payment.mp_payment_id, Payment.created_at).filter(
+            Payment.status.in_(PENDING_STATUSES),
+            Payment.created_at <= (now - timedelta(minutes=PENDING_MIN_AGE_MINUTES)).isoformat()
+        ).order_by(Payment.created_at).all()
+
+        if not pending:
+            return summary
+
+        begin = datetime.fromisoformat(pending[0].created_at) - timedelta(minutes=5)
+
+        try:
+            statuses = _search_payment_statuses(begin, now)
+        except MercadoPagoError as e:
+            # Sem resposta do MP não dá para expirar nada com segurança
+            print(f"Erro ao consultar pagamentos pendentes no Mercado Pago: {e}")
+            return summary
+
+        summary["checked"] = len(pending)
+        expire_before = (now - timedelta(hours=PENDING_EXPIRE_HOURS)).isoformat()
 
-    accounts = db.query(VPNAccount).all()
+        approved, closed, expired = [], {}, []
+        for mp_payment_id, created_at in pending:
+            status = statuses.get(mp_payment_id)
 
-    for acc in accounts:
-        expires = datetime.fromisoformat(acc.expires_at)
+            if status == "approved":
+                approved.append(mp_payment_id)
+            elif status in FINAL_STATUSES:
+                closed[mp_payment_id] = status
+            elif created_at < expire_before:
+                expired.append(mp_payment_id)
 
-        days_left = (expires - now).days
+        # Mesmo caminho do webhook: o job confere no MP e faz o compare-and-set.
+        # Aprovação achada aqui (webhook perdido) também ganha um trace
+        for mp_payment_id in approved:
+            with start_trace("reconcile_pending_payment", mp_payment_id=mp_payment_id):
+                enqueue_payment(db, mp_payment_id)
 
-        user = db.query(User).filter(User.id == acc.owner_id).first()
+        for mp_payment_id, status in closed.items():
+            summary["closed"] += db.query(Payment).filter(
+                Payment.mp_payment_id == mp_payment_id,
+                Payment.status.in_(PENDING_STATUSES)
+            ).update({"status": status}, synchronize_session=False)
 
-        if not user:
-            continue
+        for i in range(0, len(expired), SCAN_CHUNK_SIZE):
+            summary["expired"] += db.query(Payment).filter(
+                Payment.mp_payment_id.in_(expired[i:i + SCAN_CHUNK_SIZE]),
+                Payment.status.in_(PENDING_STATUSES)
+            ).update({"status": "expired"}, synchronize_session=False)
 
-        # Notificar 3 dias antes
-        if days_left == 3:
-            send_email(
-                user.email,
-                "Sua VPN expira em 3 dias",
-                f"Olá {user.name}, sua VPN ({acc.username}) expira no dia {expires}. Renove para evitar interrupções."
-            )
+        db.commit()
+        summary["approved"] = len(approved)
 
-        # Notificar 1 dia
-        elif days_left == 1:
-            send_email(
-                user.email,
-                "Sua VPN expira amanhã",
-                f"Olá {user.name}, sua VPN ({acc.username}) expira amanhã ({expires}). Recomendamos renovar hoje."
-            )
+        for mp_payment_id, status in closed.items():
+            payment_events.publish(mp_payment_id, status)
+        for mp_payment_id in expired:
+            payment_events.publish(mp_payment_id, "expired")
 
-        # Notificar expiração
-        elif days_left <= 0:
-            send_email(
-                user.email,
-                "Sua VPN expirou",
-                f"Olá {user.name}, sua VPN ({acc.username}) expirou. Faça a renovação para continuar utilizando."
-            )
+        return summary
+    finally:
+        db.close()
 
-    db.close()
+
+# ------------------------------------------------------
+# RECONCILIAÇÃO SERVIDOR <-> BANCO
+# ------------------------------------------------------
+def reconcile_hosts():
+    summaries = reconcile()
+
+    for summary in summaries:
+        for error in summary["failed"]:
+            print(f"Reconciliação ({summary['server']}): {error}")
+
+    return summaries
+
+
+# ------------------------------------------------------
+# AGENDADOR
+# ------------------------------------------------------
+scheduler = BackgroundScheduler()
 
 
 def start_scheduler():
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(check_expirations, "interval", hours=12)  # roda a cada 12h
-    scheduler.start()
+    if scheduler.running:
+        return
 
+    # timed_job: duração e resultado de cada execução em /metrics
+    scheduler.add_job(timed_job(check_expirations), "interval", hours=12)  # roda a cada 12h
+    scheduler.add_job(timed_job(sweep_expired), "interval", minutes=SWEEP_INTERVAL_MINUTES)
+    scheduler.add_job(timed_job(reconcile_hosts), "interval", minutes=RECONCILE_INTERVAL_MINUTES)
+    scheduler.add_job(timed_job(refresh_servers), "interval", minutes=SERVER_CHECK_INTERVAL_MINUTES)
+    scheduler.add_job(timed_job(rollup_login_logs), "interval", hours=24)
+    scheduler.add_job(timed_job(reconcile_pending_payments), "interval", minutes=PENDING_CHECK_INTERVAL_MINUTES)
+    scheduler.add_job(timed_job(recover_provisioning_jobs), "interval", minutes=STALE_JOB_CHECK_INTERVAL_MINUTES)
+    scheduler.start()
 
 
-@app.on_event("startup")
-def start():
-    start_scheduler()
+def stop_scheduler():
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
@@ -0,0 +1,161 @@
+import os
+from datetime import datetime
+
+from sqlalchemy import func
+
+from .database import SessionLocal
+from .models import Trial, VPNAccount, VPNServer
+from .ssh_connector import SSH_HOST, SSH_PORT, server_target, ssh
+from .ehi_generator import EHI_HOST, EHI_PROXY_IP, EHI_PROXY_PORT
+
+SERVER_DEFAULT_CAPACITY = int(os.getenv("SERVER_DEFAULT_CAPACITY", "500"))
+HEALTH_CHECK_TIMEOUT = int(os.getenv("SERVER_HEALTH_CHECK_TIMEOUT", "10"))
+
+
+class NoServerAvailable(Exception):
+    """Todos os servidores estão cheios, fora do ar ou desativados."""
+
+
+# ------------------------------------------------------
+# SERVIDOR PADRÃO
+# ------------------------------------------------------
+def ensure_default_server(db):
+    """
+    Sem nenhum VPNServer cadastrado, cria o "principal" a partir da
+    configuração antiga (SSH_HOST / EHI_HOST) e atribui a ele as contas
+    e testes que ainda não têm servidor.
+    """
+    server = db.query(VPNServer).order_by(VPNServer.id).first()
+
+    if server is None:
+        # Instalação antiga: todas as contas ativas já estão neste servidor.
+        # Capacidade com folga sobre elas, senão o refresh_servers (que
+        # recalcula user_count) deixaria o servidor "cheio" e sem vagas
+        active = (
+            db.query(func.count(VPNAccount.id)).filter(VPNAccount.active.is_(True)).scalar()
+            + db.query(func.count(Trial.id)).filter(Trial.active.is_(True)).scalar()
+        )
+
+        server = VPNServer(
+            name="principal",
+            host=SSH_HOST,
+            port=SSH_PORT,
+            public_host=EHI_HOST,
+            proxy_ip=EHI_PROXY_IP,
+            proxy_port=EHI_PROXY_PORT,
+            capacity=max(SERVER_DEFAULT_CAPACITY, active * 2),
+            user_count=active
+        )
+        db.add(server)
+        db.flush()
+
+    db.query(VPNAccount).filter(VPNAccount.server_id.is_(None)).update(
+        {"server_id": server.id}, synchronize_session=False
+    )
+    db.query(Trial).filter(Trial.server_id.is_(None)).update(
+        {"server_id": server.id}, synchronize_session=False
+    )
+    db.commit()
+
+    return server
+
+
+# ------------------------------------------------------
+# ALOCAÇÃO (MENOS CARREGADO PRIMEIRO)
+# ------------------------------------------------------
+def pick_server(db, region=None):
+    """
+    Reserva uma vaga no servidor saudável com menor ocupação
+    (user_count / capacity) e retorna o VPNServer.
+    O incremento é condicional, então duas alocações simultâneas
+    não estouram a capacidade.
+    """
+    query = db.query(VPNServer).filter(
+        VPNServer.enabled.is_(True),
+        VPNServer.healthy.is_(True),
+        VPNServer.user_count < VPNServer.capacity
+    )
+
+    if region:
+        query = query.filter(VPNServer.region == region)
+
+    candidates = query.order_by(
+        (VPNServer.user_count * 1.0 / VPNServer.capacity),
+        VPNServer.id
+    ).all()
+
+    for server in candidates:
+        reserved = db.query(VPNServer).filter(
+            VPNServer.id == server.id,
+            VPNServer.user_count < VPNServer.capacity
+        ).update({"user_count": VPNServer.user_count + 1}, synchronize_session=False)
+        db.commit()
+
+        if reserved:
+            db.refresh(server)
+            return server
+
+    raise NoServerAvailable("Nenhum servidor VPN disponível")
+
+
+def release_server(db, server_id):
+    """Devolve a vaga reservada (provisionamento falhou ou conta revogada)."""
+    if server_id is None:
+        return
+
+    db.query(VPNServer).filter(
+        VPNServer.id == server_id,
+        VPNServer.user_count > 0
+    ).update({"user_count": VPNServer.user_count - 1}, synchronize_session=False)
+    db.commit()
+
+
+def get_server(db, server_id):
+    if server_id is None:
+        return None
+    return db.query(VPNServer).filter(VPNServer.id == server_id).first()
+
+
+# ------------------------------------------------------
+# CONTAGEM E SAÚDE
+# ------------------------------------------------------
+def refresh_servers():
+    """
+    Recalcula user_count a partir das contas ativas (corrige desvios das
+    reservas) e testa a conexão SSH de cada servidor.
+    """
+    db = SessionLocal()
+    now = datetime.utcnow()
+
+    try:
+        counts = dict(
+            db.query(VPNAccount.server_id, func.count(VPNAccount.id))
+            .filter(VPNAccount.active.is_(True))
+            .group_by(VPNAccount.server_id)
+            .all()
+        )
+
+        trial_counts = (
+            db.query(Trial.server_id, func.count(Trial.id))
+            .filter(Trial.active.is_(True))
+            .group_by(Trial.server_id)
+            .all()
+        )
+        for server_id, count in trial_counts:
+            counts[server_id] = counts.get(server_id, 0) + count
+
+        for server in db.query(VPNServer).filter(VPNServer.enabled.is_(True)).all():
+            server.user_count = counts.get(server.id, 0)
+
+            try:
+                result = ssh.execute("true", timeout=HEALTH_CHECK_TIMEOUT, **server_target(server))
+                server.healthy = result.exit_status == 0
+            except Exception as e:
+                print(f"Servidor {server.name} fora do ar: {e}")
+                server.healthy = False
+
+            server.last_check_at = now
+
+        db.commit()
+    finally:
+        db.close()
@@ -1,67 +1,481 @@
-import paramiko
+import os
+import re
+import shlex
+import socket
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-SSH_HOST = "192.99.110.188"
-SSH_USER = "root"
-SSH_PASS = "SUA_SENHA_AQUI"
+import paramiko
+
+from .metrics import ssh_command_seconds, ssh_connect_seconds, ssh_errors
+from .tracing import KIND_CLIENT, record_span, span
 
-def create_ssh_user(username, password, days):
-    try:
+SSH_HOST = os.getenv("SSH_HOST", "192.99.110.188")
+SSH_PORT = int(os.getenv("SSH_PORT", "22"))
+SSH_USER = os.getenv("SSH_USER", "root")
+SSH_PASS = os.getenv("SSH_PASS", "SUA_SENHA_AQUI")
+
+# ------------------------------------------------------
+# POOL CONFIG
+# ------------------------------------------------------
+SSH_POOL_SIZE = int(os.getenv("SSH_POOL_SIZE", "4"))            # conexões por host
+SSH_KEEPALIVE = int(os.getenv("SSH_KEEPALIVE", "30"))           # segundos
+SSH_IDLE_TIMEOUT = int(os.getenv("SSH_IDLE_TIMEOUT", "300"))    # segundos
+SSH_CONNECT_TIMEOUT = int(os.getenv("SSH_CONNECT_TIMEOUT", "10"))
+SSH_COMMAND_TIMEOUT = int(os.getenv("SSH_COMMAND_TIMEOUT", "60"))
+
+# Erros que indicam conexão quebrada (vale reconectar e tentar de novo)
+CONNECTION_ERRORS = (paramiko.SSHException, EOFError, socket.error)
+
+CommandResult = namedtuple("CommandResult", ["exit_status", "stdout", "stderr"])
+
+
+class SSHConnectionPool:
+    """
+    Pool de conexões SSH autenticadas, por host.
+    Mantém até `max_size` transports vivos por host (keepalive ativo),
+    descarta conexões ociosas ou mortas e reconecta quando necessário.
+    """
+
+    def __init__(
+        self,
+        max_size=SSH_POOL_SIZE,
+        keepalive=SSH_KEEPALIVE,
+        idle_timeout=SSH_IDLE_TIMEOUT,
+        connect_timeout=SSH_CONNECT_TIMEOUT,
+    ):
+        self.max_size = max_size
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+
+        self._lock = threading.Lock()
+        self._idle = {}    # key -> [(client, last_used)]
+        self._slots = {}   # key -> BoundedSemaphore(max_size)
+
+    # --------------------------------------------------
+    # Internos
+    # --------------------------------------------------
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_size)
+            return self._slots[key]
+
+    def _connect(self, host, port, username, password):
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(SSH_HOST, username=SSH_USER, password=SSH_PASS)
+        started = time.perf_counter()
+        try:
+            client.connect(
+                host,
+                port=port,
+                username=username,
+                password=password,
+                timeout=self.connect_timeout,
+                banner_timeout=self.connect_timeout,
+                auth_timeout=self.connect_timeout,
+                look_for_keys=False,
+                allow_agent=False,
+            )
+        except Exception:
+            ssh_errors.inc("connect")
+            raise
+        elapsed = time.perf_counter() - started
+        ssh_connect_seconds.observe(elapsed, host)
+        record_span("ssh.connect", elapsed, KIND_CLIENT, host=host)
+
+        client.get_transport().set_keepalive(self.keepalive)
+        return client
+
+    @staticmethod
+    def _close(client):
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, client, last_used):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+
+        # Conexão parada há mais tempo que o keepalive: testa antes de usar
+        if time.monotonic() - last_used > self.keepalive:
+            try:
+                transport.send_ignore()
+            except Exception:
+                return False
+
+        return True
+
+    def _evict_idle(self, key=None):
+        now = time.monotonic()
+        expired = []
+
+        with self._lock:
+            keys = [key] if key is not None else list(self._idle)
+            for k in keys:
+                alive = []
+                for client, last_used in self._idle.get(k, []):
+                    if now - last_used > self.idle_timeout:
+                        expired.append(client)
+                    else:
+                        alive.append((client, last_used))
+                self._idle[k] = alive
+
+        for client in expired:
+            self._close(client)
+
+    # --------------------------------------------------
+    # API
+    # --------------------------------------------------
+    def acquire(self, host, port, username, password):
+        key = (host, port, username)
+        self._slot(key).acquire()
+
+        try:
+            self._evict_idle(key)
+
+            while True:
+                with self._lock:
+                    idle = self._idle.get(key)
+                    entry = idle.pop() if idle else None
+
+                if entry is None:
+                    return self._connect(host, port, username, password)
+
+                client, last_used = entry
+                if self._is_healthy(client, last_used):
+                    return client
+
+                self._close(client)
+
+        except Exception:
+            self._slot(key).release()
+            raise
+
+    def release(self, host, port, username, client, broken=False):
+        key = (host, port, username)
+
+        if broken:
+            self._close(client)
+        else:
+            with self._lock:
+                self._idle.setdefault(key, []).append((client, time.monotonic()))
+
+        self._slot(key).release()
+
+    @contextmanager
+    def connection(self, host=None, port=None, username=None, password=None):
+        host = host or SSH_HOST
+        port = port or SSH_PORT
+        username = username or SSH_USER
+        password = password if password is not None else SSH_PASS
+
+        client = self.acquire(host, port, username, password)
+        broken = False
+        try:
+            yield client
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.release(host, port, username, client, broken=broken)
+
+    def execute(self, command, stdin_data=None, timeout=SSH_COMMAND_TIMEOUT, **target):
+        """
+        Executa um comando numa conexão do pool.
+        Se a conexão estiver quebrada, reconecta e tenta mais uma vez.
+        """
+        for attempt in range(2):
+            try:
+                with self.connection(**target) as client:
+                    return run_command(client, command, stdin_data, timeout)
+            except CONNECTION_ERRORS:
+                ssh_errors.inc("command")
+                if attempt == 1:
+                    raise
+
+    def close_idle(self):
+        """Fecha conexões ociosas além do idle_timeout."""
+        self._evict_idle()
+
+    def close_all(self):
+        with self._lock:
+            entries = [c for idle in self._idle.values() for c, _ in idle]
+            self._idle.clear()
+
+        for client in entries:
+            self._close(client)
+
+
+def run_command(client, command, stdin_data=None, timeout=SSH_COMMAND_TIMEOUT):
+    started = time.perf_counter()
+    stdin, stdout, stderr = client.exec_command(command, timeout=timeout)
+
+    if stdin_data is not None:
+        stdin.write(stdin_data)
+        stdin.channel.shutdown_write()
+
+    out = stdout.read().decode()
+    err = stderr.read().decode()
+    status = stdout.channel.recv_exit_status()
+
+    # Rótulo = programa ("bash" para os scripts em lote, "chage"...)
+    program = command.split(None, 1)[0]
+    elapsed = time.perf_counter() - started
+    ssh_command_seconds.observe(elapsed, program)
+    record_span("ssh.command", elapsed, KIND_CLIENT, command=program, exit_status=status)
+
+    return CommandResult(status, out, err)
+
+
+# Executor compartilhado por todo o backend
+ssh = SSHConnectionPool()
+
+
+def server_target(server=None):
+    """
+    Parâmetros de conexão de um VPNServer (host/porta/credenciais).
+    Sem servidor, ou campos vazios, usa o servidor padrão (SSH_HOST...).
+    """
+    if server is None:
+        return {}
+
+    return {
+        "host": server.host,
+        "port": server.port,
+        "username": server.ssh_user,
+        "password": server.ssh_password,
+    }
+
+
+# ------------------------------------------------------
+# PROVISIONAMENTO EM LOTE (UM ÚNICO ROUND TRIP)
+# ------------------------------------------------------
+USERNAME_RE = re.compile(r"^[a-z_][a-z0-9_-]{0,31}$")
+
+# Função shell idempotente: cria o usuário se não existir,
+# define a senha (lida do stdin via heredoc) e a expiração.
+PROVISION_SCRIPT_HEADER = """\
+provision() {
+    u="$1"; exp="$2"
+    id -u "$u" >/dev/null 2>&1 || useradd -M -s /bin/false "$u" || { printf 'ERR\\t%s\\tuseradd\\n' "$u"; return; }
+    chpasswd || { printf 'ERR\\t%s\\tchpasswd\\n' "$u"; return; }
+    chage -E "$exp" "$u" || { printf 'ERR\\t%s\\tchage\\n' "$u"; return; }
+    printf 'OK\\t%s\\t%s\\n' "$u" "$exp"
+}
+"""
+
+
+def build_provision_script(users):
+    """
+    Monta o script de provisionamento para [(username, password, days), ...].
+    As senhas vão no corpo do script (stdin do bash), nunca na linha de comando.
+    """
+    lines = [PROVISION_SCRIPT_HEADER]
+
+    for username, password, days in users:
+        if not USERNAME_RE.match(username):
+            raise ValueError(f"Usuário SSH inválido: {username!r}")
+        if "\n" in password or "\r" in password:
+            raise ValueError(f"Senha inválida para {username}")
 
-        # data de expiração
         expire_date = (datetime.now() + timedelta(days=days)).strftime("%Y-%m-%d")
 
-        # comandos do SSH PLUS PRO
-        commands = [
-            f"useradd -M -s /bin/false {username}",
-            f"echo '{password}\n{password}' | passwd {username}",
-            f"chage -E {expire_date} {username}"
-        ]
+        lines.append(f"provision {username} {expire_date} <<'__MVPN_PW__'")
+        lines.append(f"{username}:{password}")
+        lines.append("__MVPN_PW__")
+
+    return "\n".join(lines) + "\n"
+
+
+def _parse_script_output(output):
+    """Linhas "OK|ERR<tab>usuário<tab>detalhe" -> {usuário: [status, usuário, detalhe]}."""
+    parsed = {}
+    for line in output.splitlines():
+        parts = line.split("\t")
+        if len(parts) == 3 and parts[0] in ("OK", "ERR"):
+            parsed[parts[1]] = parts
+    return parsed
+
+
+def parse_provision_output(users, output):
+    """Converte a saída OK/ERR do script em um resultado por usuário."""
+    parsed = _parse_script_output(output)
+
+    results = []
+    for username, _password, _days in users:
+        parts = parsed.get(username)
+
+        if parts is None:
+            results.append({"username": username, "success": False, "error": "sem resposta do servidor"})
+        elif parts[0] == "OK":
+            results.append({"username": username, "success": True, "expires": parts[2]})
+        else:
+            results.append({"username": username, "success": False, "error": f"falha em {parts[2]}"})
+
+    return results
+
+
+def provision_users(users, server=None):
+    """
+    Cria/atualiza vários usuários SSH com um único comando remoto.
+    Recebe [(username, password, days), ...] e devolve um resultado por usuário,
+    na mesma ordem. Rodar de novo com os mesmos dados é seguro (idempotente).
+    """
+    users = list(users)
+    if not users:
+        return []
 
-        output = ""
-        for cmd in commands:
-            stdin, stdout, stderr = client.exec_command(cmd)
-            output += stdout.read().decode() + stderr.read().decode()
+    with span("ssh.provision_users", users=len(users), server=getattr(server, "name", None)) as provision_span:
+        script = build_provision_script(users)
+        result = ssh.execute("bash -s", stdin_data=script, **server_target(server))
+        results = parse_provision_output(users, result.stdout)
+        provision_span.set(failed=sum(1 for r in results if not r["success"]))
 
-        client.close()
-        return {"success": True, "log": output}
+    return results
+
+
+# ------------------------------------------------------
+# RESERVA DE CONTAS (WARM POOL)
+# ------------------------------------------------------
+# Cria o usuário já travado: senha bloqueada (usermod -L) e conta
+# expirada (chage -E 0). Nome que já existe no servidor é recusado,
+# nunca reaproveitado, para não tomar a conta de um cliente.
+RESERVE_SCRIPT_HEADER = """\
+reserve() {
+    u="$1"
+    id -u "$u" >/dev/null 2>&1 && { printf 'ERR\\t%s\\texists\\n' "$u"; return; }
+    useradd -M -s /bin/false "$u" || { printf 'ERR\\t%s\\tuseradd\\n' "$u"; return; }
+    chpasswd || { printf 'ERR\\t%s\\tchpasswd\\n' "$u"; return; }
+    usermod -L "$u" && chage -E 0 "$u" || { printf 'ERR\\t%s\\tlock\\n' "$u"; return; }
+    printf 'OK\\t%s\\tlocked\\n' "$u"
+}
+"""
+
+
+def reserve_users(users, server=None):
+    """
+    Cria vários usuários travados com um único comando remoto.
+    Recebe [(username, password), ...] e retorna {username: True/False}.
+    """
+    users = list(users)
+    if not users:
+        return {}
+
+    lines = [RESERVE_SCRIPT_HEADER]
+    for username, password in users:
+        if not USERNAME_RE.match(username):
+            raise ValueError(f"Usuário SSH inválido: {username!r}")
+        if "\n" in password or "\r" in password:
+            raise ValueError(f"Senha inválida para {username}")
+
+        lines.append(f"reserve {username} <<'__MVPN_PW__'")
+        lines.append(f"{username}:{password}")
+        lines.append("__MVPN_PW__")
+
+    result = ssh.execute("bash -s", stdin_data="\n".join(lines) + "\n", **server_target(server))
+    parsed = _parse_script_output(result.stdout)
+
+    return {u: parsed.get(u, ["ERR"])[0] == "OK" for u, _password in users}
+
+
+def build_activate_command(username, days):
+    if not USERNAME_RE.match(username):
+        raise ValueError(f"Usuário SSH inválido: {username!r}")
+
+    expire_date = (datetime.now() + timedelta(days=days)).strftime("%Y-%m-%d")
+    return f"usermod -U {username} && chage -E {expire_date} {username}", expire_date
+
+
+def activate_user(username, days, server=None):
+    """Destrava um usuário reservado e define a expiração (um só comando)."""
+    try:
+        command, expire_date = build_activate_command(username, days)
+        result = ssh.execute(command, **server_target(server))
+
+        if result.exit_status != 0:
+            return {"success": False, "error": result.stderr.strip() or f"exit {result.exit_status}"}
+
+        return {"success": True, "expires": expire_date}
 
     except Exception as e:
         return {"success": False, "error": str(e)}
 
-def delete_ssh_user(username):
+
+# ------------------------------------------------------
+# REVOGAÇÃO EM LOTE
+# ------------------------------------------------------
+# Derruba as sessões e remove o usuário. Usuário que já não existe
+# conta como revogado, então o lote pode ser repetido sem erro.
+REVOKE_SCRIPT_HEADER = """\
+revoke() {
+    u="$1"
+    id -u "$u" >/dev/null 2>&1 || { printf 'OK\\t%s\\tabsent\\n' "$u"; return; }
+    pkill -KILL -u "$u" 2>/dev/null
+    userdel -f "$u" || { printf 'ERR\\t%s\\tuserdel\\n' "$u"; return; }
+    printf 'OK\\t%s\\tdeleted\\n' "$u"
+}
+"""
+
+
+def revoke_users(usernames, server=None):
+    """
+    Remove vários usuários SSH com um único comando remoto.
+    Retorna {username: True/False} (True = não existe mais no servidor).
+    """
+    usernames = list(usernames)
+    if not usernames:
+        return {}
+
+    lines = [REVOKE_SCRIPT_HEADER]
+    for username in usernames:
+        if not USERNAME_RE.match(username):
+            raise ValueError(f"Usuário SSH inválido: {username!r}")
+        lines.append(f"revoke {username}")
+
+    result = ssh.execute("bash -s", stdin_data="\n".join(lines) + "\n", **server_target(server))
+    parsed = _parse_script_output(result.stdout)
+
+    return {u: parsed.get(u, ["ERR"])[0] == "OK" for u in usernames}
+
+
+# ------------------------------------------------------
+# USUÁRIOS SSH
+# ------------------------------------------------------
+def create_ssh_user(username, password, days, server=None):
+    with span("create_ssh_user", username=username, days=days):
+        return _create_ssh_user(username, password, days, server)
+
+def _create_ssh_user(username, password, days, server=None):
     try:
-        command = f"userdel -rf {username}"
-        result = ssh.execute(command)
-        return {"status": "deleted", "output": result}
+        result = provision_users([(username, password, days)], server)[0]
+
+        if not result["success"]:
+            return {"success": False, "error": result["error"]}
+
+        return {"success": True, "log": f"{username} expira em {result['expires']}"}
+
     except Exception as e:
-        return {"error": str(e)}
+        return {"success": False, "error": str(e)}
 
-def renew_ssh_user(username, days):
+def delete_ssh_user(username, server=None):
     try:
-        command = f"chage -E $(date -d '+{days} days' +%s) {username}"
-        result = ssh.execute(command)
-        return {"status": "renewed", "output": result}
+        if not revoke_users([username], server)[username]:
+            return {"error": f"falha ao remover {username}"}
+        return {"status": "deleted", "output": ""}
     except Exception as e:
         return {"error": str(e)}
-    
-    
-def delete_ssh_user(username):
-    try:
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect("192.99.110.188", username="root", password="3zFS3LqZ30NeN")
-
-        command = f"deluser {username}"
-        stdin, stdout, stderr = client.exec_command(command)
-        output = stdout.read().decode()
-        client.close()
-
-        return output
 
+def renew_ssh_user(username, days, server=None):
+    try:
+        command = f"chage -E $(date -d '+{int(days)} days' +%Y-%m-%d) {shlex.quote(username)}"
+        result = ssh.execute(command, **server_target(server))
+        return {"status": "renewed", "output": result.stdout + result.stderr}
     except Exception as e:
-        return str(e)
-
+        return {"error": str(e)}
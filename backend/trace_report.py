@@ -0,0 +1,174 @@
+"""
+Caminho crítico dos traces mais lentos gravados por tracing.py.
+
+Uso (na raiz do repositório):
+
+    python -m backend.trace_report                  # 5 mais lentos
+    python -m backend.trace_report -n 10 --root mercadopago_webhook
+    python -m backend.trace_report --file /var/log/maritima/spans.jsonl
+
+A duração do trace vai do início do span raiz até o fim do último span
+(o e-mail sai depois de o webhook já ter respondido). O caminho crítico
+é a cadeia de spans que determina esse fim: partindo da raiz, desce
+sempre no filho que termina por último e, antes dele, no que terminou
+antes de ele começar. "intervalo" é o tempo entre o trecho anterior e
+este que nenhum span cobre: trabalho do próprio pai fora de spans ou
+espera em fila (job depois do webhook, lote do e-mail...).
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+from collections import defaultdict
+
+from .tracing import STATUS_ERROR, TRACE_FILE
+
+
+def _attributes(span):
+    values = {}
+    for item in span.get("attributes", []):
+        value = item["value"]
+        values[item["key"]] = next(iter(value.values())) if value else None
+    return values
+
+
+def load_spans(path):
+    """Lê o arquivo atual e os rotacionados (.1, .2 ...). Linhas quebradas são ignoradas."""
+    spans = []
+    for name in sorted(glob.glob(f"{path}.*")) + [path]:
+        if not os.path.exists(name):
+            continue
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                span["start"] = int(span["startTimeUnixNano"])
+                span["end"] = int(span["endTimeUnixNano"])
+                spans.append(span)
+    return spans
+
+
+# ------------------------------------------------------
+# TRACES
+# ------------------------------------------------------
+class Trace:
+    def __init__(self, trace_id, spans):
+        self.trace_id = trace_id
+        self.spans = {s["spanId"]: s for s in spans}
+        self.children = defaultdict(list)
+
+        self.roots = []
+        for s in spans:
+            parent = s.get("parentSpanId")
+            if parent and parent in self.spans:
+                self.children[parent].append(s)
+            else:
+                self.roots.append(s)
+
+        self.start = min(s["start"] for s in spans)
+        self.end = max(s["end"] for s in spans)
+        self._tree_end = {}
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def root(self):
+        return min(self.roots, key=lambda s: s["start"])
+
+    def tree_end(self, span):
+        """Fim do span ou do descendente que termina por último."""
+        key = span["spanId"]
+        if key not in self._tree_end:
+            self._tree_end[key] = max([span["end"]] + [self.tree_end(c) for c in self.children[key]])
+        return self._tree_end[key]
+
+    def critical_path(self, span=None, depth=0, gap=0):
+        """[(profundidade, span, intervalo em ns)] em ordem cronológica."""
+        span = span or self.root
+        path = [(depth, span, gap)]
+
+        chosen = []
+        cursor = self.tree_end(span)
+        for child in sorted(self.children[span["spanId"]], key=self.tree_end, reverse=True):
+            if self.tree_end(child) <= cursor:
+                chosen.append(child)
+                cursor = child["start"]
+
+        # Primeiro filho: conta a partir do início do pai (ou do fim, se o
+        # filho só começou depois de o pai terminar); os demais, do irmão anterior
+        previous = None
+        for child in reversed(chosen):
+            if previous is not None:
+                reference = self.tree_end(previous)
+            elif child["start"] > span["end"]:
+                reference = span["end"]
+            else:
+                reference = span["start"]
+            path.extend(self.critical_path(child, depth + 1, max(0, child["start"] - reference)))
+            previous = child
+        return path
+
+
+def build_traces(spans, root_name=None):
+    grouped = defaultdict(list)
+    for span in spans:
+        grouped[span["traceId"]].append(span)
+
+    traces = [Trace(trace_id, items) for trace_id, items in grouped.items()]
+    if root_name:
+        traces = [t for t in traces if t.root["name"] == root_name]
+    return traces
+
+
+# ------------------------------------------------------
+# SAÍDA
+# ------------------------------------------------------
+def _ms(ns):
+    return ns / 1e6
+
+
+def print_trace(trace):
+    root = trace.root
+    attrs = _attributes(root)
+    label = " ".join(f"{k}={v}" for k, v in attrs.items())
+    print(f"\ntrace {trace.trace_id}  {root['name']}  {_ms(trace.duration):.1f} ms  {label}")
+    print(f"  {'início':>10}  {'duração':>10}  {'intervalo':>10}  span")
+
+    for depth, span, gap in trace.critical_path():
+        error = "  ERRO: " + span["status"].get("message", "") if span.get("status", {}).get("code") == STATUS_ERROR else ""
+        extras = {k: v for k, v in _attributes(span).items() if k not in attrs}
+        detail = " " + " ".join(f"{k}={v}" for k, v in extras.items()) if extras else ""
+
+        print(
+            f"  {_ms(span['start'] - trace.start):>8.1f}ms  {_ms(span['end'] - span['start']):>8.1f}ms"
+            f"  {_ms(gap):>8.1f}ms  {'  ' * depth}{span['name']}{detail}{error}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Caminho crítico dos traces mais lentos")
+    parser.add_argument("--file", default=TRACE_FILE, help="arquivo JSONL (os rotacionados são lidos junto)")
+    parser.add_argument("-n", type=int, default=5, help="quantos traces mostrar")
+    parser.add_argument("--root", help="só traces com este span raiz (mercadopago_webhook, trial...)")
+    args = parser.parse_args(argv)
+
+    traces = build_traces(load_spans(args.file), args.root)
+    if not traces:
+        print(f"Nenhum trace em {args.file}")
+        return 1
+
+    traces.sort(key=lambda t: t.duration, reverse=True)
+    print(f"{len(traces)} traces; mostrando os {min(args.n, len(traces))} mais lentos")
+    for trace in traces[:args.n]:
+        print_trace(trace)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,323 @@
+"""
+Rastreamento leve (spans) do caminho webhook -> provisionamento -> SSH ->
+e-mail e do teste grátis.
+
+O trace começa no webhook do Mercado Pago ou no /api/trial e segue pela
+thread atual via contextvars. Para passar de uma thread a outra pela
+fila do banco (ProvisioningJob, EmailDelivery) o contexto é gravado na
+linha como um traceparent W3C ("00-<trace>-<span>-<flags>") e retomado
+pelo worker com resume_trace().
+
+Cada span vira uma linha JSON no arquivo TRACE_FILE (com rotação), com
+os nomes de campo do OTLP/JSON (traceId, spanId, parentSpanId,
+startTimeUnixNano...): juntar as linhas em resourceSpans/scopeSpans dá
+o corpo aceito por um coletor OTLP. Para ler: python -m backend.trace_report
+"""
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from .metrics import metrics
+
+# ------------------------------------------------------
+# CONFIG
+# ------------------------------------------------------
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") == "1"
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))    # 0.0 a 1.0, por trace
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(BASE_DIR, "traces", "spans.jsonl"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(20 * 1024 * 1024)))
+TRACE_BACKUPS = int(os.getenv("TRACE_BACKUPS", "5"))                 # spans.jsonl.1 ... .N
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "1"))  # segundos
+
+# Tipos de span do OTLP
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+KIND_CONSUMER = 5
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+SpanContext = namedtuple("SpanContext", ["trace_id", "span_id", "sampled"])
+
+_current = ContextVar("trace_span", default=None)
+
+spans_dropped = metrics.counter("trace_spans_dropped_total", "Spans descartados com a fila do exportador cheia")
+
+
+def _sampled(trace_id):
+    # Decisão derivada do próprio trace id: qualquer thread chega à mesma
+    # resposta sem precisar combinar nada
+    return int(trace_id[-8:], 16) < TRACE_SAMPLE_RATE * 0x100000000
+
+
+def _new_id(bits):
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+# ------------------------------------------------------
+# EXPORTADOR (JSONL COM ROTAÇÃO)
+# ------------------------------------------------------
+class SpanExporter:
+    """
+    Fila em memória + thread que grava os spans em lote. Quem cria o
+    span nunca espera disco: com a fila cheia o span é descartado
+    (contado em trace_spans_dropped_total).
+    """
+
+    def __init__(self, path=TRACE_FILE, max_bytes=TRACE_MAX_BYTES, backups=TRACE_BACKUPS, queue_size=TRACE_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._file = None
+
+    def export(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            spans_dropped.inc()
+            return
+        self.start()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="trace-exporter", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        """Grava o que estiver na fila e fecha o arquivo."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _loop(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout=TRACE_FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
+
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"Erro ao gravar spans: {e}")
+
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _write(self, batch):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+
+        self._file.write("".join(json.dumps(span, separators=(",", ":")) + "\n" for span in batch))
+        self._file.flush()
+
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+
+exporter = SpanExporter()
+
+
+# ------------------------------------------------------
+# SPANS
+# ------------------------------------------------------
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Span:
+    __slots__ = ("context", "parent_id", "name", "kind", "start_ns", "attributes", "error")
+
+    def __init__(self, context, parent_id, name, kind, attributes, start_ns=None):
+        self.context = context
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = start_ns or time.time_ns()
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, end_ns=None):
+        exporter.export({
+            "traceId": self.context.trace_id,
+            "spanId": self.context.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(end_ns or time.time_ns()),
+            "attributes": [_attribute(k, v) for k, v in self.attributes.items() if v is not None],
+            "status": {"code": STATUS_ERROR, "message": self.error} if self.error else {"code": STATUS_OK},
+        })
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+@contextmanager
+def _activate(trace_id, parent_id, sampled, name, kind, attributes):
+    context = SpanContext(trace_id, _new_id(64), sampled)
+    token = _current.set(context)
+
+    if not sampled:
+        try:
+            yield NOOP_SPAN
+        finally:
+            _current.reset(token)
+        return
+
+    span = Span(context, parent_id, name, kind, attributes)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        span.end()
+
+
+@contextmanager
+def start_trace(name, kind=KIND_SERVER, **attributes):
+    """Abre um trace novo (span raiz). Dentro dele, span() cria filhos."""
+    if not TRACING_ENABLED:
+        yield NOOP_SPAN
+        return
+
+    trace_id = _new_id(128)
+    with _activate(trace_id, None, _sampled(trace_id), name, kind, attributes) as span:
+        yield span
+
+
+@contextmanager
+def span(name, kind=KIND_INTERNAL, **attributes):
+    """Span filho do atual; sem trace ativo (ou fora da amostra) não faz nada."""
+    parent = _current.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+
+    with _activate(parent.trace_id, parent.span_id, parent.sampled, name, kind, attributes) as child:
+        yield child
+
+
+def record_span(name, seconds, kind=KIND_INTERNAL, **attributes):
+    """Span já terminado (agora) que durou `seconds`; para trechos já cronometrados."""
+    parent = _current.get()
+    if parent is None or not parent.sampled:
+        return
+
+    end_ns = time.time_ns()
+    context = SpanContext(parent.trace_id, _new_id(64), True)
+    Span(context, parent.span_id, name, kind, attributes, start_ns=end_ns - int(seconds * 1e9)).end(end_ns)
+
+
+# ------------------------------------------------------
+# PROPAGAÇÃO ENTRE THREADS (TRACEPARENT)
+# ------------------------------------------------------
+def current_traceparent():
+    """traceparent W3C do span atual, para gravar junto do job/e-mail; None sem trace."""
+    context = _current.get()
+    if context is None:
+        return None
+    return f"00-{context.trace_id}-{context.span_id}-{'01' if context.sampled else '00'}"
+
+
+def _parse_traceparent(value):
+    try:
+        _version, trace_id, span_id, flags = value.split("-")
+        int(trace_id, 16), int(span_id, 16)
+        return trace_id, span_id, int(flags, 16) & 1 == 1
+    except (AttributeError, ValueError):
+        return None
+
+
+@contextmanager
+def resume_trace(traceparent, name, kind=KIND_CONSUMER, **attributes):
+    """Continua, em outra thread, o trace gravado em `traceparent`."""
+    parsed = _parse_traceparent(traceparent) if TRACING_ENABLED else None
+    if parsed is None:
+        yield NOOP_SPAN
+        return
+
+    trace_id, parent_id, sampled = parsed
+    with _activate(trace_id, parent_id, sampled, name, kind, attributes) as resumed:
+        yield resumed
+
+
+# ------------------------------------------------------
+# SQLALCHEMY (COMMITS)
+# ------------------------------------------------------
+def instrument_sessions(session_factory):
+    """Um span "db.commit" por commit feito dentro de um trace."""
+    from sqlalchemy import event
+
+    @event.listens_for(session_factory, "before_commit")
+    def _before_commit(session):
+        if _current.get() is not None:
+            session.info["commit_started"] = time.perf_counter()
+
+    @event.listens_for(session_factory, "after_commit")
+    def _after_commit(session):
+        started = session.info.pop("commit_started", None)
+        if started is not None:
+            record_span("db.commit", time.perf_counter() - started)
+
+    @event.listens_for(session_factory, "after_rollback")
+    def _after_rollback(session):
+        session.info.pop("commit_started", None)
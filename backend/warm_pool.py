@@ -0,0 +1,271 @@
+import os
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from .database import SessionLocal
+from .models import ProvisioningJob, VPNServer, WarmAccount
+from .ssh_connector import activate_user, reserve_users
+from .metrics import metrics
+from .tracing import span
+
+# ------------------------------------------------------
+# CONFIG
+# ------------------------------------------------------
+WARM_POOL_TARGET = int(os.getenv("WARM_POOL_TARGET", "20"))        # contas prontas por servidor (0 = desligado)
+WARM_POOL_BATCH = int(os.getenv("WARM_POOL_BATCH", "10"))          # usuários por script de reserva
+WARM_POOL_INTERVAL = float(os.getenv("WARM_POOL_INTERVAL", "60"))  # segundos entre verificações
+# Conta "claimed" há mais tempo que isso sem virar VPNAccount: processo
+# morreu no meio da ativação
+WARM_POOL_CLAIM_TIMEOUT = int(os.getenv("WARM_POOL_CLAIM_TIMEOUT", "600"))
+
+warm_pool_claims = metrics.counter(
+    "warm_pool_claims_total", "Ativações pela reserva (hit), reserva vazia (miss) e ativação que falhou (failed)",
+    ("result",)
+)
+
+# ------------------------------------------------------
+# RESERVA DE CONTAS PRÉ-CRIADAS
+# ------------------------------------------------------
+# Criar o usuário SSH na hora (useradd + chpasswd + chage) é o trecho
+# mais lento do teste grátis e do plano pago. A reserva mantém, por
+# servidor, WARM_POOL_TARGET usuários já criados e travados (senha
+# bloqueada e conta expirada); ativar um é pegar a linha no banco com
+# UPDATE condicional e rodar um único "usermod -U && chage -E".
+#
+# O EHI não é guardado na reserva: é gerado na ativação, com o
+# public_host/proxy do servidor naquele momento.
+
+
+def _new_username():
+    return f"mvpn{os.urandom(4).hex()}"
+
+
+def claim_account(db, server_id):
+    """
+    Pega uma conta pronta do servidor e marca como "claimed".
+    O UPDATE condicional garante que duas ativações não pegam a mesma conta.
+    """
+    candidates = db.query(WarmAccount.id).filter(
+        WarmAccount.server_id == server_id,
+        WarmAccount.status == "ready"
+    ).order_by(WarmAccount.id).limit(5).all()
+
+    for (account_id,) in candidates:
+        claimed = db.query(WarmAccount).filter(
+            WarmAccount.id == account_id,
+            WarmAccount.status == "ready"
+        ).update({"status": "claimed", "claimed_at": datetime.utcnow()}, synchronize_session=False)
+        db.commit()
+
+        if claimed:
+            return db.query(WarmAccount).filter(WarmAccount.id == account_id).first()
+
+    return None
+
+
+def take_account(db, server, days):
+    """
+    Ativa uma conta da reserva do servidor por `days` dias.
+    Retorna (username, password), ou None se a reserva estiver vazia ou a
+    ativação falhar: quem chama cria o usuário do jeito normal.
+
+    A linha continua "claimed" (protegida da reconciliação) até quem chama
+    gravar a conta do cliente chamando finish_claim no mesmo commit.
+    """
+    if WARM_POOL_TARGET <= 0:
+        return None
+
+    with span("warm_pool.take", server=server.name) as take_span:
+        account = claim_account(db, server.id)
+        pool.wake()
+
+        if account is None:
+            warm_pool_claims.inc("miss")
+            take_span.set(result="miss")
+            return None
+
+        result = activate_user(account.username, days, server)
+        credentials = (account.username, account.password)
+
+        if not result["success"]:
+            # O usuário travado deixa de ser reservado e fica para a reconciliação
+            db.query(WarmAccount).filter(WarmAccount.id == account.id).delete(synchronize_session=False)
+            db.commit()
+
+            print(f"Falha ao ativar conta da reserva {credentials[0]}: {result['error']}")
+            warm_pool_claims.inc("failed")
+            take_span.set(result="failed")
+            return None
+
+        warm_pool_claims.inc("hit")
+        take_span.set(result="hit")
+        return credentials
+
+
+def finish_claim(db, username):
+    """Tira da reserva a conta ativada, sem commit: vai junto com a VPNAccount."""
+    db.query(WarmAccount).filter(
+        WarmAccount.username == username,
+        WarmAccount.status == "claimed"
+    ).delete(synchronize_session=False)
+
+
+def reserved_usernames(db, server_id):
+    """Usuários da reserva (em criação, prontos ou em ativação) que a reconciliação não deve remover."""
+    return {
+        username for (username,) in db.query(WarmAccount.username).filter(WarmAccount.server_id == server_id)
+    }
+
+
+# ------------------------------------------------------
+# REABASTECIMENTO
+# ------------------------------------------------------
+def _release_stale_claims(db):
+    limit = datetime.utcnow() - timedelta(seconds=WARM_POOL_CLAIM_TIMEOUT)
+
+    # Job de provisionamento ainda aberto (esperando retentativa) segura a conta
+    open_jobs = db.query(ProvisioningJob.username).filter(
+        ProvisioningJob.status.in_(("pending", "running")),
+        ProvisioningJob.username.isnot(None)
+    )
+
+    db.query(WarmAccount).filter(
+        WarmAccount.status == "claimed",
+        WarmAccount.claimed_at < limit,
+        WarmAccount.username.notin_(open_jobs)
+    ).delete(synchronize_session=False)
+
+    # Reserva interrompida (processo morreu durante o script)
+    db.query(WarmAccount).filter(
+        WarmAccount.status == "reserving",
+        WarmAccount.created_at < limit
+    ).delete(synchronize_session=False)
+    db.commit()
+
+
+def refill_server(db, server):
+    """Completa a reserva do servidor até WARM_POOL_TARGET, em lotes. Retorna quantas criou."""
+    ready = db.query(func.count(WarmAccount.id)).filter(
+        WarmAccount.server_id == server.id,
+        WarmAccount.status == "ready"
+    ).scalar()
+
+    created = 0
+    missing = WARM_POOL_TARGET - ready
+
+    while missing > 0:
+        batch = [(_new_username(), os.urandom(4).hex()) for _ in range(min(WARM_POOL_BATCH, missing))]
+
+        # As linhas entram antes do useradd: a reconciliação que ler o banco
+        # antes de listar o servidor já vê estes nomes como reservados
+        accounts = [
+            WarmAccount(server_id=server.id, username=username, password=password, status="reserving")
+            for username, password in batch
+        ]
+        db.add_all(accounts)
+        db.commit()
+        ids = {a.username: a.id for a in accounts}
+
+        results = {}
+        try:
+            results = reserve_users(batch, server)
+        finally:
+            # Sem o usuário no servidor a linha sai; o que ficou pela metade
+            # no servidor deixa de ser reservado e a reconciliação remove
+            ok = [i for username, i in ids.items() if results.get(username)]
+            failed = [i for username, i in ids.items() if not results.get(username)]
+
+            if ok:
+                db.query(WarmAccount).filter(WarmAccount.id.in_(ok)).update(
+                    {"status": "ready"}, synchronize_session=False
+                )
+            if failed:
+                db.query(WarmAccount).filter(WarmAccount.id.in_(failed)).delete(synchronize_session=False)
+            db.commit()
+
+        if not ok:
+            raise RuntimeError(f"nenhum usuário reservado no servidor {server.name}")
+
+        created += len(ok)
+        missing -= len(ok)
+
+    return created
+
+
+def refill_all():
+    db = SessionLocal()
+    try:
+        _release_stale_claims(db)
+
+        servers = db.query(VPNServer).filter(
+            VPNServer.enabled.is_(True),
+            VPNServer.healthy.is_(True)
+        ).all()
+
+        for server in servers:
+            try:
+                refill_server(db, server)
+            except Exception as e:
+                db.rollback()
+                print(f"Erro ao reabastecer a reserva do servidor {server.name}: {e}")
+    finally:
+        db.close()
+
+
+class WarmPool:
+    """Thread que mantém a reserva cheia; acordada a cada conta retirada."""
+
+    def __init__(self, interval=WARM_POOL_INTERVAL):
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def start(self):
+        if WARM_POOL_TARGET <= 0 or self._thread:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="warm-pool", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                refill_all()
+            except Exception:
+                traceback.print_exc()
+
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
+pool = WarmPool()
+
+
+def _ready_accounts():
+    db = SessionLocal()
+    try:
+        rows = db.query(VPNServer.name, func.count(WarmAccount.id)).join(
+            WarmAccount, WarmAccount.server_id == VPNServer.id
+        ).filter(WarmAccount.status == "ready").group_by(VPNServer.name).all()
+    finally:
+        db.close()
+
+    return {(name,): count for name, count in rows}
+
+
+metrics.gauge("warm_pool_ready", "Contas pré-criadas prontas para ativação, por servidor", _ready_accounts, ("server",))
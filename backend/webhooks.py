@@ -0,0 +1,109 @@
+import os
+import threading
+from collections import OrderedDict
+
+from sqlalchemy.exc import IntegrityError
+
+from .models import Payment, WebhookEvent
+from .provisioning import CLAIMED_STATUSES, enqueue_payment
+
+# ------------------------------------------------------
+# CONFIG
+# ------------------------------------------------------
+WEBHOOK_SEEN_SIZE = int(os.getenv("WEBHOOK_SEEN_SIZE", "50000"))  # eventos lembrados em memória
+
+
+# ------------------------------------------------------
+# EVENTOS JÁ VISTOS (EM MEMÓRIA)
+# ------------------------------------------------------
+class SeenSet:
+    """
+    Conjunto LRU limitado. Retentativas do MP que já passaram por este
+    processo são descartadas sem tocar no banco; o que escapar (outro
+    processo, reinício) é barrado pela constraint única do WebhookEvent.
+    """
+
+    def __init__(self, max_size=WEBHOOK_SEEN_SIZE):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return True
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._data[key] = True
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+webhook_seen = SeenSet()
+
+
+# ------------------------------------------------------
+# INGESTÃO
+# ------------------------------------------------------
+def mercadopago_event_key(body):
+    """
+    (provedor, id do evento, ação) de uma notificação do Mercado Pago.
+    Notificações antigas (IPN) não têm id próprio: id do evento None.
+    """
+    event_id = body.get("id")
+    action = body.get("action") or body.get("type") or ""
+    return ("mercadopago", str(event_id) if event_id else None, action)
+
+
+def is_duplicate(key):
+    """Evento já visto neste processo (sem id do evento nunca é duplicado)."""
+    return key[1] is not None and key in webhook_seen
+
+
+def ingest_payment_event(db, key, mp_payment_id):
+    """
+    Registra o evento e enfileira o provisionamento, uma única vez.
+    Retorna (status, job_id): "queued", "duplicate" ou "already_processed".
+
+    Sem id do evento não há o que deduplicar: uma chave só pelo pagamento
+    descartaria a aprovação que chega depois do aviso de "pending". O
+    compare-and-set do Payment (provisioning.py) já impede provisionar duas vezes.
+    """
+    provider, event_id, action = key
+    if event_id is None:
+        return _enqueue_unless_claimed(db, mp_payment_id)
+
+    if key in webhook_seen:
+        return "duplicate", None
+
+    event = WebhookEvent(provider=provider, event_id=event_id, action=action, mp_payment_id=mp_payment_id)
+    db.add(event)
+
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        webhook_seen.add(key)
+        return "duplicate", None
+
+    status, job_id = _enqueue_unless_claimed(db, mp_payment_id)
+    event.job_id = job_id
+    db.commit()
+
+    webhook_seen.add(key)
+    return status, job_id
+
+
+def _enqueue_unless_claimed(db, mp_payment_id):
+    # Pagamento já com job dono: não enfileira de novo
+    status = db.query(Payment.status).filter(Payment.mp_payment_id == mp_payment_id).scalar()
+    if status in CLAIMED_STATUSES:
+        db.commit()
+        return "already_processed", None
+
+    job = enqueue_payment(db, mp_payment_id)
+    return "queued", job.id
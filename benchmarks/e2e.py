@@ -0,0 +1,244 @@
+"""
+Benchmark ponta a ponta do backend, sem rede externa.
+
+Sobe os substitutos locais (SSH, Mercado Pago e SMTP, ver fakes.py),
+aponta o backend para eles e mede, por etapa, latência (p50/p95/p99) e
+vazão de: cadastro, login, criação do PIX, webhook -> conta criada,
+webhook -> e-mail entregue, get-plans (completo e 304) e teste grátis.
+
+Uso (na raiz do repositório):
+
+    python -m benchmarks.e2e --customers 40 --concurrency 8
+    python -m benchmarks.e2e --save-baseline       # grava baselines/e2e.json
+    python -m benchmarks.e2e --compare             # exit 1 se o p95 piorar > --threshold
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import httpx
+
+from .fakes import FakeMercadoPago, FakeSSHServer, SMTPSink
+from .stats import compare, environment, load_results, print_comparison, print_table, save_results, summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baselines", "e2e.json")
+
+APPROVED_SUBJECT = "Seu acesso Marítima VPN"
+TRIAL_SUBJECT = "Teste grátis Marítima VPN"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ponta a ponta (offline)")
+    parser.add_argument("--customers", type=int, default=40, help="clientes simulados")
+    parser.add_argument("--concurrency", type=int, default=8, help="requisições simultâneas")
+    parser.add_argument("--ssh-latency", type=float, default=0.02, help="segundos por comando no SSH falso")
+    parser.add_argument("--mp-latency", type=float, default=0.01, help="segundos por chamada no MP falso")
+    parser.add_argument("--timeout", type=float, default=60, help="espera máxima por conta/e-mail")
+    parser.add_argument("--output", help="grava o resultado em JSON")
+    parser.add_argument("--save-baseline", action="store_true", help=f"grava em {os.path.relpath(BASELINE_PATH, ROOT)}")
+    parser.add_argument("--compare", action="store_true", help="compara com o baseline salvo")
+    parser.add_argument("--metric", default="p95_ms")
+    parser.add_argument("--threshold", type=float, default=0.25, help="piora tolerada (0.25 = 25%%)")
+    return parser.parse_args(argv)
+
+
+# ------------------------------------------------------
+# AMBIENTE
+# ------------------------------------------------------
+def configure_backend(workdir, ssh, mp, smtp):
+    """Variáveis lidas pelos módulos do backend no import: definir antes dele."""
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "EHI_DIR": os.path.join(workdir, "ehis"),
+        "TRACE_FILE": os.path.join(workdir, "spans.jsonl"),
+        "SSH_HOST": "127.0.0.1",
+        "SSH_PORT": str(ssh.port),
+        "SSH_USER": "bench",
+        "SSH_PASS": "bench",
+        "MP_API_URL": mp.url,
+        "MP_ACCESS_TOKEN": "bench",
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": str(smtp.port),
+        "SMTP_SSL": "0",
+        "EMAIL_SENDER": "bench@maritimavpn.local",
+        "EMAIL_APP_PASSWORD": "",
+        "MAIL_BATCH_WAIT": "0.05",
+        "PROVISIONING_POLL_INTERVAL": "0.05",
+        "RATE_LIMIT_ENABLED": "0",
+    })
+
+
+class Stages:
+    """Amostras e janela de tempo (início/fim) de cada etapa."""
+
+    def __init__(self):
+        self.samples = OrderedDict()
+        self.windows = {}
+
+    def record(self, stage, seconds, started):
+        self.samples.setdefault(stage, []).append(seconds)
+        first, last = self.windows.get(stage, (started, started + seconds))
+        self.windows[stage] = (min(first, started), max(last, started + seconds))
+
+    def summary(self):
+        return {
+            stage: summarize(samples, self.windows[stage][1] - self.windows[stage][0])
+            for stage, samples in self.samples.items()
+        }
+
+
+# ------------------------------------------------------
+# CENÁRIOS
+# ------------------------------------------------------
+async def run_benchmark(args, mp, smtp):
+    from backend.main import app
+    from backend.payment_events import payment_events
+
+    stages = Stages()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    customers = [f"bench{i}@maritimavpn.local" for i in range(args.customers)]
+    tokens = {}
+    rejected = {}
+
+    async def call(stage, method, url, expected=(200,), **kwargs):
+        """
+        Requisição cronometrada. 429/503 (limite ou pool de hash cheio)
+        são repetidos depois do Retry-After, como faria o navegador; o
+        tempo medido inclui a espera e as recusas ficam em `rejected`.
+        """
+        started = time.perf_counter()
+        while True:
+            response = await client.request(method, url, **kwargs)
+            if response.status_code not in (429, 503):
+                break
+            rejected[stage] = rejected.get(stage, 0) + 1
+            await asyncio.sleep(float(response.headers.get("retry-after", "1")))
+
+        stages.record(stage, time.perf_counter() - started, started)
+
+        if response.status_code not in expected:
+            raise RuntimeError(f"{url}: {response.status_code} {response.text[:200]}")
+        return response
+
+    async def each(fn):
+        async def bounded(email):
+            async with semaphore:
+                await fn(email)
+        await asyncio.gather(*(bounded(email) for email in customers))
+
+    transport = httpx.ASGITransport(app=app)
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=args.timeout) as client:
+
+            async def register(email):
+                await call("register", "POST", "/api/register", json={
+                    "name": "Bench", "email": email, "password": "bench-pass"
+                })
+
+            async def login(email):
+                response = await call("login", "POST", "/api/login", json={"email": email, "password": "bench-pass"})
+                tokens[email] = {"Authorization": f"Bearer {response.json()['token']}"}
+
+            async def buy(email):
+                response = await call("create-pix", "POST", "/api/create-pix", json={"plan_days": 30}, headers=tokens[email])
+                mp_payment_id = response.json()["payment_id"]
+                mp.approve(mp_payment_id)
+
+                subscription = payment_events.subscribe(mp_payment_id)
+                try:
+                    started = time.perf_counter()
+                    await call("webhook", "POST", "/api/webhook/mercadopago", json={
+                        "id": f"bench-{mp_payment_id}",
+                        "action": "payment.updated",
+                        "type": "payment",
+                        "data": {"id": str(mp_payment_id)},
+                    })
+
+                    queue = subscription[1]
+                    while (await asyncio.wait_for(queue.get(), args.timeout))["status"] != "approved":
+                        pass
+                    stages.record("webhook->account", time.perf_counter() - started, started)
+                finally:
+                    payment_events.unsubscribe(mp_payment_id, subscription)
+
+                delivered = await asyncio.to_thread(smtp.wait_for, email, APPROVED_SUBJECT, args.timeout)
+                stages.record("webhook->email", delivered - started, started)
+
+            async def plans(email):
+                response = await call("get-plans", "GET", "/api/get-plans", headers=tokens[email])
+                conditional = {**tokens[email], "If-None-Match": response.headers["etag"]}
+                await call("get-plans-304", "GET", "/api/get-plans", expected=(304,), headers=conditional)
+
+            async def trial(email):
+                await call("trial", "POST", "/api/trial", headers=tokens[email])
+
+            for phase in (register, login, buy, plans, trial):
+                await each(phase)
+
+    return stages.summary(), rejected
+
+
+# ------------------------------------------------------
+# CLI
+# ------------------------------------------------------
+def main(argv=None):
+    args = parse_args(argv)
+    os.chdir(ROOT)  # main.py monta js/ e imagens/ com caminho relativo
+
+    workdir = tempfile.mkdtemp(prefix="mvpn-bench-")
+    ssh = FakeSSHServer(latency=args.ssh_latency).start()
+    mp = FakeMercadoPago(latency=args.mp_latency).start()
+    smtp = SMTPSink().start()
+
+    try:
+        configure_backend(workdir, ssh, mp, smtp)
+        stages, rejected = asyncio.run(run_benchmark(args, mp, smtp))
+    finally:
+        smtp.stop()
+        mp.stop()
+        ssh.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "meta": {
+            **environment(),
+            "customers": args.customers,
+            "concurrency": args.concurrency,
+            "ssh_latency": args.ssh_latency,
+            "mp_latency": args.mp_latency,
+            "ssh_calls": dict(ssh.calls),
+            "rejected": rejected,
+        },
+        "stages": stages,
+    }
+
+    print_table(stages)
+    if rejected:
+        print(f"\nRecusadas (429/503) e repetidas: {rejected}")
+
+    if args.output:
+        save_results(args.output, results)
+    if args.save_baseline:
+        save_results(BASELINE_PATH, results)
+        print(f"\nBaseline gravado em {os.path.relpath(BASELINE_PATH, ROOT)}")
+
+    if args.compare:
+        baseline = load_results(BASELINE_PATH)
+        rows, regressions = compare(stages, baseline["stages"], args.metric, args.threshold)
+        print_comparison(rows, args.metric, args.threshold)
+        if regressions:
+            print(f"\nRegressões: {', '.join(regressions)}")
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,382 @@
+"""
+Substitutos locais dos serviços externos, para rodar o backend sem rede:
+
+- FakeSSHServer: servidor SSH (paramiko) que entende os scripts de
+  provisionamento/revogação/reserva do ssh_connector e registra
+  useradd/chage.
+- FakeMercadoPago: API HTTP mínima de pagamentos (/v1/payments).
+- SMTPSink: servidor SMTP (aiosmtpd) que só guarda o horário de chegada.
+"""
+import json
+import re
+import socket
+import threading
+import time
+from collections import defaultdict
+from email import message_from_bytes, policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import paramiko
+from aiosmtpd.controller import Controller
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ------------------------------------------------------
+# SSH
+# ------------------------------------------------------
+PROVISION_RE = re.compile(r"^provision (\S+) (\S+) <<'(\S+)'$")
+REVOKE_RE = re.compile(r"^revoke (\S+)$")
+RESERVE_RE = re.compile(r"^reserve (\S+) <<'(\S+)'$")
+ACTIVATE_RE = re.compile(r"^usermod -U (\S+) && chage -E (\S+) \1$")
+
+
+class _SSHInterface(paramiko.ServerInterface):
+    def __init__(self, fake):
+        self.fake = fake
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(
+            target=self.fake.handle_exec,
+            args=(channel, command.decode()),
+            daemon=True
+        ).start()
+        return True
+
+
+class FakeSSHServer:
+    """
+    Servidor SSH em 127.0.0.1 que interpreta, em Python, os comandos que o
+    backend envia ("bash -s" com provision/revoke/reserve, "true", chage,
+    "usermod -U ... && chage -E ..."):
+    nada roda de verdade, cada useradd/chpasswd/chage/userdel fica em
+    `self.calls` e os usuários em `self.users`.
+
+    `latency` (segundos) simula o custo do comando no servidor real.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.port = _free_port()
+        self.host_key = paramiko.RSAKey.generate(2048)
+
+        self.users = {}                      # usuário -> data de expiração
+        self.calls = defaultdict(int)        # comando -> quantidade
+        self.commands = 0
+        self._lock = threading.Lock()
+
+        self._sock = None
+        self._thread = None
+        self._transports = []
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("127.0.0.1", self.port))
+        self._sock.listen(100)
+
+        self._thread = threading.Thread(target=self._accept_loop, name="fake-ssh", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._sock:
+            self._sock.close()
+        for transport in self._transports:
+            transport.close()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=_SSHInterface(self))
+            self._transports.append(transport)
+
+            # Aceita canais até a conexão cair (o pool reaproveita a conexão)
+            threading.Thread(target=self._channel_loop, args=(transport,), daemon=True).start()
+
+    @staticmethod
+    def _channel_loop(transport):
+        # Canal aceito e descartado é fechado pelo __del__ do paramiko:
+        # mantém a referência enquanto ele estiver aberto
+        channels = set()
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is not None:
+                channels.add(channel)
+            channels = {c for c in channels if not c.closed}
+
+    def handle_exec(self, channel, command):
+        stdin = b""
+        if command == "bash -s":
+            while True:
+                chunk = channel.recv(65536)
+                if not chunk:
+                    break
+                stdin += chunk
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        output, status = self.run(command, stdin.decode())
+
+        channel.sendall(output.encode())
+        channel.send_exit_status(status)
+        channel.shutdown_write()
+        channel.close()
+
+    def run(self, command, script):
+        with self._lock:
+            self.commands += 1
+
+            if command == "true":
+                return "", 0
+
+            if command.startswith("chage "):
+                self.calls["chage"] += 1
+                return "", 0
+
+            match = ACTIVATE_RE.match(command)
+            if match:
+                username, expires = match.groups()
+                if username not in self.users:
+                    return f"usermod: user '{username}' does not exist\n", 6
+                self.calls["usermod"] += 1
+                self.calls["chage"] += 1
+                self.users[username] = expires
+                return "", 0
+
+            if command != "bash -s":
+                return "", 127
+
+            out = []
+            lines = iter(script.splitlines())
+            for line in lines:
+                match = PROVISION_RE.match(line)
+                if match:
+                    username, expires, marker = match.groups()
+                    # Corpo do heredoc: "usuário:senha" até o marcador
+                    for body in lines:
+                        if body == marker:
+                            break
+
+                    if username not in self.users:
+                        self.calls["useradd"] += 1
+                    self.calls["chpasswd"] += 1
+                    self.calls["chage"] += 1
+                    self.users[username] = expires
+                    out.append(f"OK\t{username}\t{expires}")
+                    continue
+
+                match = RESERVE_RE.match(line)
+                if match:
+                    username, marker = match.groups()
+                    for body in lines:
+                        if body == marker:
+                            break
+
+                    if username in self.users:
+                        out.append(f"ERR\t{username}\texists")
+                        continue
+                    self.calls["useradd"] += 1
+                    self.calls["chpasswd"] += 1
+                    self.calls["usermod"] += 1
+                    self.calls["chage"] += 1
+                    self.users[username] = "1970-01-01"
+                    out.append(f"OK\t{username}\tlocked")
+                    continue
+
+                match = REVOKE_RE.match(line)
+                if match:
+                    username = match.group(1)
+                    if self.users.pop(username, None) is None:
+                        out.append(f"OK\t{username}\tabsent")
+                    else:
+                        self.calls["userdel"] += 1
+                        out.append(f"OK\t{username}\tdeleted")
+
+            return "\n".join(out) + "\n", 0
+
+
+# ------------------------------------------------------
+# MERCADO PAGO
+# ------------------------------------------------------
+class _MPHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        fake = self.server.fake
+        length = int(self.headers.get("Content-Length", 0))
+        data = json.loads(self.rfile.read(length) or b"{}")
+
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        payment = fake.create(data, self.headers.get("X-Idempotency-Key"))
+        self._send(201, payment)
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        if url.path == "/v1/payments/search":
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            self._send(200, fake.search(int(query.get("offset", 0)), int(query.get("limit", 30))))
+            return
+
+        payment = fake.get(url.path.rsplit("/", 1)[-1])
+        if payment is None:
+            self._send(404, {"message": "Payment not found"})
+        else:
+            self._send(200, payment)
+
+
+class FakeMercadoPago:
+    """API de pagamentos em memória; approve() simula o cliente pagando o PIX."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+
+        self.payments = {}
+        self._keys = {}
+        self._next_id = 10_000_000
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), _MPHandler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        threading.Thread(target=self._server.serve_forever, name="fake-mp", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+
+    def create(self, data, idempotency_key):
+        with self._lock:
+            if idempotency_key in self._keys:
+                return self.payments[self._keys[idempotency_key]]
+
+            self._next_id += 1
+            payment_id = str(self._next_id)
+            payment = {
+                "id": int(payment_id),
+                "status": "pending",
+                "transaction_amount": data.get("transaction_amount"),
+                "point_of_interaction": {
+                    "transaction_data": {
+                        "qr_code": f"00020126-PIX-{payment_id}",
+                        "qr_code_base64": "iVBORw0KGgo=",
+                    }
+                },
+            }
+            self.payments[payment_id] = payment
+            self._keys[idempotency_key] = payment_id
+            return payment
+
+    def get(self, payment_id):
+        with self._lock:
+            return self.payments.get(str(payment_id))
+
+    def search(self, offset, limit):
+        with self._lock:
+            results = list(self.payments.values())
+        return {"results": results[offset:offset + limit], "paging": {"total": len(results), "offset": offset, "limit": limit}}
+
+    def approve(self, payment_id):
+        with self._lock:
+            self.payments[str(payment_id)]["status"] = "approved"
+
+
+# ------------------------------------------------------
+# SMTP
+# ------------------------------------------------------
+class _SinkHandler:
+    def __init__(self, sink):
+        self.sink = sink
+
+    async def handle_DATA(self, server, session, envelope):
+        now = time.perf_counter()
+        subject = str(message_from_bytes(envelope.content, policy=policy.default).get("Subject", ""))
+        for rcpt in envelope.rcpt_tos:
+            self.sink.record(rcpt, subject, now)
+        return "250 OK"
+
+
+class SMTPSink:
+    """SMTP local que aceita tudo e guarda quando cada e-mail chegou."""
+
+    def __init__(self):
+        self.port = _free_port()
+        self.received = defaultdict(list)   # (destinatário, assunto) -> [perf_counter de chegada]
+        self._events = {}
+        self._lock = threading.Lock()
+        self._controller = Controller(_SinkHandler(self), hostname="127.0.0.1", port=self.port)
+
+    def start(self):
+        self._controller.start()
+        return self
+
+    def stop(self):
+        self._controller.stop()
+
+    def record(self, rcpt, subject, when):
+        key = (rcpt, subject)
+        with self._lock:
+            self.received[key].append(when)
+            event = self._events.get(key)
+        if event:
+            event.set()
+
+    def wait_for(self, rcpt, subject, timeout=30):
+        """Bloqueia até o e-mail chegar; retorna o horário (perf_counter)."""
+        key = (rcpt, subject)
+        with self._lock:
+            if self.received.get(key):
+                return self.received[key][0]
+            event = self._events.setdefault(key, threading.Event())
+
+        if not event.wait(timeout):
+            raise TimeoutError(f"nenhum e-mail '{subject}' para {rcpt}")
+
+        with self._lock:
+            return self.received[key][0]
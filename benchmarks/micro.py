@@ -0,0 +1,304 @@
+"""
+Microbenchmarks dos custos pagos a cada requisição.
+
+Cada cenário tem um prefixo que diz de onde vem o custo:
+
+- hash/       argon2 (hash_password / verify_password, parâmetros do .env)
+- serialize/  JWT (create_token / decode), generate_ehi e o JSON do get-plans
+- db/         consultas do get_current_user e do get_plans num SQLite
+              semeado com até --users usuários
+
+e roda em vários tamanhos (tamanho da senha, das credenciais do EHI,
+quantidade de usuários no banco, planos por usuário).
+
+Uso (na raiz do repositório):
+
+    python -m benchmarks.micro                     # tudo; grava results/micro-last.json
+    python -m benchmarks.micro --only db,serialize
+    python -m benchmarks.micro --compare           # diff com a execução anterior
+"""
+import argparse
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from .stats import compare, environment, load_results, print_comparison, print_table, save_results, summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAST_RUN_PATH = os.path.join(ROOT, "benchmarks", "results", "micro-last.json")
+
+GROUPS = ("hash", "serialize", "db")
+PASSWORD_SIZES = (8, 64, 1024)        # caracteres
+CREDENTIAL_SIZES = (8, 64, 512)       # usuário/senha do EHI
+PLAN_SIZES = (1, 10, 50, 200)         # contas do usuário (50 = página padrão)
+
+
+def _sizes(value):
+    return tuple(int(v) for v in value.split(","))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks (hash, serialização, banco)")
+    parser.add_argument("--only", default=",".join(GROUPS), help="grupos separados por vírgula")
+    parser.add_argument("--users", type=_sizes, default=(1000, 10000, 100000), help="usuários no banco, ex.: 1000,100000")
+    parser.add_argument("--min-time", type=float, default=0.5, help="segundos mínimos por cenário")
+    parser.add_argument("--min-rounds", type=int, default=5)
+    parser.add_argument("--output", help="grava o resultado também neste JSON")
+    parser.add_argument("--compare", nargs="?", const=LAST_RUN_PATH, metavar="JSON",
+                        help="compara com outro resultado (padrão: a execução anterior)")
+    parser.add_argument("--metric", default="p50_ms")
+    parser.add_argument("--threshold", type=float, default=0.25, help="piora tolerada (0.25 = 25%%)")
+    return parser.parse_args(argv)
+
+
+# ------------------------------------------------------
+# MEDIÇÃO
+# ------------------------------------------------------
+def measure(fn, setup=None, min_rounds=5, min_time=0.5, max_rounds=200000):
+    """
+    Chama fn() até somar min_time segundos (e pelo menos min_rounds
+    vezes), cronometrando cada chamada. `setup` roda antes de cada
+    chamada, fora do tempo medido. throughput_per_s = chamadas/s.
+    """
+    if setup:
+        setup()
+    fn()  # aquecimento
+
+    samples = []
+    spent = 0.0
+    while len(samples) < min_rounds or (spent < min_time and len(samples) < max_rounds):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        samples.append(elapsed)
+        spent += elapsed
+
+    return summarize(samples, spent)
+
+
+class Suite:
+    def __init__(self, args):
+        self.args = args
+        self.results = {}
+
+    def run(self, name, fn, setup=None):
+        gc.collect()  # lixo do cenário anterior (ou da semeadura) não entra na conta
+        summary = measure(fn, setup, self.args.min_rounds, self.args.min_time)
+        self.results[name] = summary
+        print(f"{name:<48} p50 {summary['p50_ms']:>10.3f} ms", flush=True)
+
+
+# ------------------------------------------------------
+# HASH
+# ------------------------------------------------------
+def bench_hash(suite):
+    from backend.auth import hash_password, verify_password
+
+    for size in PASSWORD_SIZES:
+        password = "s" * size
+        hashed = hash_password(password)
+        suite.run(f"hash/hash_password[len={size}]", lambda: hash_password(password))
+        suite.run(f"hash/verify_password[len={size}]", lambda: verify_password(password, hashed))
+
+
+# ------------------------------------------------------
+# SERIALIZAÇÃO
+# ------------------------------------------------------
+class _Server:
+    public_host = "br1.maritimavpn.shop"
+    proxy_ip = "104.17.71.206"
+    proxy_port = "80"
+
+
+def bench_serialize(suite):
+    from jose import jwt
+
+    from backend.auth import ALGORITHM, SECRET_KEY, create_token, download_link_expiry
+    from backend.ehi_generator import generate_ehi
+    from backend.plans_cache import render_plans
+
+    token = create_token(123456)
+    suite.run("serialize/jwt_encode", lambda: create_token(123456))
+    suite.run("serialize/jwt_decode", lambda: jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]))
+
+    for size in CREDENTIAL_SIZES:
+        username, password = "u" * size, "p" * size
+        suite.run(f"serialize/generate_ehi[len={size}]", lambda: generate_ehi(username, password, "30", _Server))
+
+    class Row:
+        def __init__(self, i):
+            self.id = i
+            self.plan = "30"
+            self.username = f"mvpn{i:08d}"
+            self.expires_at = datetime(2026, 1, 1) + timedelta(days=i)
+
+    link_expires = download_link_expiry()
+    for size in PLAN_SIZES:
+        rows = [Row(i) for i in range(size)]
+        suite.run(f"serialize/render_plans[plans={size}]", lambda: render_plans(rows, 1, link_expires))
+
+
+# ------------------------------------------------------
+# BANCO
+# ------------------------------------------------------
+SEED_CHUNK = 10000
+
+
+def _seed_users(engine, start, stop, password_hash):
+    from backend.models import User, VPNAccount
+
+    now = datetime.utcnow()
+    expires = now + timedelta(days=30)
+
+    with engine.begin() as conn:
+        for first in range(start, stop, SEED_CHUNK):
+            ids = range(first + 1, min(stop, first + SEED_CHUNK) + 1)
+            conn.execute(User.__table__.insert(), [
+                {"id": i, "name": f"Cliente {i}", "email": f"user{i}@bench.local",
+                 "password": password_hash, "trial_used": False}
+                for i in ids
+            ])
+            # Uma conta por usuário, como um banco de produção típico
+            conn.execute(VPNAccount.__table__.insert(), [
+                {"owner_id": i, "username": f"mvpn{i:08d}", "password": "x", "expires_at": expires,
+                 "plan": "30", "ehi_file": "bench.ehi", "active": True, "updated_at": now}
+                for i in ids
+            ])
+
+
+def _seed_plans(engine, owner_id, count):
+    from backend.models import VPNAccount
+
+    if count <= 0:
+        return
+
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(VPNAccount.__table__.insert(), [
+            {"owner_id": owner_id, "username": f"mvpn{owner_id}x{i}", "password": "x",
+             "expires_at": now + timedelta(days=i), "plan": "30", "ehi_file": "bench.ehi",
+             "active": True, "updated_at": now}
+            for i in range(count)
+        ])
+
+
+def bench_db(suite):
+    from backend.auth import create_token, download_link_expiry, get_current_user, pwd_context, user_cache
+    from backend.database import Base, SessionLocal, engine
+    from backend.plans_cache import load_plans_page, plans_version
+
+    Base.metadata.create_all(bind=engine)
+    password_hash = pwd_context.hash("bench-pass")
+    rng = random.Random(42)
+
+    seeded = 0
+    for users in sorted(suite.args.users):
+        started = time.perf_counter()
+        _seed_users(engine, seeded, users, password_hash)
+        seeded = users
+        print(f"-- banco com {users} usuários (semeado em {time.perf_counter() - started:.1f}s)", flush=True)
+
+        headers = [f"Bearer {create_token(rng.randint(1, users))}" for _ in range(1000)]
+        picks = iter(lambda: rng.choice(headers), None)
+
+        def current_user(header=None):
+            db = SessionLocal()
+            try:
+                get_current_user(header or next(picks), db)
+            finally:
+                db.close()
+
+        # Sem cache: JWT + SELECT por chave primária; com cache: só o JWT
+        suite.run(f"db/current_user_miss[users={users}]", current_user, setup=user_cache.clear)
+
+        # Cache aquecido com todos os tokens sorteáveis: toda chamada é hit
+        user_cache.clear()
+        for header in set(headers):
+            current_user(header)
+        suite.run(f"db/current_user_hit[users={users}]", current_user)
+
+    # Planos por usuário no banco maior; os donos são usuários novos
+    link_expires = download_link_expiry()
+    for size in PLAN_SIZES:
+        seeded += 1
+        _seed_users(engine, seeded - 1, seeded, password_hash)
+        _seed_plans(engine, seeded, size - 1)  # _seed_users já criou uma
+        owner = seeded
+
+        def version():
+            db = SessionLocal()
+            try:
+                plans_version(db, owner, link_expires)
+            finally:
+                db.close()
+
+        def page():
+            db = SessionLocal()
+            try:
+                load_plans_page(db, owner, 1, 50)
+            finally:
+                db.close()
+
+        suite.run(f"db/plans_version[plans={size}]", version)
+        suite.run(f"db/plans_page[plans={size}]", page)
+
+
+# ------------------------------------------------------
+# CLI
+# ------------------------------------------------------
+def main(argv=None):
+    args = parse_args(argv)
+    groups = [g for g in args.only.split(",") if g]
+    unknown = set(groups) - set(GROUPS)
+    if unknown:
+        print(f"Grupos desconhecidos: {', '.join(sorted(unknown))} (use {', '.join(GROUPS)})")
+        return 2
+
+    # O backend lê DATABASE_URL no import: banco descartável
+    workdir = tempfile.mkdtemp(prefix="mvpn-micro-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'micro.db')}"
+
+    suite = Suite(args)
+    try:
+        for group in GROUPS:
+            if group in groups:
+                {"hash": bench_hash, "serialize": bench_serialize, "db": bench_db}[group](suite)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {"meta": {**environment(), "users": list(args.users)}, "stages": suite.results}
+
+    print()
+    print_table(suite.results, columns=("count", "throughput_per_s", "p50_ms", "p95_ms", "mean_ms"))
+
+    # Lê a execução anterior antes de sobrescrevê-la
+    baseline = None
+    if args.compare:
+        if os.path.exists(args.compare):
+            baseline = load_results(args.compare)
+        else:
+            print(f"\nSem resultado anterior em {os.path.relpath(args.compare, ROOT)}")
+
+    save_results(LAST_RUN_PATH, results)
+    if args.output:
+        save_results(args.output, results)
+
+    if baseline:
+        rows, regressions = compare(suite.results, baseline["stages"], args.metric, args.threshold)
+        print_comparison(rows, args.metric, args.threshold)
+        if regressions:
+            print(f"\nRegressões: {', '.join(regressions)}")
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+import json
+import os
+import platform
+from datetime import datetime, timezone
+
+
+# ------------------------------------------------------
+# ESTATÍSTICAS
+# ------------------------------------------------------
+def percentile(sorted_samples, p):
+    """Percentil com interpolação linear (p entre 0 e 100)."""
+    if not sorted_samples:
+        return 0.0
+
+    k = (len(sorted_samples) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(sorted_samples) - 1)
+    return sorted_samples[low] + (sorted_samples[high] - sorted_samples[low]) * (k - low)
+
+
+def summarize(samples, wall_seconds=None):
+    """Amostras em segundos -> resumo em milissegundos (+ vazão, se houver wall)."""
+    ordered = sorted(samples)
+    ms = 1000.0
+
+    summary = {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * ms, 3) if ordered else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * ms, 3),
+        "p95_ms": round(percentile(ordered, 95) * ms, 3),
+        "p99_ms": round(percentile(ordered, 99) * ms, 3),
+        "max_ms": round(ordered[-1] * ms, 3) if ordered else 0.0,
+    }
+
+    if wall_seconds:
+        summary["throughput_per_s"] = round(len(ordered) / wall_seconds, 2)
+
+    return summary
+
+
+# ------------------------------------------------------
+# RESULTADOS E BASELINES
+# ------------------------------------------------------
+def environment():
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "date": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+    }
+
+
+def save_results(path, results):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(current, baseline, metric="p95_ms", threshold=0.25):
+    """
+    Compara `metric` de cada cenário com o baseline.
+    Retorna [(nome, baseline, atual, variação)] e a lista de regressões
+    (piora acima de `threshold`, ex.: 0.25 = 25%).
+    """
+    rows, regressions = [], []
+
+    for name, base in baseline.items():
+        if name not in current:
+            continue
+
+        before, after = base[metric], current[name][metric]
+        change = (after - before) / before if before else 0.0
+        rows.append((name, before, after, change))
+
+        if change > threshold:
+            regressions.append(name)
+
+    return rows, regressions
+
+
+def print_table(results, columns=("count", "throughput_per_s", "p50_ms", "p95_ms", "p99_ms", "max_ms")):
+    width = max([len(name) for name in results] + [8])
+    print(f"{'cenário':<{width}}  " + "  ".join(f"{c:>16}" for c in columns))
+
+    for name, summary in results.items():
+        cells = [summary.get(c, "") for c in columns]
+        print(f"{name:<{width}}  " + "  ".join(f"{c:>16}" for c in cells))
+
+
+def print_comparison(rows, metric, threshold):
+    width = max([len(r[0]) for r in rows] + [8])
+    print(f"\n{'cenário':<{width}}  {'baseline ' + metric:>20}  {'atual':>12}  {'variação':>10}")
+
+    for name, before, after, change in rows:
+        flag = "  <-- regressão" if change > threshold else ""
+        print(f"{name:<{width}}  {before:>20.3f}  {after:>12.3f}  {change:>+9.1%}{flag}")
@@ -182,12 +182,52 @@ async function openPix(days) {
             document.getElementById("pixModal")
         ).show();
 
+        watchPayment(data.payment_id);
+
     } catch (err) {
         console.error(err);
         alert("Erro ao conectar com o servidor");
     }
 }
 
+// ============================
+// STATUS DO PAGAMENTO (SSE)
+// ============================
+const PAYMENT_FAILED = ["rejected", "cancelled", "refunded", "charged_back", "failed", "expired"];
+let paymentEvents = null;
+
+function watchPayment(paymentId) {
+    if (paymentEvents) {
+        paymentEvents.close();
+    }
+
+    // EventSource não envia headers: o token vai na URL
+    paymentEvents = new EventSource(
+        API_URL + "/payments/" + paymentId + "/events?token=" + encodeURIComponent(getToken())
+    );
+
+    paymentEvents.addEventListener("status", (e) => {
+        const data = JSON.parse(e.data);
+
+        if (data.status === "approved") {
+            paymentEvents.close();
+            paymentEvents = null;
+
+            const modal = bootstrap.Modal.getInstance(document.getElementById("pixModal"));
+            if (modal) {
+                modal.hide();
+            }
+
+            alert("Pagamento aprovado! Seu plano já está disponível.");
+            openPlans();
+        } else if (PAYMENT_FAILED.includes(data.status)) {
+            paymentEvents.close();
+            paymentEvents = null;
+            alert("O pagamento não foi aprovado. Tente novamente.");
+        }
+    });
+}
+
 // ============================
 // COPIAR PIX
 // ============================
@@ -230,7 +270,7 @@ async function openPlans() {
                     <p>Usuário: <b>${p.username}</b></p>
                     <p>Expira: <b>${p.expires}</b></p>
                     <a class="btn btn-success btn-sm"
-                       href="/api/download-ehi/${p.id}"
+                       href="${p.download_url}"
                        target="_blank">
                        Download EHI
                     </a>